@@ -22,6 +22,96 @@ STATUS_CHECK_ID = '1017'
 FIELD_NOTES_PATH = ''
 JSONLD_CONTEXT_PATH = ''
 
+# resolved user filters (see utils/userfilters.py) are kept in memory,
+# for that many seconds at most (filters changed from another process
+# are picked up once expired)
+USERFILTER_CACHE_SIZE = 1000
+USERFILTER_CACHE_TTL = 600
+
+# /gene and /query responses cache, entries are dropped as soon as the
+# data changes (index name or _meta timestamp/build_version, checked at
+# most every INDEX_VERSION_CHECK_INTERVAL seconds).
+# backend: "memory" (per process, RESPONSE_CACHE_SIZE entries),
+# "disk" (shared folder, RESPONSE_CACHE_DISK_SIZE bytes) or None (disabled)
+RESPONSE_CACHE_BACKEND = "memory"
+RESPONSE_CACHE_SIZE = 10000
+RESPONSE_CACHE_DISK_PATH = "/tmp/mygene_response_cache"
+RESPONSE_CACHE_DISK_SIZE = 1024 ** 3
+# bigger responses (json encoded) are not cached
+RESPONSE_CACHE_MAX_ITEM_SIZE = 1024 ** 2
+# aggregations (facets) of /query results are also cached on their own,
+# whatever the page, fields or species_facet_filter (FACET_CACHE_SIZE
+# entries per process, 0 to disable)
+FACET_CACHE_SIZE = 1000
+INDEX_VERSION_CHECK_INTERVAL = 60
+
+# ES clients are shared per process and role (see utils.es.get_es): "api"
+# for API requests, which must fail fast, "batch" for index builds and
+# other scripts, which wait and retry. ES_HOST can list several nodes
+# (comma-separated), requests are spread over them; a failing node is left
+# out for ES_DEAD_TIMEOUT seconds, doubled on each consecutive failure
+# (up to 32 times)
+ES_CLIENT_PROFILES = {
+    "api": {"timeout": 30, "max_retries": 2, "retry_on_timeout": False,
+            "maxsize": 25},
+    "batch": {"timeout": 600, "max_retries": 100, "retry_on_timeout": True,
+              "maxsize": 10},
+}
+ES_DEAD_TIMEOUT = 60
+
+# API handlers query ES without blocking (see utils/es_async.py), with the
+# "api" profile above: max number of concurrent requests to ES per process
+# (more are queued)
+ES_ASYNC_MAX_CLIENTS = 200
+
+# include_tax_tree=1 expands species to their descendants using a local
+# copy of NCBI taxonomy: path to taxdump.tar.gz (or its nodes.dmp file).
+# If not set, species are expanded by TAXONOMY_SERVICE_URL, unless
+# TAXONOMY_REMOTE_FALLBACK is False. Expanded species lists are kept in
+# memory.
+TAXDUMP_PATH = None
+TAXONOMY_SERVICE_URL = 'http://t.biothings.io/v1/taxon'
+TAXONOMY_REMOTE_FALLBACK = True
+TAXONOMY_CACHE_SIZE = 10000
+
+# gene id -> genedoc _id index file (see utils/idindex.py), /gene/<id>
+# requests are served with a direct _id lookup when set and matching ES
+# data. Built with "python -m utils.idindex <genedoc collection>"
+ID_INDEX_PATH = None
+
+# genomic interval index file (see utils/intervalindex.py): when set and
+# matching ES data, "chrX:start-end" queries are resolved locally, then
+# run as an ids query (unless more than INTERVAL_INDEX_MAX_IDS genes
+# overlap). Built with "python -m utils.intervalindex <genedoc collection>"
+INTERVAL_INDEX_PATH = None
+INTERVAL_INDEX_MAX_IDS = 10000
+
+# time /gene and /query requests phases (params, build, es, clean,
+# serialize), reported on /metrics
+METRICS_ENABLED = True
+
+# concurrent identical ES requests (same url and body) from /gene and
+# /query share one in-flight call. Calls are counted for the last
+# ES_COALESCE_STATS_SIZE distinct requests, reported on /metrics
+ES_COALESCE_REQUESTS = True
+ES_COALESCE_STATS_SIZE = 1000
+
+# on startup, /status returns 503 until the process is warm (see
+# utils/warmup.py): requests of WARMUP_CORPUS_PATH (one path per line, built
+# from access logs with "python -m utils.warmup <access log>") are replayed,
+# WARMUP_CONCURRENCY at a time, for at most WARMUP_TIMEOUT seconds
+WARMUP_CORPUS_PATH = None
+WARMUP_CONCURRENCY = 10
+WARMUP_TIMEOUT = 300
+
+# /query ES bodies are given a cost estimate before being sent to ES (see
+# utils/querycost.py): over QUERY_COST_LIMIT they are rejected, over
+# QUERY_COST_SOFT_LIMIT ES returns hits found within QUERY_COST_SOFT_TIMEOUT.
+# None disables a limit. Costs are reported on /metrics
+QUERY_COST_LIMIT = 300
+QUERY_COST_SOFT_LIMIT = 100
+QUERY_COST_SOFT_TIMEOUT = '10s'
+
 GENOME_ASSEMBLY = {
     "human": "hg38",
     "mouse": "mm10",
@@ -124,3 +214,19 @@ DATA_SRC_BUILD_COLLECTION = 'src_build'     # for src data build information
 DATA_SRC_DATABASE = 'genedoc_src'
 
 DATA_TARGET_MASTER_COLLECTION = 'db_master'
+
+# source docs are merged into the target collection in unordered bulk
+# updates of MERGE_BULK_SIZE docs, each one acknowledged
+MERGE_BULK_SIZE = 1000
+# processes merging sources in parallel (DataBuilder.use_parallel, "-p"
+# option of databuild.builder), None for all cores
+MERGE_PROCESSES = None
+# sort-merge build mode (DataBuilder.sort_merge, "-s" option): roots and
+# source docs are sorted in chunks of SORT_MERGE_CHUNK_SIZE docs, spilled
+# to temp files in SORT_MERGE_TMP_FOLDER (None for system default)
+SORT_MERGE_CHUNK_SIZE = 200000
+SORT_MERGE_TMP_FOLDER = None
+# id mappings and root gene ids are stored as compact memory-mapped files
+# (see utils/idmapping.py) in IDMAPPING_FOLDER (None for system default).
+# Id mappings are kept there, built once per upload of their sources.
+IDMAPPING_FOLDER = None
@@ -4,6 +4,26 @@ Support MongoDB, ES, CouchDB
 '''
 from __future__ import print_function
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def combine_updates(updates):
+    '''return (id, extra_doc, index) from a list of (id, extra_doc) updates,
+       one per id: extra_docs of an id are combined in order, as applied
+       one after another ($set fields of the last update win), index is
+       the position of its last update in the list.
+    '''
+    combined = {}
+    for index, (id, extra_doc) in enumerate(updates):
+        if id in combined:
+            # given docs may be shared by several ids, copy
+            doc = dict(combined[id][0])
+            doc.update(extra_doc)
+            extra_doc = doc
+        combined[id] = (extra_doc, index)
+    return [(id, extra_doc, index) for id, (extra_doc, index) in combined.items()]
+
 
 class GeneDocBackendBase:
     name = 'Undefined'
@@ -19,6 +39,14 @@ class GeneDocBackendBase:
         '''update only, no upsert.'''
         raise NotImplemented
 
+    def bulk_update(self, updates):
+        '''update only, no upsert, for a list of (id, extra_doc).
+           Return the number of matching docs.
+        '''
+        for id, extra_doc in updates:
+            self.update(id, extra_doc)
+        return len(updates)
+
     def drop(self):
         raise NotImplemented
 
@@ -103,6 +131,27 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
                                       manipulate=False, check_keys=False,
                                       upsert=False, w=0)
 
+    def bulk_update(self, updates):
+        '''unordered, acknowledged bulk write: raise a BulkWriteError
+           (with failed updates in its "details") on write errors.
+           Updates of the same id are combined first (see combine_updates),
+           an unordered write wouldn't apply them in order.
+           Return the number of matching docs.
+        '''
+        if not updates:
+            return 0
+        combined = combine_updates(updates)
+        try:
+            res = self.target_collection.bulk_write(
+                [UpdateOne({'_id': id}, {'$set': extra_doc}) for id, extra_doc, _ in combined],
+                ordered=False)
+        except BulkWriteError as err:
+            # error indexes refer to given updates
+            for error in err.details.get('writeErrors', []):
+                error['index'] = combined[error['index']][2]
+            raise
+        return res.matched_count
+
     def update_diff(self, diff, extra={}):
         '''update a doc based on the diff returned from diff.diff_doc
             "extra" can be passed (as a dictionary) to add common fields to the
@@ -123,6 +172,20 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
     def drop(self):
         self.target_collection.drop()
 
+    def copy_from(self, collection_name):
+        '''replace target_collection with a copy of collection_name (in the
+           same database), made server-side.
+        '''
+        source = self.target_collection.database[collection_name]
+        source.aggregate([{'$match': {}}, {'$out': self.target_collection.name}])
+
+    def unset_fields(self, fields):
+        '''remove fields from all docs, return the number of docs updated.'''
+        res = self.target_collection.update_many(
+            {'$or': [{field: {'$exists': True}} for field in fields]},
+            {'$unset': dict((field, '') for field in fields)})
+        return res.modified_count
+
     def get_id_list(self):
         return [x['_id'] for x in self.target_collection.find(projection=[], manipulate=False)]
 
@@ -160,7 +223,8 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
 
     def finalize(self):
         '''flush all pending writes.'''
-        self.target_collection.database.client.fsync(async=True)
+        # "async" is a reserved word since python 3.7
+        self.target_collection.database.client.fsync(**{'async': True})
 
     def remove_from_ids(self, ids, step=10000):
         for i in range(0, len(ids), step):
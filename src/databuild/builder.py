@@ -1,20 +1,30 @@
 from __future__ import print_function
 import sys
 import os.path
+import gc
 import time
-import copy
+import numbers
+import tempfile
+import multiprocessing
 from datetime import datetime
 from pprint import pformat
 
+import gridfs
+from pymongo.errors import BulkWriteError
+
 from biothings.utils.mongo import (get_src_db, get_target_db, get_src_master,
                          get_src_build, get_src_dump, doc_feeder)
 from biothings.utils.common import (timesofar, ask, safewfile,
-                                    dump2gridfs, get_timestamp, get_random_string)
+                                    get_timestamp, get_random_string)
 from utils.common import setup_logfile, loadobj
 from utils.dataload import list2dict, alwayslist
 from utils.es import ESIndexer
+from utils.idmapping import IdMapping
 import databuild.backend
-from config import LOG_FOLDER, logger as logging
+from databuild import sortmerge
+from config import (LOG_FOLDER, MERGE_BULK_SIZE, MERGE_PROCESSES,
+                    SORT_MERGE_CHUNK_SIZE, SORT_MERGE_TMP_FOLDER, IDMAPPING_FOLDER,
+                    logger as logging)
 
 '''
 #Build_Config example
@@ -54,17 +64,234 @@ Build_Config = {
 '''
 
 
+# pickled id mappings uploaded to GridFS by the root sources loaders
+ENTREZ_GENEID_D = "entrez_gene__geneid_d.pyobj"
+ENSEMBL2ENTREZ_LI = "ensembl_gene__2entrezgene_list.pyobj"
+
+
+def _gridfs_version(db, filename):
+    '''upload time of a GridFS file (see dump2gridfs), as a version.'''
+    return gridfs.GridFS(db).get(filename).upload_date.strftime('%Y%m%d%H%M%S%f')
+
+
+def load_entrez_geneid_d(src, geneid_d=None):
+    '''return entrez gene ids (current or retired) -> current gene id, as
+       an IdMapping stored in IDMAPPING_FOLDER: built from its GridFS
+       pickle (or from geneid_d, by the loader) once per upload.
+    '''
+    return IdMapping.open_stored(
+        IDMAPPING_FOLDER, 'entrez_geneid_d', [_gridfs_version(src, ENTREZ_GENEID_D)],
+        lambda: (geneid_d or loadobj((ENTREZ_GENEID_D, src), mode='gridfs')).items())
+
+
+def load_ensembl2entrez(src, entrez_geneid_d, ensembl2entrez_li=None):
+    '''return ensembl gene id -> current entrez gene id(s), deprecated
+       entrez gene ids filtered out with entrez_geneid_d (see
+       load_entrez_geneid_d), as an IdMapping stored in IDMAPPING_FOLDER:
+       built from its GridFS pickle (or from ensembl2entrez_li, by the
+       loader) once per upload of either source.
+    '''
+    def items():
+        li = ensembl2entrez_li or loadobj((ENSEMBL2ENTREZ_LI, src), mode='gridfs')
+        li = [(ensembl_id, entrez_geneid_d[int(entrez_id)]) for (ensembl_id, entrez_id) in li
+              if int(entrez_id) in entrez_geneid_d]
+        return list2dict(li, 0).items()
+    return IdMapping.open_stored(
+        IDMAPPING_FOLDER, 'ensembl_gene',
+        [_gridfs_version(src, ENSEMBL2ENTREZ_LI), _gridfs_version(src, ENTREZ_GENEID_D)], items)
+
+
+def _bulk_update(target, updates, stats):
+    '''write updates with target.bulk_update, counting updated docs and
+       write errors into stats.
+    '''
+    if not updates:
+        return
+    try:
+        stats['updated'] += target.bulk_update(updates)
+    except BulkWriteError as err:
+        write_errors = err.details.get('writeErrors', [])
+        stats['updated'] += err.details.get('nMatched', 0)
+        stats['errors'] += len(write_errors)
+        for error in write_errors[:3]:
+            logging.error("Merge error on '%s': %s" % (updates[error['index']][0], error['errmsg']))
+
+
+def _target_ids(_id, geneid_set, idmapping_d=None):
+    '''return target _ids (in geneid_set) source doc _id is merged into.'''
+    if idmapping_d:
+        _id = idmapping_d.get(_id, None) or _id
+    # there could be cases that idmapping returns multiple entrez_gene ids.
+    return [str(__id) for __id in alwayslist(_id) if str(__id) in geneid_set]
+
+
+def merge_docs(docs, target, geneid_set, idmapping_d=None, bulk_size=MERGE_BULK_SIZE):
+    '''merge source docs into existing target docs (matched on _id, after
+       id mapping with idmapping_d), in bulk updates of bulk_size docs.
+       Return {"docs": source docs, "updated": target docs updated,
+       "errors": failed updates}.
+    '''
+    stats = {'docs': 0, 'updated': 0, 'errors': 0}
+    updates = []
+    for doc in docs:
+        stats['docs'] += 1
+        for __id in _target_ids(doc['_id'], geneid_set, idmapping_d):
+            doc.pop('_id', None)
+            doc.pop('taxid', None)
+            updates.append((__id, doc))
+        if len(updates) >= bulk_size:
+            _bulk_update(target, updates, stats)
+            updates = []
+    _bulk_update(target, updates, stats)
+    return stats
+
+
+def _same_id_type(id1, id2):
+    return isinstance(id1, numbers.Number) == isinstance(id2, numbers.Number) and \
+        (isinstance(id1, numbers.Number) or type(id1) is type(id2))
+
+
+def id_ranges(collection, size):
+    '''return _id filters splitting collection in ranges of at most size
+       docs. MongoDB range queries only match values of the bound's type,
+       so a new range also starts at each _id type change (numbers, then
+       strings...): the last range of a type is {"$gte": lo}, matching all
+       following _ids of that type.
+    '''
+    bounds = []
+    prev = None
+    cur = collection.find({}, {'_id': 1}).sort('_id', 1).batch_size(10000)
+    for i, doc in enumerate(cur):
+        _id = doc['_id']
+        if not bounds or i - bounds[-1][0] >= size or not _same_id_type(prev, _id):
+            bounds.append((i, _id))
+        prev = _id
+    filters = []
+    for (_, lo), hi in zip(bounds, [b[1] for b in bounds[1:]] + [None]):
+        if hi is not None and _same_id_type(lo, hi):
+            filters.append([{'_id': {'$gte': lo, '$lt': hi}}])
+        else:
+            filters.append([{'_id': {'$gte': lo}}])
+    return filters
+
+
+def shared_target_ids(collection, geneid_set, idmapping_d):
+    '''return _ids of collection docs updating a target doc also updated by
+       other docs (several source ids mapped to the same target id, see
+       merge_docs), in natural order, the order _merge_sequential merges
+       them in. Merged concurrently, the update applied last would depend
+       on timing.
+    '''
+    def targets():
+        for doc in collection.find({}, {'_id': 1}).batch_size(10000):
+            yield doc['_id'], _target_ids(doc['_id'], geneid_set, idmapping_d)
+    seen = set()
+    shared = set()
+    for _, ids in targets():
+        for __id in ids:
+            if __id in seen:
+                shared.add(__id)
+            seen.add(__id)
+    del seen
+    if not shared:
+        return []
+    return [_id for _id, ids in targets() if shared.intersection(ids)]
+
+
+def find_in_order(collection, ids, batch_size):
+    '''yield collection docs with given _ids, in ids order.'''
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        docs = dict([(doc['_id'], doc) for doc in collection.find({'_id': {'$in': batch}})])
+        for _id in batch:
+            if _id in docs:
+                yield docs[_id]
+
+
+def merge_range_stats(results, src_count):
+    '''sum stats of _merge_worker results for the ranges of a source of
+       src_count docs. Return (stats, errors): failed ranges, and a count
+       mismatch if some docs weren't merged.
+    '''
+    stats = {'docs': 0, 'updated': 0, 'errors': 0}
+    errors = []
+    for _, res in results:
+        if isinstance(res, dict):
+            for k in stats:
+                stats[k] += res[k]
+        else:
+            errors.append("range merge failed: {}".format(res))
+    if stats['docs'] != src_count:
+        errors.append("{} docs merged, {} in source".format(stats['docs'], src_count))
+    return stats, errors
+
+
+# set before merge worker processes are forked, so they share it
+# (copy-on-write) instead of receiving a pickled copy with each task:
+# {"geneid_set": ..., "idmapping": {id_type: idmapping_d}, "target": ...,
+#  "shared": {(collection, id_type): set of shared_target_ids}}
+_worker_state = {}
+
+
+def _merge_worker(task):
+    '''merge source docs matching one of id_filters (see id_ranges), in a
+       worker process, except docs with shared target ids (merged in order
+       afterwards). Return (collection, merge_docs stats or error).
+    '''
+    collection, id_filters, id_type, bulk_size = task
+    src = get_src_db()
+    target = databuild.backend.GeneDocMongoDBBackend(get_target_db()[_worker_state['target']])
+    shared = _worker_state['shared'].get((collection, id_type))
+    try:
+        stats = {'docs': 0, 'updated': 0, 'errors': 0}
+        for id_filter in id_filters:
+            cur = src[collection].find(id_filter, no_cursor_timeout=True).batch_size(1000)
+            docs = (doc for doc in cur if doc['_id'] not in shared) if shared else cur
+            try:
+                _stats = merge_docs(docs, target, _worker_state['geneid_set'],
+                                    _worker_state['idmapping'].get(id_type), bulk_size)
+            finally:
+                cur.close()
+            for k in stats:
+                stats[k] += _stats[k]
+        return collection, stats
+    except Exception as e:
+        return collection, "{}: {}".format(type(e).__name__, e)
+    finally:
+        src.client.close()
+        target.target_collection.database.client.close()
+
+
+def sources_to_remerge(sources, changed, src_fields):
+    '''return (sources, fields) to re-merge in an incremental build:
+       changed sources, plus sources sharing a field with them (a source
+       overwrites fields set by previous ones, so all of them are merged
+       again, in order), in sources order, and all their fields.
+       src_fields is {source: top-level fields}.
+    '''
+    remerge = set(changed)
+    while True:
+        fields = set(field for src in remerge for field in src_fields.get(src, []))
+        sharing = set(src for src in sources if fields & set(src_fields.get(src, [])))
+        if sharing <= remerge:
+            break
+        remerge |= sharing
+    return [src for src in sources if src in remerge], sorted(fields)
+
+
 class DataBuilder():
 
     def __init__(self, build_config=None, backend='mongodb'):
         self.src = get_src_db()
         self.step = 10000
-        self.use_parallel = False
+        self.bulk_size = MERGE_BULK_SIZE
+        self.use_parallel = False     # merge with a pool of MERGE_PROCESSES processes
+        self.merge_processes = MERGE_PROCESSES
+        self.sort_merge = False       # write each genedoc once, see databuild/sortmerge.py
+        self.incremental = False      # re-merge only sources changed since the last build
         self.merge_logging = True     # save output into a logging file when merge is called.
         self.max_build_status = 10    # max no. of records kept in "build" field of src_build collection.
 
-        self.using_ipython_cluster = False
-        self.shutdown_ipengines_after_done = False
         self.log_folder = LOG_FOLDER
 
         self._build_config = build_config
@@ -178,30 +405,33 @@ class DataBuilder():
         else:
             raise ValueError('"build_config" cannot be empty.')
 
+    def _to_idmapping(self, name, items):
+        '''return items (see IdMapping.build) as an IdMapping. Its file is
+           removed once mapped: it's only shared with forked workers.
+        '''
+        path = os.path.join(IDMAPPING_FOLDER or tempfile.gettempdir(), 'idmapping_{}_{}_{}'.format(
+                            self._build_config.get('name'), name, os.getpid()))
+        n = IdMapping.build(path, items)
+        idmapping = IdMapping(path)
+        os.remove(path)
+        logging.info("%s: %d ids, %.1fMB" % (name, n, len(idmapping._mm) / 1024. ** 2))
+        return idmapping
+
     def _load_entrez_geneid_d(self):
-        self._entrez_geneid_d = loadobj(("entrez_gene__geneid_d.pyobj", self.src), mode='gridfs')
+        self._entrez_geneid_d = load_entrez_geneid_d(self.src)
+        logging.info("entrez_geneid_d: %d ids" % len(self._entrez_geneid_d))
 
     def _load_ensembl2entrez_li(self):
-        ensembl2entrez_li = loadobj(("ensembl_gene__2entrezgene_list.pyobj", self.src), mode='gridfs')
-        #filter out those deprecated entrez gene ids
-        logging.info(len(ensembl2entrez_li))
-        ensembl2entrez_li = [(ensembl_id, self._entrez_geneid_d[int(entrez_id)]) for (ensembl_id, entrez_id) in ensembl2entrez_li
-                             if int(entrez_id) in self._entrez_geneid_d]
-        logging.info(len(ensembl2entrez_li))
-        ensembl2entrez = list2dict(ensembl2entrez_li, 0)
-        self._idmapping_d_cache['ensembl_gene'] = ensembl2entrez
-
-    def _save_idmapping_gridfs(self):
-        '''saving _idmapping_d_cache into gridfs.'''
-        idmapping_gridfs_d = {}
-        if self._idmapping_d_cache:
-            for id_type in self._idmapping_d_cache:
-                filename = 'tmp_idmapping_d_cache_' + id_type
-                dump2gridfs(self._idmapping_d_cache[id_type], filename, self.src)
-                idmapping_gridfs_d[id_type] = filename
-        return idmapping_gridfs_d
-
-    def make_genedoc_root(self):
+        if not self._entrez_geneid_d:
+            self._load_entrez_geneid_d()
+        self._idmapping_d_cache['ensembl_gene'] = load_ensembl2entrez(self.src, self._entrez_geneid_d)
+        logging.info("ensembl_gene: %d ids" % len(self._idmapping_d_cache['ensembl_gene']))
+
+    def make_genedoc_root(self, target=None):
+        '''insert root docs into target (self.target by default), return
+           the set of root gene ids.
+        '''
+        target = target or self.target
         if not self._entrez_geneid_d:
             self._load_entrez_geneid_d()
 
@@ -221,7 +451,7 @@ class DataBuilder():
         if "entrez_gene" in self._build_config['gene_root']:
             for doc_li in doc_feeder(self.src['entrez_gene'], inbatch=True, step=self.step, query=_query):
                 #target_collection.insert(doc_li, manipulate=False, check_keys=False)
-                self.target.insert(doc_li)
+                target.insert(doc_li)
                 geneid_set.extend([doc['_id'] for doc in doc_li])
                 species_set |= set([doc['taxid'] for doc in doc_li])
             cnt_total_entrez_genes = len(geneid_set)
@@ -245,13 +475,13 @@ class DataBuilder():
                         geneid_set.append(_doc['_id'])
                 if _doc_li:
                     #target_collection.insert(_doc_li, manipulate=False, check_keys=False)
-                    self.target.insert(_doc_li)
+                    target.insert(_doc_li)
             cnt_matching_ensembl_genes = cnt_total_ensembl_genes - cnt_ensembl_only_genes
             logging.info('# of ensembl Gene IDs in total: %d' % cnt_total_ensembl_genes)
             logging.info('# of ensembl Gene IDs match entrez Gene IDs: %d' % cnt_matching_ensembl_genes)
             logging.info('# of ensembl Gene IDs DO NOT match entrez Gene IDs: %d' % cnt_ensembl_only_genes)
 
-            geneid_set = set(geneid_set)
+            geneid_set = self._to_idmapping('geneid_set', geneid_set)
             logging.info('# of total Root Gene IDs: %d' % len(geneid_set))
             _stats = {'total_entrez_genes': cnt_total_entrez_genes,
                       'total_species': cnt_total_species,
@@ -278,10 +508,14 @@ class DataBuilder():
         self.prepare_target(target_name=target)
         self.log_building_start()
         try:
-            if self.using_ipython_cluster:
+            if self.sort_merge:
                 if sources:
-                    raise NotImplemented("merge speficic sources not supported when using parallel")
-                self._merge_ipython_cluster(step=step)
+                    raise NotImplementedError("merge specific sources not supported in sort-merge mode")
+                self._merge_sort_merge(step=step)
+            elif self.incremental:
+                if sources:
+                    raise NotImplementedError("merge specific sources not supported in incremental mode")
+                self._merge_incremental(step=step)
             else:
                 self._merge_local(step=step, restart_at=restart_at,src_collection_list=sources)
 
@@ -313,7 +547,6 @@ class DataBuilder():
         '''resume a merging process after a failure.
              .merge_resume('mygene_allspecies', 'reporter')
         '''
-        assert not self.using_ipython_cluster, "Abort. Can only resume merging in non-parallel mode."
         self.load_build_config(build_config)
         last_build = self._build_config['build'][-1]
         logging.info("Last build record:")
@@ -347,124 +580,6 @@ class DataBuilder():
             self.log_src_build({'status': 'success',
                                 'timestamp': datetime.now()})
 
-    def _merge_ipython_cluster(self, step=100000):
-        '''Do the merging on ipython cluster.'''
-        from ipyparallel import Client, require
-        from config import CLUSTER_CLIENT_JSON
-
-        t0 = time.time()
-        src_collection_list = [collection for collection in self._build_config['sources']
-                               if collection not in ['entrez_gene', 'ensembl_gene']]
-
-        self.target.drop()
-        self.target.prepare()
-        geneid_set = self.make_genedoc_root()
-
-        idmapping_gridfs_d = self._save_idmapping_gridfs()
-
-        logging.info(timesofar(t0))
-
-        rc = Client(CLUSTER_CLIENT_JSON)
-        lview = rc.load_balanced_view()
-        logging.info("\t# nodes in use: {}".format(len(lview.targets or rc.ids)))
-        lview.block = False
-        kwargs = {}
-        target_collection = self.target.target_collection
-        kwargs['server'], kwargs['port'] = target_collection.database.client.address
-        kwargs['src_db'] = self.src.name
-        kwargs['target_db'] = target_collection.database.name
-        kwargs['target_collection_name'] = target_collection.name
-        kwargs['limit'] = step
-
-        @require('pymongo', 'time', 'types')
-        def worker(kwargs):
-            server = kwargs['server']
-            port = kwargs['port']
-            src_db = kwargs['src_db']
-            target_db = kwargs['target_db']
-            target_collection_name = kwargs['target_collection_name']
-
-            src_collection = kwargs['src_collection']
-            skip = kwargs['skip']
-            limit = kwargs['limit']
-
-            def load_from_gridfs(filename, db):
-                import gzip
-                import pickle
-                import gridfs
-                fs = gridfs.GridFS(db)
-                fobj = fs.get(filename)
-                gzfobj = gzip.GzipFile(fileobj=fobj)
-                try:
-                    object = pickle.load(gzfobj)
-                finally:
-                    gzfobj.close()
-                    fobj.close()
-                return object
-
-            def alwayslist(value):
-                if value is None:
-                    return []
-                if isinstance(value, (list, tuple)):
-                    return value
-                else:
-                    return [value]
-
-            conn = pymongo.MongoClient(server, port)
-            src = conn[src_db]
-            target_collection = conn[target_db][target_collection_name]
-
-            idmapping_gridfs_name = kwargs.get('idmapping_gridfs_name', None)
-            if idmapping_gridfs_name:
-                idmapping_d = load_from_gridfs(idmapping_gridfs_name, src)
-            else:
-                idmapping_d = None
-
-            cur = src[src_collection].find(skip=skip, limit=limit, timeout=False)
-            cur.batch_size(1000)
-            try:
-                for doc in cur:
-                    _id = doc['_id']
-                    if idmapping_d:
-                        _id = idmapping_d.get(_id, None) or _id
-                    # there could be cases that idmapping returns multiple entrez_gene id.
-                    for __id in alwayslist(_id): 
-                        __id = str(__id)
-                        doc.pop('_id', None)
-                        doc.pop('taxid', None)
-                        target_collection.update({'_id': __id}, doc, manipulate=False, upsert=False)
-                        #target_collection.update({'_id': __id}, {'$set': doc},
-            finally:
-                cur.close()
-
-        t0 = time.time()
-        task_list = []
-        for src_collection in src_collection_list:
-            _kwargs = copy.copy(kwargs)
-            _kwargs['src_collection'] = src_collection
-            id_type = self.src_master[src_collection].get('id_type', None)
-            if id_type:
-                idmapping_gridfs_name = idmapping_gridfs_d[id_type]
-                _kwargs['idmapping_gridfs_name'] = idmapping_gridfs_name
-            cnt = self.src[src_collection].count()
-            for s in range(0, cnt, step):
-                __kwargs = copy.copy(_kwargs)
-                __kwargs['skip'] = s
-                task_list.append(__kwargs)
-
-        logging.info("\t# of tasks: {}".format(len(task_list)))
-        logging.info("\tsubmitting...")
-        job = lview.map_async(worker, task_list)
-        logging.info("done.")
-        job.wait_interactive()
-        logging.info("\t# of results returned: {}".format(len(job.result())))
-        logging.info("\ttotal time: {}".format(timesofar(t0)))
-
-        if self.shutdown_ipengines_after_done:
-            logging.info("\tshuting down all ipengine nodes...")
-            lview.shutdown()
-            logging.info('Done.')
-
     def _merge_local(self, step=100000, restart_at=0, src_collection_list=None):
         if restart_at == 0 and src_collection_list is None:
             self.target.drop()
@@ -480,127 +595,209 @@ class DataBuilder():
         if not src_collection_list:
             src_collection_list = self._build_config['sources']
         src_cnt = 0
+        to_merge = []
         for collection in src_collection_list:
             if collection in ['entrez_gene', 'ensembl_gene']:
                 continue
 
             src_cnt += 1
+            if restart_at <= src_cnt:
+                to_merge.append((collection, self.src_master[collection].get('id_type', None)))
 
-            id_type = self.src_master[collection].get('id_type', None)
-            flag_need_id_conversion = id_type is not None
-            if flag_need_id_conversion:
-                idmapping_d = self.get_idmapping_d(id_type)
-            else:
-                idmapping_d = None
+        merge_stats = self._merge_sources(to_merge, geneid_set, step=step)
+        self.target.finalize()
+        if merge_stats:
+            self.log_src_build({'merge_stats': merge_stats})
 
-            if restart_at <= src_cnt:
-                if self.use_parallel:
-                    self.doc_queue = []
-                    self._merge_parallel_ipython(collection, geneid_set,
-                                                 step=step, idmapping_d=idmapping_d)
-                else:
-                    self._merge_sequential(collection, geneid_set,
-                                           step=step, idmapping_d=idmapping_d)
+    def _merge_sources(self, to_merge, geneid_set, step=100000):
+        '''merge (collection, id_type) sources into target, one after
+           another or with a pool of processes. Return {collection: stats}.
+        '''
+        if self.use_parallel:
+            return self._merge_pool(to_merge, geneid_set, step=step)
+        merge_stats = {}
+        for collection, id_type in to_merge:
+            idmapping_d = self.get_idmapping_d(id_type) if id_type else None
+            merge_stats[collection] = self._merge_sequential(
+                collection, geneid_set, step=step, idmapping_d=idmapping_d)
+        return merge_stats
+
+    def _merge_incremental(self, step=100000):
+        '''build target from a copy of the last successful build target,
+           re-merging only sources whose src_dump version changed since (see
+           sources_to_remerge): their fields (top-level keys of their
+           src_master mapping) are unset, then they are merged again. Fall
+           back to a full merge when there's no such build, or when a gene
+           root source changed.
+        '''
+        assert self.target.name == 'mongodb', \
+            'Abort. Incremental merge needs "mongodb" backend.'
+        t0 = time.time()
+        last_build = self.get_last_build()
+        if not last_build:
+            logging.info("No previous build to update, doing a full merge.")
+            return self._merge_local(step=step)
+        src_version = self.get_src_version()
+        changed = self.get_changed_sources(last_build, src_version)
+        src_fields = dict([(collection, list(self.src_master[collection].get('mapping', {})))
+                           for collection in self._build_config['sources']])
+        sources, fields = sources_to_remerge(self._build_config['sources'], changed, src_fields)
+        logging.info("Changed since %s: %s, re-merging: %s" % (last_build['target'], changed, sources))
+        if set(sources) & set(['entrez_gene', 'ensembl_gene']):
+            logging.info("Gene roots changed, doing a full merge.")
+            return self._merge_local(step=step)
+        no_mapping = [collection for collection in sources if not src_fields[collection]]
+        if no_mapping:
+            logging.info("No mapping for %s, doing a full merge." % no_mapping)
+            return self._merge_local(step=step)
+
+        self.target.copy_from(last_build['target'])
+        unset = self.target.unset_fields(fields) if fields else 0
+        logging.info("Copied %s, fields %s unset in %d docs [%s]" % (
+                     last_build['target'], fields, unset, timesofar(t0)))
+        if not self._entrez_geneid_d:
+            self._load_entrez_geneid_d()
+        geneid_set = self._to_idmapping('geneid_set', self.target.get_id_list())
+        to_merge = [(collection, self.src_master[collection].get('id_type', None))
+                    for collection in sources]
+        merge_stats = self._merge_sources(to_merge, geneid_set, step=step)
         self.target.finalize()
+        self._stats = last_build.get('stats')
+        self._src_version = src_version
+        self.log_src_build({'stats': self._stats,
+                            'src_version': src_version,
+                            'merge_stats': merge_stats,
+                            'incremental': {'from': last_build['target'],
+                                            'changed': changed,
+                                            'sources': sources,
+                                            'unset_fields': fields,
+                                            'unset_docs': unset}})
+
+    def _merge_sort_merge(self, step=100000):
+        '''build target with a sort-merge join of roots and sources (see
+           databuild/sortmerge.py): each genedoc is inserted once, complete,
+           in inserts of bulk_size docs.
+        '''
+        t0 = time.time()
+        self.target.drop()
+        self.target.prepare()
+        roots = sortmerge.ExternalSort(SORT_MERGE_CHUNK_SIZE, SORT_MERGE_TMP_FOLDER)
+        geneid_set = self.make_genedoc_root(target=roots)
+        roots.flush()
+        collections = [collection for collection in self._build_config['sources']
+                       if collection not in ['entrez_gene', 'ensembl_gene']]
+        updates = []
+        try:
+            for src_idx, collection in enumerate(collections, 1):
+                id_type = self.src_master[collection].get('id_type', None)
+                idmapping_d = self.get_idmapping_d(id_type) if id_type else None
+                updates.append(sortmerge.sorted_updates(
+                    doc_feeder(self.src[collection], step=step), src_idx, geneid_set,
+                    idmapping_d, SORT_MERGE_CHUNK_SIZE, SORT_MERGE_TMP_FOLDER))
+                logging.info("%s sorted [%s]" % (collection, timesofar(t0)))
+            stats = {}
+            doc_li = []
+            for doc in sortmerge.merge_sorted(roots, *updates, stats=stats):
+                doc_li.append(doc)
+                if len(doc_li) >= self.bulk_size:
+                    self.target.insert(doc_li)
+                    doc_li = []
+            if doc_li:
+                self.target.insert(doc_li)
+        finally:
+            for sorter in [roots] + updates:
+                sorter.close()
+        self.target.finalize()
+        merge_stats = dict([(collection, {'updated': stats.get(src_idx, 0)})
+                            for src_idx, collection in enumerate(collections, 1)])
+        logging.info("Sort-merge done [%s]: %s" % (timesofar(t0), merge_stats))
+        self.log_src_build({'merge_stats': merge_stats})
 
     def _merge_sequential(self, collection, geneid_set, step=100000, idmapping_d=None):
-        for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
-            for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc.pop('_id', None)
-                    doc.pop('taxid', None)
-                    # target_collection.update({'_id': __id}, {'$set': doc},
-                    #                           manipulate=False,
-                    #                           upsert=False) #,safe=True)
-                    self.target.update(__id, doc)
-
-    def _merge_parallel(self, collection, geneid_set, step=100000, idmapping_d=None):
-        from multiprocessing import Process, Queue
-        NUMBER_OF_PROCESSES = 8
-
-        input_queue = Queue()
-        input_queue.conn_pool = []
-
-        def worker(q, target):
-            while True:
-                doc = q.get()
-                if doc == 'STOP':
-                    break
-                __id = doc.pop('_id')
-                doc.pop('taxid', None)
-                target.update(__id, doc)
-                # target_collection.update({'_id': __id}, {'$set': doc},
-                #                           manipulate=False,
-                #                           upsert=False) #,safe=True)
-
-        # Start worker processes
-        for i in range(NUMBER_OF_PROCESSES):
-            Process(target=worker, args=(input_queue, self.target)).start()
-
-        for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
-            for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc['_id'] = __id
-                    input_queue.put(doc)
-
-        # Tell child processes to stop
-        for i in range(NUMBER_OF_PROCESSES):
-            input_queue.put('STOP')
-
-    def _merge_parallel_ipython(self, collection, geneid_set, step=100000, idmapping_d=None):
-        from IPython.parallel import Client, require
-
-        rc = Client()
-        dview = rc[:]
-        #dview = rc.load_balanced_view()
-        dview.block = False
-        target_collection = self.target.target_collection
-        dview['server'], dview['port'] = target_collection.database.client.address
-        dview['database'] = target_collection.database.name
-        dview['collection_name'] = target_collection.name
-
-        def partition(lst, n):
-            q, r = divmod(len(lst), n)
-            indices = [q * i + min(i, r) for i in range(n + 1)]
-            return [lst[indices[i]:indices[i + 1]] for i in range(n)]
-
-        @require('pymongo', 'time')
-        def worker(doc_li):
-            conn = pymongo.MongoClient(server, port)
-            target_collection = conn[database][collection_name]
-            t0 = time.time()
-            for doc in doc_li:
-                __id = doc.pop('_id')
-                doc.pop('taxid', None)
-                target_collection.update({'_id': __id}, {'$set': doc},
-                                         manipulate=False,
-                                         upsert=False)  # ,safe=True)
-            logging.info('Done. [%.1fs]' % (time.time() - t0))
-
-        for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
-            for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc['_id'] = __id
-                    self.doc_queue.append(doc)
-
-                    if len(self.doc_queue) >= step:
-                        #dview.scatter('doc_li', self.doc_queue)
-                        #dview.apply_async(worker)
-                        dview.map_async(worker, partition(self.doc_queue, len(rc.ids)))
-                        self.doc_queue = []
-                        logging.info("!")
+        '''merge source collection into target, return merge_docs stats,
+           with time and docs/s.
+        '''
+        t0 = time.time()
+        stats = merge_docs(doc_feeder(self.src[collection], step=step), self.target,
+                           geneid_set, idmapping_d=idmapping_d, bulk_size=self.bulk_size)
+        t1 = time.time() - t0
+        stats['time_in_s'] = round(t1, 1)
+        stats['docs_per_s'] = int(stats['docs'] / t1) if t1 else 0
+        logging.info("%s: %s" % (collection, stats))
+        if stats['errors']:
+            logging.error("%s: %d updates failed" % (collection, stats['errors']))
+        return stats
+
+    def _merge_pool(self, to_merge, geneid_set, step=100000):
+        '''merge (collection, id_type) sources with a pool of merge_processes
+           worker processes (all cores if None), source after source (a
+           source may overwrite fields of a previous one). Each source is
+           split in _id ranges of step docs. Docs sharing a target doc with
+           other docs (see shared_target_ids) are merged afterwards, in
+           source order, so the result is the same as a sequential merge.
+           geneid_set and id mappings are loaded before the workers are
+           forked, and shared with them. Return {collection: stats}, raise
+           RuntimeError if a range failed.
+        '''
+        assert self.target.name == 'mongodb', \
+            'Abort. Parallel merge needs "mongodb" backend.'
+        _worker_state['geneid_set'] = geneid_set
+        _worker_state['idmapping'] = dict([(id_type, self.get_idmapping_d(id_type))
+                                           for id_type in set(x[1] for x in to_merge) if id_type])
+        _worker_state['target'] = self.target.target_name
+        shared_ids = {}
+        for collection, id_type in to_merge:
+            # without id mapping, each source doc has its own target doc
+            if id_type and (collection, id_type) not in shared_ids:
+                ids = shared_target_ids(self.src[collection], geneid_set,
+                                        _worker_state['idmapping'][id_type])
+                logging.info("%s: %d docs with shared target ids" % (collection, len(ids)))
+                shared_ids[(collection, id_type)] = ids
+        _worker_state['shared'] = dict([(key, set(ids)) for key, ids in shared_ids.items() if ids])
+        # objects created so far won't be tracked by gc anymore, so
+        # collections don't touch (and copy) their pages in workers
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        pool = multiprocessing.get_context('fork').Pool(self.merge_processes)
+        merge_stats = {}
+        failed = []
+        try:
+            for collection, id_type in to_merge:
+                t0 = time.time()
+                tasks = [(collection, id_filters, id_type, self.bulk_size)
+                         for id_filters in id_ranges(self.src[collection], step)]
+                results = list(pool.imap_unordered(_merge_worker, tasks))
+                shared = shared_ids.get((collection, id_type))
+                if shared:
+                    results.append((collection, merge_docs(
+                        find_in_order(self.src[collection], shared, self.bulk_size),
+                        self.target, geneid_set, _worker_state['idmapping'][id_type],
+                        self.bulk_size)))
+                stats, errors = merge_range_stats(results, self.src[collection].count())
+                for error in errors:
+                    logging.error("%s: %s" % (collection, error))
+                if errors:
+                    failed.append(collection)
+                t1 = time.time() - t0
+                stats['time_in_s'] = round(t1, 1)
+                stats['docs_per_s'] = int(stats['docs'] / t1) if t1 else 0
+                stats['ranges'] = len(tasks)
+                stats['shared'] = len(shared or [])
+                logging.info("%s: %s" % (collection, stats))
+                merge_stats[collection] = stats
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_state.clear()
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+        if failed:
+            raise RuntimeError("Merge failed for: {}".format(', '.join(sorted(set(failed)))))
+        return merge_stats
 
     def get_src_version(self):
         src_dump = get_src_dump(self.src.client)
@@ -611,6 +808,39 @@ class DataBuilder():
                 src_version[src['_id']] = version
         return src_version
 
+    def get_last_build(self):
+        '''return the last successful build record of src_build, with source
+           versions and an existing "mongodb" target.
+        '''
+        src_build = getattr(self, 'src_build', None)
+        if src_build:
+            _cfg = src_build.find_one({'_id': self._build_config['_id']})
+            target_names = set(get_target_db().collection_names())
+            for build in reversed(_cfg.get('build', [])):
+                if build.get('status', None) == 'success' and build.get('src_version', None) and \
+                   build.get('target_backend', None) == 'mongodb' and build.get('target', None) in target_names:
+                    return build
+
+    def get_changed_sources(self, last_build, src_version=None):
+        '''return build config sources whose src_dump version (as in
+           src_version, current ones by default) differs from last_build
+           ones. A source without version is changed if it was loaded after
+           last_build started.
+        '''
+        from dataload import __sources_dict__
+        src_dump_names = dict([(src.split('.')[-1], dump) for dump, srcs in __sources_dict__.items()
+                               for src in srcs])
+        src_version = src_version or self.get_src_version()
+        changed = []
+        for collection in self._build_config['sources']:
+            dump = src_dump_names.get(collection, collection)
+            if dump in src_version or dump in last_build['src_version']:
+                if src_version.get(dump, None) != last_build['src_version'].get(dump, None):
+                    changed.append(collection)
+            elif self.src_master[collection].get('timestamp', datetime.max) > last_build['started_at']:
+                changed.append(collection)
+        return changed
+
     def get_last_src_build_stats(self):
         src_build = getattr(self, 'src_build', None)
         if src_build:
@@ -844,23 +1074,30 @@ class DataBuilder():
 
 
 def main():
-    if len(sys.argv) > 1:
-        config = sys.argv[1]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+    if args:
+        config = args[0]
     else:
         config = 'mygene_allspecies'
+    # -p: merge with local worker processes, -s: sort-merge mode,
+    # -i: incremental (re-merge changed sources only)
     use_parallel = '-p' in sys.argv
+    sort_merge = '-s' in sys.argv
+    incremental = '-i' in sys.argv
     sources = None  # will build all sources
     target = None   # will generate a new collection name
     # "target_col:src_col1,src_col2" will specifically merge src_col1
     # and src_col2 into existing target_col (instead of merging everything)
-    if not use_parallel and len(sys.argv) > 2:
-        target,tmp = sys.argv[2].split(":")
+    if len(args) > 1:
+        target,tmp = args[1].split(":")
         sources = tmp.split(",")
 
     t0 = time.time()
     bdr = DataBuilder(backend='mongodb')
     bdr.load_build_config(config)
-    bdr.using_ipython_cluster = use_parallel
+    bdr.use_parallel = use_parallel
+    bdr.sort_merge = sort_merge
+    bdr.incremental = incremental
     bdr.merge(sources=sources,target=target)
 
     logging.info("Finished. %s" % timesofar(t0))
@@ -0,0 +1,123 @@
+'''
+Sort-merge join of gene roots and source docs: every merged genedoc is
+built in memory, then written once, instead of being inserted as a root
+and updated once per source.
+
+Root docs and (id-mapped) source docs are sorted on target _id with an
+external sort (sorted chunks spilled to temp files, then merged), and
+all sorted streams are joined with a k-way merge. Source docs are applied
+to their root in the same order as DataBuilder._merge_sequential does
+(sources in build config order, then docs in source order), so merged
+genedocs are the same.
+'''
+import heapq
+import pickle
+import tempfile
+import itertools
+
+from utils.dataload import alwayslist
+
+
+class ExternalSort(object):
+    '''sort (key, ...) tuples of any number, keeping at most chunk_size of
+       them in memory. Also collects root docs as a backend does, with
+       insert(doc_li).
+    '''
+
+    def __init__(self, chunk_size=200000, tmp_folder=None):
+        self.chunk_size = chunk_size
+        self.tmp_folder = tmp_folder
+        self._chunk = []
+        self._runs = []
+        self._seq = 0
+
+    def add(self, item):
+        self._chunk.append(item)
+        if len(self._chunk) >= self.chunk_size:
+            self._spill()
+
+    def insert(self, doc_li):
+        '''add root docs, keyed on _id (source index 0).'''
+        for doc in doc_li:
+            self.add((str(doc['_id']), 0, self._seq, doc))
+            self._seq += 1
+
+    def flush(self):
+        '''spill items kept in memory to a temp file.'''
+        if self._chunk:
+            self._spill()
+
+    def _spill(self):
+        self._chunk.sort()
+        f = tempfile.TemporaryFile(dir=self.tmp_folder)
+        # one pickle per item, read back one at a time
+        for item in self._chunk:
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        self._runs.append(f)
+        self._chunk = []
+
+    @staticmethod
+    def _read_run(f):
+        try:
+            while True:
+                yield pickle.load(f)
+        except EOFError:
+            pass
+        finally:
+            f.close()
+
+    def __iter__(self):
+        '''sorted items, this can be iterated only once.'''
+        self._chunk.sort()
+        runs = [self._read_run(f) for f in self._runs] + [iter(self._chunk)]
+        self._runs = []
+        return heapq.merge(*runs)
+
+    def close(self):
+        for f in self._runs:
+            f.close()
+        self._runs = []
+        self._chunk = []
+
+
+def sorted_updates(docs, src_idx, geneid_set, idmapping_d=None,
+                   chunk_size=200000, tmp_folder=None):
+    '''return source docs as (target _id, src_idx, seq, doc) sorted
+       on target _id, with the same id mapping and filtering as
+       databuild.builder.merge_docs.
+    '''
+    updates = ExternalSort(chunk_size, tmp_folder)
+    seq = 0
+    for doc in docs:
+        _id = doc['_id']
+        if idmapping_d:
+            _id = idmapping_d.get(_id, None) or _id
+        for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+            __id = str(__id)
+            if __id in geneid_set:
+                doc.pop('_id', None)
+                doc.pop('taxid', None)
+                updates.add((__id, src_idx, seq, doc))
+                seq += 1
+    updates.flush()
+    return updates
+
+
+def merge_sorted(roots, *updates, **kwargs):
+    '''k-way merge of sorted roots (see ExternalSort.insert) and sorted
+       source updates (see sorted_updates): yield merged genedocs, in _id
+       order. Updates without a root are dropped. "stats" kwarg, if given,
+       is a dict filled with {src_idx: number of updates applied}.
+    '''
+    stats = kwargs.get('stats', {})
+    for _id, group in itertools.groupby(heapq.merge(roots, *updates), key=lambda x: x[0]):
+        _, src_idx, _, doc = next(group)
+        if src_idx != 0:
+            # no root for this gene, as updates don't upsert
+            continue
+        doc = dict(doc)
+        for _, src_idx, _, update in group:
+            doc.update(update)
+            stats[src_idx] = stats.get(src_idx, 0) + 1
+        yield doc
@@ -6,6 +6,7 @@ import types
 import time
 import datetime
 import importlib
+import gridfs
 from biothings.utils.mongo import get_src_conn, get_src_dump, get_data_folder
 from biothings.utils.common import get_timestamp, get_random_string, timesofar, dump2gridfs, iter_n
 from config import DATA_SRC_DATABASE, DATA_SRC_MASTER_COLLECTION
@@ -140,12 +141,21 @@ class GeneDocSource(dict):
                 geneid_d = self.get_geneid_d()
                 dump2gridfs(geneid_d, self.__collection__ + '__geneid_d.pyobj', self.db)
                 print('Done[%s]' % timesofar(t0))
+                # id mapping files opened by the builder, built once here
+                from databuild.builder import load_entrez_geneid_d
+                load_entrez_geneid_d(self.db, geneid_d)
             if getattr(self, 'ENSEMBL_GENEDOC_ROOT', False):
                 print('Uploading "mapping2entrezgene" to GridFS...', end='')
                 t0 = time.time()
                 x2entrezgene_list = self.get_mapping_to_entrez()
                 dump2gridfs(x2entrezgene_list, self.__collection__ + '__2entrezgene_list.pyobj', self.db)
                 print('Done[%s]' % timesofar(t0))
+                from databuild.builder import load_entrez_geneid_d, load_ensembl2entrez
+                try:
+                    load_ensembl2entrez(self.db, load_entrez_geneid_d(self.db), x2entrezgene_list)
+                except gridfs.NoFile:
+                    # entrez_gene not loaded yet, left to the builder
+                    pass
 
         if update_master:
             # update src_master collection
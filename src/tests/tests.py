@@ -176,6 +176,12 @@ class MyGeneTest(BiothingTestHelperMixin):
         eq_(res[0]['_id'], '1017')
         eq_(res[1]['_id'], '1018')
 
+    def test_query_cost(self):
+        res = self.json_ok(self.get_ok(self.api + '/query?q=' +
+                                       '%20OR%20'.join(['symbol:*dk'] * 10)),
+                           checkerror=False)
+        ok_('expensive' in res['error'])
+
     def test_query_interval(self):
         res = self.json_ok(self.get_ok(self.api +
                            '/query?q=chr1:1000-100000&species=human'))
@@ -222,6 +228,9 @@ class MyGeneTest(BiothingTestHelperMixin):
         # testing non-ascii character
         self.get_404(self.api + '/gene/' +
                      '54097\xef\xbf\xbd\xef\xbf\xbdmouse')
+        # not in the id index, matched by the analyzed ensembl.gene field
+        res = self.json_ok(self.get_ok(self.api + '/gene/ensg00000123374'))
+        eq_(res['_id'], '1017')
 
         # commented out this test, as no more
         # allow dot in the geneid
@@ -239,6 +248,22 @@ class MyGeneTest(BiothingTestHelperMixin):
         self.get_404(self.api + '/gene')
         self.get_404(self.api + '/gene/')
 
+    def test_response_cache(self):
+        # same request twice (second one likely served from cache)
+        res = self.json_ok(self.get_ok(self.api + '/gene/1017?fields=symbol,name'))
+        res2 = self.json_ok(self.get_ok(self.api + '/gene/1017?fields=symbol,name'))
+        eq_(res, res2)
+        # fields order doesn't matter
+        res3 = self.json_ok(self.get_ok(self.api + '/gene/1017?fields=name,symbol'))
+        eq_(res, res3)
+        res = self.json_ok(self.get_ok(self.api + '/query?q=cdk2&species=human'))
+        res2 = self.json_ok(self.get_ok(self.api + '/query?q=cdk2&species=human'))
+        eq_([h['_id'] for h in res['hits']], [h['_id'] for h in res2['hits']])
+        # errors are not cached
+        res = self.json_ok(self.get_ok(self.api + '/query?q=cdk?&size=1a'),
+                           checkerror=False)
+        assert 'error' in res
+
     def test_gene_post(self):
         res = self.json_ok(self.post_ok(self.api + '/gene', {'ids': '1017'}))
         eq_(len(res), 1)
@@ -277,11 +302,40 @@ class MyGeneTest(BiothingTestHelperMixin):
         res = self.json_ok(self.post_ok(self.api + '/gene',{'ids': '791256'}))
         eq_(res[0]['_id'], '50846')  # this is the corresponding _id field
 
+        # mix of ids found by _id (entrezgene, Ensembl-only gene) and by
+        # search (retired, Ensembl gene with an entrezgene): order is kept
+        res = self.json_ok(self.post_ok(self.api + '/gene',
+                           {'ids': '1017,791256,ENSG00000148795,1018,1017'}))
+        eq_([x['_id'] for x in res], ['1017', '50846', '1586', '1018', '1017'])
+        eq_([x['query'] for x in res], ['1017', '791256', 'ENSG00000148795', '1018', '1017'])
+        res = self.json_ok(self.post_ok(self.api + '/gene',
+                           {'ids': '1017,12566', 'species': 'mouse'}))
+        ok_(res[0]['notfound'])
+        eq_(res[1]['_id'], '12566')
+
     def test_status(self):
         # /status
         self.get_ok(self.host + '/status')
         self.head_ok(self.host + '/status')
 
+    def test_cors_headers(self):
+        for url in [self.api + '/gene/1017', self.api + '/query?q=cdk2',
+                    self.api + '/gene/1017?msgpack=true']:
+            res, con = self.h.request(url)
+            eq_(res.status, 200)
+            eq_(res['access-control-allow-origin'], '*')
+            ok_('cache-control' in res)
+
+    def test_metrics(self):
+        self.json_ok(self.get_ok(self.api + '/query?q=cdk?'))
+        res = self.json_ok(self.get_ok(self.host + '/metrics'))
+        # metrics are per process, there may be several behind self.host
+        if 'query_get' in res:
+            ok_('total' in list(res['query_get'].values())[0])
+        ok_('es_coalescing' in res)
+        ok_(res['es_coalescing']['shared'] <= res['es_coalescing']['calls'])
+        ok_('rejected' in res['query_cost'])
+
     def test_metadata(self):
         root = self.json_ok(self.get_ok(self.host + '/metadata'))
         v3 = self.json_ok(self.get_ok(self.api + '/metadata'))
@@ -303,6 +357,15 @@ class MyGeneTest(BiothingTestHelperMixin):
         nodebug = self.json_ok(self.get_ok(self.api + '/metadata?dev=0'))
         assert not "software" in nodebug.keys()
 
+    def test_metadata_etag(self):
+        for url in [self.api + '/metadata', self.api + '/metadata/fields']:
+            res, con = self.h.request(url)
+            eq_(res.status, 200)
+            ok_('etag' in res)
+            ok_('access-control-allow-origin' in res)
+            res, con = self.h.request(url, headers={'If-None-Match': res['etag']})
+            eq_(res.status, 304)
+
     def test_query_facets(self):
         res = self.json_ok(self.get_ok(self.api +
                                        '/query?q=cdk?&facets=taxid'))
@@ -319,6 +382,11 @@ class MyGeneTest(BiothingTestHelperMixin):
         eq_([x["count"] for x in res2['facets']['taxid']['terms']
             if x["term"] == 9606][0], res2['total'])
 
+        # facets (cached or not) don't depend on the page
+        res3 = self.json_ok(self.get_ok(self.api +
+                            '/query?q=cdk?&facets=taxid&from=10&size=5'))
+        eq_(res3['facets'], res['facets'])
+
     def test_query_userfilter(self):
         res1 = self.json_ok(self.get_ok(self.api + '/query?q=cdk'))
         res2 = self.json_ok(self.get_ok(self.api +
@@ -451,6 +519,26 @@ class MyGeneTest(BiothingTestHelperMixin):
         assert 'hits' in res2
         ok_(len(res2['hits']) >= 2)
 
+    def test_fetch_all_stream(self):
+        res = self.json_ok(self.get_ok(self.api +
+                           '/query?q=cdk*&species=human&size=0'))
+        res2 = self.get_ok(self.api +
+                           '/query?q=cdk*&species=human&fetch_all=true&stream=true')
+        lines = res2.decode('utf-8').splitlines()
+        eq_(len(lines), res['total'])
+        hit = _d(lines[0])
+        ok_('_id' in hit and 'symbol' in hit)
+
+    def test_query_cursor(self):
+        url = self.api + '/query?q=cdk*&species=human&fields=entrezgene&sort=entrezgene&size=5'
+        res = self.json_ok(self.get_ok(url + '&from=5'))
+        page1 = self.json_ok(self.get_ok(url + '&cursor=true'))
+        ok_(page1['cursor'])
+        page2 = self.json_ok(self.get_ok(url + '&cursor=' + page1['cursor']))
+        eq_([h['_id'] for h in page2['hits']], [h['_id'] for h in res['hits']])
+        res = self.json_ok(self.get_ok(url + '&cursor=invalid'))
+        eq_(res['success'], False)
+
     def test_dotfield(self):
         # /query service
         # default dotfield=0
@@ -870,6 +958,485 @@ class MyGeneTest(BiothingTestHelperMixin):
 
 
 
+class TaxonomyTreeTest(object):
+    __test__ = True
+
+    # (taxid, parent) from nodes.dmp, Bacillus genus and human
+    nodes = [(1, 1), (131567, 1), (2, 131567), (1239, 2), (91061, 1239),
+             (1385, 91061), (186817, 1385), (1386, 186817), (1390, 1386),
+             (1396, 1386), (405534, 1396), (9605, 131567), (9606, 9605)]
+
+    def test_descendants(self):
+        from utils.taxonomy import TaxonomyTree
+        tree = TaxonomyTree.from_nodes(self.nodes)
+        eq_(len(tree), len(self.nodes))
+        eq_(sorted(tree.descendants(1386)), [1386, 1390, 1396, 405534])
+        eq_(tree.descendants(9606), [9606])
+        eq_(tree.descendants(12345), [])
+        eq_(sorted(tree.descendants(1)), sorted([n[0] for n in self.nodes]))
+
+    def test_save_load(self):
+        import tempfile
+        from utils.taxonomy import TaxonomyTree
+        tree = TaxonomyTree.from_nodes(self.nodes)
+        with tempfile.NamedTemporaryFile() as f:
+            tree.save(f.name)
+            loaded = TaxonomyTree.load(f.name)
+        for taxid, _ in self.nodes:
+            eq_(loaded.descendants(taxid), tree.descendants(taxid))
+
+    def test_expand_species_async(self):
+        from tornado.ioloop import IOLoop
+        from utils import taxonomy
+        saved = taxonomy._tree
+        taxonomy._tree = taxonomy.TaxonomyTree.from_nodes(self.nodes)
+        taxonomy._expand_cache.invalidate()
+        try:
+            expanded = IOLoop.current().run_sync(
+                lambda: taxonomy.expand_species_async([1386, 9606, 12345]))
+            eq_(expanded, [1386, 1390, 1396, 9606, 12345, 405534])
+            eq_(taxonomy.expand_species([9606, 1386, 12345]), expanded)
+        finally:
+            taxonomy._tree = saved
+            taxonomy._expand_cache.invalidate()
+
+
+class ResponseCacheTest(object):
+    __test__ = True
+
+    def test_shared_disk_cache(self):
+        import shutil
+        import tempfile
+        from utils.cache import DiskCache, ResponseCache, MISSING
+        path = tempfile.mkdtemp()
+        try:
+            cache = ResponseCache(DiskCache(path))
+            cache.set('k', 'v1', {'a': 1})
+            # another process (or a restart) doesn't wipe the shared cache
+            other = ResponseCache(DiskCache(path))
+            eq_(other.get('k', 'v1'), {'a': 1})
+            other.set('k2', 'v1', [1])
+            eq_(cache.get('k2', 'v1'), [1])
+            # new data version: previous entries are removed once
+            other.set('k', 'v2', {'a': 2})
+            eq_(cache.get('k', 'v2'), {'a': 2})
+            eq_(cache.get('k2', 'v2'), MISSING)
+            eq_(len(cache.backend), 2)
+        finally:
+            shutil.rmtree(path)
+
+
+class IndexVersionTest(object):
+    __test__ = True
+
+    def test_meta_update(self):
+        from utils.es import ESQuery
+        from config import ES_INDEX_NAME, ES_INDEX_NAME_TIER1
+        esq = ESQuery.__new__(ESQuery)
+        esq._doc_type = 'gene'
+        esq._index_versions = {}
+
+        def set_meta(_meta):
+            for index in (ES_INDEX_NAME, ES_INDEX_NAME_TIER1):
+                esq._set_index_version(
+                    index, {index + '_20260101': {'mappings': {'gene': {'_meta': _meta}}}})
+        set_meta({'build_version': '20260101', 'stats': {'total': 1}})
+        version = esq._get_data_version()
+        meta_version = esq._get_metadata_version()
+        ok_(version.startswith(ES_INDEX_NAME + '_20260101:20260101|'))
+        # in-place _meta update (stats after a sync): data, and indices
+        # stamped with its version, are still current
+        set_meta({'build_version': '20260101', 'stats': {'total': 2}})
+        eq_(esq._get_data_version(), version)
+        ok_(esq._get_metadata_version() != meta_version)
+
+
+class IdIndexTest(object):
+    __test__ = True
+
+    docs = [{'_id': '1017', 'entrezgene': 1017,
+             'ensembl': {'gene': 'ENSG00000123374'}},
+            {'_id': '50846', 'entrezgene': 50846, 'retired': [791256]},
+            {'_id': 'ENSG00000240253', 'ensembl': [{'gene': 'ENSG00000240253'}]},
+            {'_id': '1', 'entrezgene': 1, 'ensembl': {'gene': 'ENSG00000121410'}},
+            {'_id': '2', 'entrezgene': 2, 'ensembl': {'gene': 'ENSG00000121410'}}]
+
+    def test_get(self):
+        import tempfile
+        from utils.idindex import IdIndex
+        with tempfile.NamedTemporaryFile() as f:
+            # only ids which are not their genedoc _id are stored
+            eq_(IdIndex.build(f.name, self.docs, 'v1'), 3)
+            idx = IdIndex(f.name)
+            eq_(idx.version, 'v1')
+            eq_(idx.get('791256'), ['50846'])
+            eq_(idx.get('ENSG00000123374'), ['1017'])
+            eq_(idx.get('ENSG00000121410'), ['1', '2'])
+            eq_(idx.get('1017'), ['1017'])
+            eq_(idx.get('ENSG00000240253'), ['ENSG00000240253'])
+            ok_(idx.is_current())
+            IdIndex.build(f.name, self.docs[:1], 'v2')
+            ok_(not idx.is_current())
+            # previous mapping still readable until swapped
+            eq_(idx.get('791256'), ['50846'])
+
+    def test_mget_candidates(self):
+        import tempfile
+        from utils.es import ESQuery
+        from utils.idindex import IdIndex
+        esq = ESQuery.__new__(ESQuery)
+        # 1 is also a retired id of gene 50846
+        docs = self.docs[:1] + [{'_id': '50846', 'entrezgene': 50846, 'retired': [791256, 1]}] + \
+            self.docs[2:]
+        bids = ['1017', 1, '791256', 'ENSG00000240253']
+        with tempfile.NamedTemporaryFile() as f:
+            IdIndex.build(f.name, docs, 'v1')
+            idx = IdIndex(f.name)
+            eq_(esq._get_mget_candidates(bids, {}, idx), ['1017', 'ENSG00000240253'])
+            # no id index: entrezgene ids could be retired ids too
+            eq_(esq._get_mget_candidates(bids, {}), ['ENSG00000240253'])
+            eq_(esq._get_mget_candidates(bids, {'scopes': 'entrezgene'}), ['1017', 1, '791256'])
+            eq_(esq._get_mget_candidates(bids, {'scopes': 'entrezgene,symbol'}, idx), [])
+
+
+class IdMappingTest(object):
+    __test__ = True
+
+    def test_get(self):
+        import tempfile
+        from utils.idmapping import IdMapping
+        mapping = dict([('ENSG{:04d}'.format(i), i) for i in range(500)])
+        mapping['ENSG0007'] = [7, 1007]
+        with tempfile.NamedTemporaryFile() as f:
+            eq_(IdMapping.build(f.name, mapping.items()), 500)
+            m = IdMapping(f.name)
+            eq_(len(m), 500)
+            eq_(m.get('ENSG0001'), '1')
+            eq_(m['ENSG0007'], ['7', '1007'])
+            eq_(m.get('ENSG0499'), '499')
+            eq_(m.get('ENSG9999'), None)
+            eq_(m.get('ENSG000'), None)
+            ok_('ENSG0000' in m)
+            ok_('A' not in m)
+            eq_(dict(m.items()), dict((k, [str(x) for x in v] if isinstance(v, list) else str(v))
+                                      for k, v in mapping.items()))
+            # a set of ids, duplicates kept once
+            eq_(IdMapping.build(f.name, ['3', '1', '22', '1']), 3)
+            s = IdMapping(f.name)
+            eq_(list(s), ['1', '22', '3'])
+            ok_('22' in s and '2' not in s)
+
+    def test_open_stored(self):
+        import os
+        import shutil
+        import tempfile
+        from utils.idmapping import IdMapping
+        folder = tempfile.mkdtemp()
+        built = []
+
+        def items(version):
+            def _items():
+                built.append(version)
+                return [('ENSG1', version)]
+            return _items
+        try:
+            eq_(IdMapping.open_stored(folder, 'ensembl_gene', ['1', '2'], items('a')).get('ENSG1'), 'a')
+            # same data versions: opened as is
+            eq_(IdMapping.open_stored(folder, 'ensembl_gene', ['1', '2'], items('b')).get('ENSG1'), 'a')
+            IdMapping.open_stored(folder, 'entrez_geneid_d', ['1'], items('c'))
+            eq_(IdMapping.open_stored(folder, 'ensembl_gene', ['1', '3'], items('d')).get('ENSG1'), 'd')
+            eq_(built, ['a', 'c', 'd'])
+            eq_(sorted(os.listdir(folder)), ['ensembl_gene.1.3.idm', 'entrez_geneid_d.1.idm'])
+        finally:
+            shutil.rmtree(folder)
+
+
+class IntervalIndexTest(object):
+    __test__ = True
+
+    docs = [{'_id': '1017', 'taxid': 9606,
+             'genomic_pos': {'chr': '12', 'start': 55966769, 'end': 55972784},
+             'genomic_pos_hg19': {'chr': '12', 'start': 56360553, 'end': 56366568}},
+            {'_id': '1018', 'taxid': 9606,
+             'genomic_pos': [{'chr': '12', 'start': 55966000, 'end': 55967000},
+                             {'chr': 'X', 'start': 100, 'end': 200}]},
+            {'_id': '12566', 'taxid': 10090,
+             'genomic_pos': {'chr': '10', 'start': 127455896, 'end': 127461493}}]
+
+    def test_overlap(self):
+        import tempfile
+        from utils.intervalindex import IntervalIndex
+        with tempfile.NamedTemporaryFile() as f:
+            eq_(IntervalIndex.build(f.name, self.docs, 'v1'), 3)
+            idx = IntervalIndex(f.name)
+            eq_(idx.version, 'v1')
+            eq_(idx.overlap(9606, 'genomic_pos', '12', 55960000, 55970000),
+                ['1018', '1017'])
+            eq_(idx.overlap(9606, 'genomic_pos', '12', 55970000, 55980000),
+                ['1017'])
+            eq_(idx.overlap(9606, 'genomic_pos', 'x', 150, 150), ['1018'])
+            eq_(idx.overlap(9606, 'genomic_pos_hg19', '12', 1, 56360553), ['1017'])
+            eq_(idx.overlap(9606, 'genomic_pos', '10', 1, 200000000), [])
+            eq_(idx.overlap(10090, 'genomic_pos', '10', 127455000, 127456000),
+                ['12566'])
+
+
+class WarmupTest(object):
+    __test__ = True
+
+    def test_parse_request(self):
+        from utils.warmup import parse_request
+        eq_(parse_request('/v3/gene/1017?fields=symbol'),
+            ('gene', '1017', {'fields': 'symbol', 'species': 'all',
+                              'scopes': 'entrezgene,ensemblgene,retired'}))
+        eq_(parse_request('/query?q=cdk2&size=5&callback=f'),
+            ('query', 'cdk2', {'size': 5}))
+        eq_(parse_request('/v3/query?q=cdk2&size=x'), None)
+        eq_(parse_request('/v3/query?scroll_id=abc'), None)
+        eq_(parse_request('/v3/query?q=cdk2&fetch_all=true'), None)
+        eq_(parse_request('/v3/metadata'), None)
+
+
+class QueryClassifierTest(object):
+    __test__ = True
+
+    def test_classify_query(self):
+        from tools.bench_query_classify import QUERIES, legacy_classify, new_classify
+        from utils.es import ESQueryBuilder
+        qbdr = ESQueryBuilder()
+        # same classification as the former successive checks
+        for q in QUERIES:
+            eq_(new_classify(qbdr, q), legacy_classify(qbdr, q))
+        eq_(qbdr.classify_query('"1017"').entrezgene, 1017)
+        eq_(qbdr.classify_query('symbol:CDK?').type, 'raw_string')
+        eq_(qbdr.classify_query('hg19.chr12:57,795,963-57,815,592').interval,
+            {'chr': '12', 'gstart': '57,795,963', 'gend': '57,815,592', 'assembly': 'hg19'})
+        # builders consume the parse result
+        eq_(qbdr.generate_query('1017', qbdr.classify_query('1017')),
+            qbdr.generate_query('1017'))
+
+
+class QueryCostTest(object):
+    __test__ = True
+
+    def test_estimate(self):
+        from utils.es import ESQueryBuilder
+        from utils.querycost import estimate
+        qbdr = ESQueryBuilder(size=10)
+        cheap = estimate(qbdr.query('cdk2'))
+        ok_(cheap['total'] < 50)
+        eq_(cheap['wildcards'], 0)
+        # leading wildcards cost much more than trailing ones
+        lead = estimate(ESQueryBuilder().query('symbol:*dk2'))
+        trail = estimate(ESQueryBuilder().query('symbol:cdk*'))
+        ok_(lead['wildcards'] > trail['wildcards'] > 0)
+        eq_(estimate({'query': {'match_all': {}}, 'size': 1000, 'from': 9000})['size'], 100)
+        eq_(estimate({'query': {'terms': {'taxid': list(range(1000))}}})['terms'], 10)
+        eq_(estimate(ESQueryBuilder(species=[9606]).query('chr1:1000-2000'))['nested'], 10)
+
+    def test_check(self):
+        from biothings.www.api.es import QueryError
+        from utils import querycost
+        body = {'query': {'query_string': {'query': ' OR '.join(['*a'] * 10)}}}
+        try:
+            querycost.check(body)
+            ok_(False, 'expensive query not rejected')
+        except QueryError:
+            pass
+        body = {'query': {'query_string': {'query': 'symbol:*a OR symbol:*b'}}}
+        querycost.check(body)
+        eq_(body['timeout'], querycost.QUERY_COST_SOFT_TIMEOUT)
+        body = {'query': {'match_all': {}}}
+        querycost.check(body)
+        ok_('timeout' not in body)
+
+
+class MergeDocsTest(object):
+    __test__ = True
+
+    def test_merge_docs(self):
+        from databuild.backend import GeneDocMemeoryBackend
+        from databuild.builder import merge_docs
+        target = GeneDocMemeoryBackend()
+        target.insert([{'_id': '1', 'taxid': 9606}, {'_id': '2', 'taxid': 9606},
+                       {'_id': 'ENSG1', 'taxid': 9606}])
+        src = [{'_id': 'ENSG1', 'taxid': 9606, 'a': 1}, {'_id': 'ENSG2', 'a': 2},
+               {'_id': 'ENSG3', 'a': 3}, {'_id': 'X', 'a': 4}]
+        idmapping_d = {'ENSG2': ['1', '2'], 'ENSG3': '3'}
+        stats = merge_docs(src, target, set(['1', '2', 'ENSG1']), idmapping_d, bulk_size=2)
+        eq_(stats, {'docs': 4, 'updated': 3, 'errors': 0})
+        eq_(target.get_from_id('1'), {'_id': '1', 'taxid': 9606, 'a': 2})
+        eq_(target.get_from_id('2'), {'_id': '2', 'taxid': 9606, 'a': 2})
+        eq_(target.get_from_id('ENSG1'), {'_id': 'ENSG1', 'taxid': 9606, 'a': 1})
+
+    def test_combine_updates(self):
+        from databuild.backend import combine_updates
+        doc = {'a': 1, 'b': 1}
+        # doc shared by ids 1 and 2 (multi-mapped source id), then other
+        # docs mapped to id 1
+        updates = [('1', doc), ('2', doc), ('1', {'a': 2, 'c': {'x': 1}}),
+                   ('1', {'c': {'y': 2}})]
+        eq_(combine_updates(updates), [('1', {'a': 2, 'b': 1, 'c': {'y': 2}}, 3),
+                                       ('2', {'a': 1, 'b': 1}, 1)])
+        eq_(doc, {'a': 1, 'b': 1})
+
+
+class PoolMergeTest(object):
+    __test__ = True
+
+    class Collection(object):
+        '''_ids of a source, sorted and compared as MongoDB does (numbers
+           before strings, range bounds only match their own type).
+        '''
+        def __init__(self, ids):
+            self.ids = sorted(ids, key=lambda x: (isinstance(x, str), x))
+
+        def find(self, *args):
+            return self
+
+        def sort(self, *args):
+            return self
+
+        def batch_size(self, size):
+            return iter([{'_id': _id} for _id in self.ids])
+
+        def match(self, id_filter):
+            cond = id_filter['_id']
+            bound = cond['$gte']
+            return [_id for _id in self.ids
+                    if isinstance(_id, str) == isinstance(bound, str) and _id >= bound and
+                    ('$lt' not in cond or _id < cond['$lt'])]
+
+    def test_id_ranges(self):
+        from databuild.builder import id_ranges
+        src = self.Collection(list(range(1050)) + ['X{:03d}'.format(i) for i in range(30)])
+        for size in [1, 7, 500, 1050, 5000]:
+            filters = id_ranges(src, size)
+            ranges = [[_id for id_filter in id_filters for _id in src.match(id_filter)]
+                      for id_filters in filters]
+            # each doc in one range, ranges of at most size docs
+            eq_(sorted(sum(ranges, []), key=str), sorted(src.ids, key=str))
+            ok_(max(len(r) for r in ranges) <= size)
+        eq_(id_ranges(src, 500), [[{'_id': {'$gte': 0, '$lt': 500}}],
+                                  [{'_id': {'$gte': 500, '$lt': 1000}}],
+                                  [{'_id': {'$gte': 1000}}],
+                                  [{'_id': {'$gte': 'X000'}}]])
+        eq_(id_ranges(self.Collection([]), 10), [])
+
+    def test_merge_range_stats(self):
+        from databuild.builder import merge_range_stats
+        results = [('src', {'docs': 10, 'updated': 8, 'errors': 1}),
+                   ('src', {'docs': 5, 'updated': 5, 'errors': 0})]
+        eq_(merge_range_stats(results, 15), ({'docs': 15, 'updated': 13, 'errors': 1}, []))
+        stats, errors = merge_range_stats(results + [('src', 'AutoReconnect: x')], 20)
+        eq_(stats, {'docs': 15, 'updated': 13, 'errors': 1})
+        eq_(errors, ['range merge failed: AutoReconnect: x', '15 docs merged, 20 in source'])
+
+    class Source(object):
+        '''docs of a source in natural order, _id lookups ($in) return
+           them in _id order (_id index).
+        '''
+        def __init__(self, docs):
+            self.docs = docs
+
+        def find(self, query=None, projection=None):
+            import copy
+            docs = self.docs
+            if query:
+                docs = sorted([doc for doc in docs if doc['_id'] in query['_id']['$in']],
+                              key=lambda doc: doc['_id'])
+            return PoolMergeTest.Cursor(copy.deepcopy(docs))
+
+    class Cursor(list):
+        def batch_size(self, size):
+            return iter(self)
+
+    def test_shared_targets(self):
+        import copy
+        from databuild.backend import GeneDocMemeoryBackend
+        from databuild.builder import merge_docs, shared_target_ids, find_in_order
+        roots = [{'_id': '1'}, {'_id': '2'}, {'_id': '3'}, {'_id': 'ENSG1'}]
+        geneid_set = set(doc['_id'] for doc in roots)
+        idmapping_d = {'ENSG2': '1', 'ENSG3': ['1', '2'], 'ENSG4': '3', 'ENSG5': '1'}
+        src = self.Source([{'_id': 'ENSG{}'.format(i), 'x': i} for i in [5, 1, 4, 3, 2]])
+        shared = shared_target_ids(src, geneid_set, idmapping_d)
+        eq_(shared, ['ENSG5', 'ENSG3', 'ENSG2'])
+
+        sequential = GeneDocMemeoryBackend()
+        sequential.insert(copy.deepcopy(roots))
+        merge_docs(src.find(), sequential, geneid_set, idmapping_d)
+        # one range per doc, ranges merged in the worst order, then
+        # docs with shared target ids in source order
+        pool = GeneDocMemeoryBackend()
+        pool.insert(copy.deepcopy(roots))
+        for doc in reversed(src.find()):
+            if doc['_id'] not in shared:
+                merge_docs([doc], pool, geneid_set, idmapping_d)
+        merge_docs(find_in_order(src, shared, 2), pool, geneid_set, idmapping_d)
+        for doc in roots:
+            eq_(pool.get_from_id(doc['_id']), sequential.get_from_id(doc['_id']))
+        eq_(pool.get_from_id('1')['x'], 2)
+        eq_(shared_target_ids(src, geneid_set, {'ENSG2': '1', 'ENSG3': '2'}), [])
+
+
+class SortMergeTest(object):
+    __test__ = True
+
+    roots = [{'_id': str(i), 'taxid': 9606, 'symbol': 'G{}'.format(i)} for i in range(30)] + \
+            [{'_id': 'ENSG{}'.format(i), 'taxid': 9606} for i in range(5)]
+    sources = [
+        # (source docs, idmapping_d)
+        ([{'_id': i, 'taxid': 9606, 'go': [i]} for i in range(35, -5, -1)], None),
+        ([{'_id': 'ENSG{}'.format(i), 'ensembl': i, 'go': 'x'} for i in range(10)],
+         {'ENSG6': ['1', '2'], 'ENSG7': '3', 'ENSG8': ['1', '99']}),
+        ([{'_id': str(i % 7), 'reporter': [i]} for i in range(20)], None),
+    ]
+
+    def test_same_as_sequential(self):
+        import copy
+        from databuild.backend import GeneDocMemeoryBackend
+        from databuild.builder import merge_docs
+        from databuild import sortmerge
+        geneid_set = set(doc['_id'] for doc in self.roots)
+        target = GeneDocMemeoryBackend()
+        target.insert(copy.deepcopy(self.roots))
+        for docs, idmapping_d in copy.deepcopy(self.sources):
+            merge_docs(docs, target, geneid_set, idmapping_d, bulk_size=4)
+
+        roots = sortmerge.ExternalSort(chunk_size=7)
+        roots.insert(copy.deepcopy(self.roots))
+        updates = [sortmerge.sorted_updates(docs, i, geneid_set, idmapping_d, chunk_size=7)
+                   for i, (docs, idmapping_d) in enumerate(copy.deepcopy(self.sources), 1)]
+        stats = {}
+        merged = list(sortmerge.merge_sorted(roots, *updates, stats=stats))
+        eq_([doc['_id'] for doc in merged], sorted(geneid_set))
+        eq_(merged, [target.get_from_id(doc['_id']) for doc in merged])
+        eq_(stats, {1: 30, 2: 9, 3: 20})
+
+
+class IncrementalMergeTest(object):
+    __test__ = True
+
+    sources = ['entrez_gene', 'entrez_genomic_pos', 'ensembl_genomic_pos',
+               'ensembl_acc', 'exons', 'pharmgkb']
+    src_fields = {'entrez_gene': ['entrezgene', 'symbol'],
+                  'entrez_genomic_pos': ['genomic_pos'],
+                  'ensembl_genomic_pos': ['genomic_pos', 'exons_hg19'],
+                  'ensembl_acc': ['ensembl'],
+                  'exons': ['exons', 'exons_hg19'],
+                  'pharmgkb': ['pharmgkb']}
+
+    def test_sources_to_remerge(self):
+        from databuild.builder import sources_to_remerge
+        eq_(sources_to_remerge(self.sources, [], self.src_fields), ([], []))
+        eq_(sources_to_remerge(self.sources, ['pharmgkb'], self.src_fields),
+            (['pharmgkb'], ['pharmgkb']))
+        # sources sharing fields, directly or not, are merged again in order
+        eq_(sources_to_remerge(self.sources, ['exons', 'ensembl_acc'], self.src_fields),
+            (['entrez_genomic_pos', 'ensembl_genomic_pos', 'ensembl_acc', 'exons'],
+             ['ensembl', 'exons', 'exons_hg19', 'genomic_pos']))
+
+
 # Self contained test class, used for CI tools such as Travis
 # This will start a Tornado server on its own and perform tests
 # against this server.
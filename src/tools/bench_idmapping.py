@@ -0,0 +1,72 @@
+'''
+Benchmark of id mappings used by the data builder: dict (as loaded from
+GridFS, ensembl gene -> entrez gene ids) vs utils.idmapping.IdMapping
+file, memory used and lookup rate.
+
+Run from "src" folder:
+
+    python -m tools.bench_idmapping [number of ids] [number of lookups]
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+from utils.idmapping import IdMapping
+
+
+def make_mapping(n):
+    random.seed(42)
+    mapping = {}
+    for i in range(n):
+        # ~5% of ensembl genes map to several entrez genes
+        if random.random() < 0.05:
+            mapping['ENSG{:011d}'.format(i)] = [random.randrange(1, 10 ** 8) for _ in range(2)]
+        else:
+            mapping['ENSG{:011d}'.format(i)] = random.randrange(1, 10 ** 8)
+    return mapping
+
+
+def lookup_rate(mapping, keys):
+    t0 = time.time()
+    for key in keys:
+        mapping.get(key, None)
+    return len(keys) / (time.time() - t0)
+
+
+def run(n=1000000, lookups=200000):
+    tracemalloc.start()
+    mapping = make_mapping(n)
+    dict_mb = tracemalloc.get_traced_memory()[0] / 1024. ** 2
+    tracemalloc.stop()
+
+    path = os.path.join(tempfile.gettempdir(), 'bench_idmapping_{}'.format(os.getpid()))
+    try:
+        t0 = time.time()
+        IdMapping.build(path, mapping.items())
+        t_build = time.time() - t0
+        file_mb = os.path.getsize(path) / 1024. ** 2
+        idmapping = IdMapping(path)
+    finally:
+        os.remove(path)
+
+    keys = random.sample(list(mapping), lookups) + ['ENSG_missing{}'.format(i) for i in range(lookups // 10)]
+    for key in keys[:10000]:
+        value = mapping.get(key, None)
+        if isinstance(value, list):
+            value = [str(x) for x in value]
+        elif value is not None:
+            value = str(value)
+        assert idmapping.get(key) == value, key
+
+    print("{} ids  dict: {:.0f}MB in memory  IdMapping: {:.0f}MB file, mapped "
+          "(built in {:.1f}s)".format(n, dict_mb, file_mb, t_build))
+    print("lookups/s  dict: {:.0f}  IdMapping: {:.0f}".format(
+        lookup_rate(mapping, keys), lookup_rate(idmapping, keys)))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:3]])
@@ -0,0 +1,80 @@
+'''
+Benchmark for genomic interval queries, resolved by the local interval
+index (see utils/intervalindex.py) vs ES nested query.
+
+Run from "src" folder:
+
+    python -m tools.bench_interval [number]
+    python -m tools.bench_interval [number] <interval index file>
+
+Without an index file, lookups are timed on a synthetic human-like
+index. With one (matching ES data), each interval query is also run
+against ES, with the nested query and with the ids query built from the
+index.
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import tempfile
+import timeit
+
+from utils.intervalindex import IntervalIndex
+
+INTERVALS = [('1', 1000, 100000), ('1', 1000000, 2000000),
+             ('X', 10000000, 10500000), ('17', 7661779, 7687550),
+             ('7', 55019017, 55211628), ('2', 100000000, 101000000)]
+CHRS = [str(i) for i in range(1, 23)] + ['x', 'y', 'mt']
+
+
+def synthetic_genes(n=60000):
+    random.seed(42)
+    for i in range(n):
+        start = random.randint(1, 240000000)
+        yield {'_id': str(i), 'taxid': 9606,
+               'genomic_pos': {'chr': random.choice(CHRS), 'start': start,
+                               'end': start + int(random.expovariate(1 / 30000.))}}
+
+
+def bench_local(index, number):
+    t = timeit.timeit(lambda: [index.overlap(9606, 'genomic_pos', *iv) for iv in INTERVALS],
+                      number=number)
+    print("local index: {:7.2f}us/query".format(t / (number * len(INTERVALS)) * 1e6))
+
+
+def bench_es(index, number):
+    from utils.es import ESQuery
+    esq = ESQuery()
+    for with_index in (False, True):
+        esq._get_interval_index = (lambda: index) if with_index else (lambda: None)
+        t0 = time.time()
+        totals = []
+        for _ in range(number):
+            for chr, start, end in INTERVALS:
+                res = esq.query("chr{}:{}-{}".format(chr, start, end),
+                                species='human', fields='_id', size=1000)
+                totals.append(res['total'])
+        print("ES {:<14} {:7.2f}ms/query  (hits: {})".format(
+            "ids query:" if with_index else "nested query:",
+            (time.time() - t0) / (number * len(INTERVALS)) * 1e3,
+            totals[:len(INTERVALS)]))
+
+
+def run(number=1000, path=None):
+    if path:
+        index = IntervalIndex(path)
+        bench_local(index, number)
+        # response cache would hide ES time
+        from utils.es import ESQuery
+        ESQuery._response_cache = None
+        bench_es(index, max(1, number // 100))
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'intervals.idx')
+        IntervalIndex.build(path, synthetic_genes(), 'synthetic')
+        bench_local(IntervalIndex(path), number)
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:2]] + sys.argv[2:3])
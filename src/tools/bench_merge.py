@@ -0,0 +1,77 @@
+'''
+Benchmark of merging a source collection into target genedocs, against a
+local mongod: former one unacknowledged update per source doc vs
+databuild.builder.merge_docs bulk updates.
+
+Run from "src" folder (a "bench_merge" database is created, then dropped):
+
+    python -m tools.bench_merge [number of docs] [bulk size] [mongodb host]
+'''
+from __future__ import print_function
+import sys
+import time
+
+from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+
+from databuild.backend import GeneDocMongoDBBackend
+from databuild.builder import merge_docs
+
+DB_NAME = 'bench_merge'
+
+
+def make_docs(n):
+    roots = [{'_id': str(i), 'entrezgene': i, 'taxid': 9606} for i in range(n)]
+    # like reporter: a source doc per gene, plus docs of unknown genes
+    src = [{'_id': i if i < n else 'X{}'.format(i), 'taxid': 9606,
+            'reporter': {'HG-U133_Plus_2': ['{}_at'.format(i), '{}_s_at'.format(i)]}}
+           for i in range(n + n // 10)]
+    return roots, src
+
+
+def legacy_merge(docs, target_collection, geneid_set):
+    target_collection = target_collection.with_options(write_concern=WriteConcern(w=0))
+    for doc in docs:
+        __id = str(doc['_id'])
+        if __id in geneid_set:
+            doc.pop('_id', None)
+            doc.pop('taxid', None)
+            target_collection.update_one({'_id': __id}, {'$set': doc})
+
+
+def timed_merge(merge, client, roots, src):
+    db = client[DB_NAME]
+    db.target.drop()
+    db.target.insert_many([dict(doc) for doc in roots])
+    geneid_set = set(doc['_id'] for doc in roots)
+    t0 = time.time()
+    merge(db.src.find(), db.target, geneid_set)
+    # single connection: an acknowledged read waits for previous writes
+    docs = list(db.target.find().sort('_id'))
+    return time.time() - t0, docs
+
+
+def run(n=100000, bulk_size=1000, host='localhost:27017'):
+    client = MongoClient(host, maxPoolSize=1)
+    roots, src = make_docs(n)
+    client[DB_NAME].src.drop()
+    client[DB_NAME].src.insert_many(src)
+    try:
+        t_legacy, docs_legacy = timed_merge(legacy_merge, client, roots, src)
+        t_bulk, docs_bulk = timed_merge(
+            lambda docs, target_collection, geneid_set: merge_docs(
+                docs, GeneDocMongoDBBackend(target_collection), geneid_set,
+                bulk_size=bulk_size),
+            client, roots, src)
+    finally:
+        client.drop_database(DB_NAME)
+    assert docs_legacy == docs_bulk
+    n_src = float(len(src))
+    print("{} source docs  legacy: {:.1f}s ({:.0f} docs/s)  bulk ({}): {:.1f}s "
+          "({:.0f} docs/s)  x{:.1f}".format(len(src), t_legacy, n_src / t_legacy,
+                                            bulk_size, t_bulk, n_src / t_bulk,
+                                            t_legacy / t_bulk))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:3]] + sys.argv[3:4])
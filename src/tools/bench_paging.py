@@ -0,0 +1,76 @@
+'''
+Benchmark of deep paging through /query results: from/size paging vs
+cursor paging (sort values of last hit, see ESQuery._build_cursor_query).
+
+Run from "src" folder, against ES configured in config.py:
+
+    python -m tools.bench_paging [number] [query]
+
+A cursor is first taken at each offset by walking the results with
+cursor pages, then a page of PAGE_SIZE hits at that offset is timed
+"number" times with both methods. from/size paging fails beyond the
+index max_result_window (10,000 by default).
+'''
+from __future__ import print_function
+import sys
+import time
+
+from utils.es import ESQuery
+
+OFFSETS = [0, 1000, 10000, 50000, 100000]
+PAGE_SIZE = 100
+WALK_SIZE = 1000
+
+
+def get_cursors(esq, q, offsets):
+    '''return {offset: cursor} for offsets within query results.'''
+    cursors = {}
+    cursor, pos = 'true', 0
+    for offset in sorted(offsets):
+        while pos + WALK_SIZE <= offset and cursor:
+            res = esq.query(q, species='all', fields='entrezgene', size=WALK_SIZE,
+                            sort='entrezgene', cursor=cursor)
+            cursor, pos = res['cursor'], pos + WALK_SIZE
+        if not cursor or pos != offset:
+            # offset not a multiple of WALK_SIZE, or past results
+            break
+        cursors[offset] = cursor
+    return cursors
+
+
+def timed(func, number):
+    t0 = time.time()
+    for _ in range(number):
+        res = func()
+    return (time.time() - t0) / number * 1e3, res
+
+
+def run(number=10, q='__all__'):
+    esq = ESQuery()
+    # response cache would hide ES time
+    ESQuery._response_cache = None
+    cursors = get_cursors(esq, q, OFFSETS)
+    print("{:>8} {:>14} {:>14}".format("offset", "from/size", "cursor"))
+    for offset in OFFSETS:
+        if offset not in cursors:
+            print("{:>8} {:>14} {:>14}".format(offset, "-", "past results"))
+            continue
+        t_from, res_from = timed(lambda: esq.query(q, species='all', fields='entrezgene',
+                                                   size=PAGE_SIZE, sort='entrezgene',
+                                                   **{'from': offset}), number)
+        t_cursor, res_cursor = timed(lambda: esq.query(q, species='all', fields='entrezgene',
+                                                       size=PAGE_SIZE, sort='entrezgene',
+                                                       cursor=cursors[offset]), number)
+        if res_from.get('success') is False:
+            from_col = "error"
+        else:
+            from_col = "{:.1f}ms".format(t_from)
+            # same hits with both methods (entrezgene being unique, _uid
+            # tiebreaker only matters for genes without one)
+            ids = [h['_id'] for h in res_from['hits'] if 'entrezgene' in h]
+            assert ids == [h['_id'] for h in res_cursor['hits'] if 'entrezgene' in h]
+        print("{:>8} {:>14} {:>12.1f}ms".format(offset, from_col, t_cursor))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:2]] + sys.argv[2:3])
@@ -0,0 +1,62 @@
+'''
+Microbenchmark for ESQueryBuilder query shapes: compares the former
+"json.dumps/%-substitution/json.loads" building to the compiled templates.
+
+Run from "src" folder:
+
+    python -m tools.bench_query_build [number]
+'''
+from __future__ import print_function
+import sys
+import json
+import timeit
+
+from utils.es import (ESQueryBuilder, translate_datasource,
+                      _DIS_MAX_QUERY, _WILDCARD_QUERY)
+
+QUERIES = ['cdk2', 'cyclin-dependent kinase 2', 'NM_001798', 'IPR008351',
+           'hsa-mir-503', 'insulin receptor', 'tp53', 'GO:0004693']
+WILDCARD_QUERIES = ['cdk?', 'cdk*', 'insulin*', 'tp5?']
+
+
+def legacy_dis_max_query(q):
+    # refseq/accession fields were translated on every call
+    translate_datasource("refseq", trim_from=":", unescape=True)
+    translate_datasource("accession", trim_from=":", unescape=True)
+    q = q.replace('"', '').replace('\\', '')
+    _query = json.dumps(_DIS_MAX_SHAPE)
+    return json.loads(_query % {'q': q})
+
+
+def legacy_wildcard_query(q):
+    _query = json.dumps(_WILDCARD_SHAPE)
+    return json.loads(_query % {'q': q.lower()})
+
+
+# same shapes as the templates, with the former "%(q)s" placeholders
+_DIS_MAX_SHAPE = _DIS_MAX_QUERY(q="%(q)s")
+_WILDCARD_SHAPE = _WILDCARD_QUERY(q="%(q)s")
+
+
+def run(number=20000):
+    qbdr = ESQueryBuilder()
+    # sanity check: both ways must build the same queries
+    for q in QUERIES:
+        assert legacy_dis_max_query(q) == qbdr.dis_max_query(q), q
+    for q in WILDCARD_QUERIES:
+        assert legacy_wildcard_query(q) == qbdr.wildcard_query(q), q
+
+    cases = [
+        ("dis_max", legacy_dis_max_query, qbdr.dis_max_query, QUERIES),
+        ("wildcard", legacy_wildcard_query, qbdr.wildcard_query, WILDCARD_QUERIES),
+    ]
+    for name, before, after, queries in cases:
+        t_before = timeit.timeit(lambda: [before(q) for q in queries], number=number)
+        t_after = timeit.timeit(lambda: [after(q) for q in queries], number=number)
+        n = float(number * len(queries))
+        print("{:<10} before: {:7.2f}us/query  after: {:7.2f}us/query  x{:.1f}".format(
+              name, t_before / n * 1e6, t_after / n * 1e6, t_before / t_after))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,71 @@
+'''
+Benchmark of /query string classification (see
+ESQueryBuilder.classify_query): the former successive checks (uncompiled
+interval pattern, "__all__", raw_string, wildcard, then is_int on the
+dis_max input) vs the single classify_query pass.
+
+Run from "src" folder:
+
+    python -m tools.bench_query_classify [number] [corpus file]
+
+The corpus file is a warm-up corpus (request paths, see utils/warmup.py),
+its /query "q" values are classified. QUERIES are used without one.
+'''
+from __future__ import print_function
+import re
+import sys
+import timeit
+
+from biothings.utils.common import is_int
+
+from utils.es import ESQueryBuilder
+from utils.warmup import load_corpus
+
+QUERIES = ['cdk2', 'cyclin-dependent kinase 2', 'NM_001798', 'IPR008351',
+           'hsa-mir-503', 'insulin receptor', 'tp53', 'GO:0004693',
+           '1017', '"1017"', '1017\\', 'cdk?', 'insulin*', 'symbol:cdk2',
+           'symbol:CDK?', 'cdk2 AND taxid:9606', 'chr1:151073054-151383976',
+           'hg19.chr12:57,795,963-57,815,592', 'mm9.chrX:1000-2000', '__all__']
+
+
+def legacy_classify(qbdr, q):
+    '''former query type, and entrezgene for integer dis_max input.'''
+    pattern = r'chr(?P<chr>\w+):(?P<gstart>[0-9,]+)-(?P<gend>[0-9,]+)'
+    if re.search(pattern, q):
+        return 'interval', qbdr._parse_interval_query(q)
+    if q == '__all__':
+        return 'match_all', None
+    if qbdr._is_raw_string_query(q):
+        return 'raw_string', None
+    if q.find('*') != -1 or q.find('?') != -1:
+        return 'wildcard', None
+    q = q.replace('"', '').replace('\\', '')
+    if is_int(q):
+        return 'id', int(q)
+    return 'dis_max', None
+
+
+def new_classify(qbdr, q):
+    parsed = qbdr.classify_query(q)
+    if parsed.type == 'interval':
+        return parsed.type, parsed.interval
+    return parsed.type, parsed.entrezgene
+
+
+def run(number=20000, corpus=None):
+    qbdr = ESQueryBuilder()
+    if corpus:
+        queries = [arg for endpoint, arg, _ in load_corpus(corpus) if endpoint == 'query']
+    else:
+        queries = QUERIES
+    for q in queries:
+        assert legacy_classify(qbdr, q) == new_classify(qbdr, q), q
+    t_legacy = timeit.timeit(lambda: [legacy_classify(qbdr, q) for q in queries], number=number)
+    t_new = timeit.timeit(lambda: [new_classify(qbdr, q) for q in queries], number=number)
+    n = float(number * len(queries))
+    print("{} queries  legacy: {:6.2f}us/query  new: {:6.2f}us/query  x{:.1f}".format(
+          len(queries), t_legacy / n * 1e6, t_new / n * 1e6, t_legacy / t_new))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:2]] + sys.argv[2:3])
@@ -0,0 +1,94 @@
+'''
+Benchmark of API responses serialization (see utils/serializer.py) on a
+1,000-hit ES response: json module decoding/encoding (indent=2) as
+biothings return_json does, vs utils.serializer, for cleaned, raw and
+msgpack responses.
+
+Run from "src" folder:
+
+    python -m tools.bench_serialize [number]
+'''
+from __future__ import print_function
+import sys
+import json
+import random
+import timeit
+
+from utils import serializer
+
+
+def es_response(n=1000):
+    random.seed(42)
+    hits = []
+    for i in range(n):
+        hits.append({'_index': 'genedoc_mygene_current', '_type': 'gene',
+                     '_id': str(i), '_score': random.random(),
+                     '_source': {'entrezgene': i, 'symbol': 'GENE{}'.format(i),
+                                 'name': 'gene {} protein'.format(i), 'taxid': 9606,
+                                 'refseq': {'rna': ['NM_{:06d}.{}'.format(i, j) for j in range(3)]},
+                                 'go': {'BP': [{'id': 'GO:{:07d}'.format(i + j),
+                                                'term': 'process {}'.format(j),
+                                                'evidence': 'IEA'} for j in range(5)]}}})
+    return json.dumps({'took': 12, 'timed_out': False,
+                       'hits': {'total': n, 'max_score': 1., 'hits': hits}}).encode('utf-8')
+
+
+def clean(res):
+    '''_cleaned_res equivalent: _source with _id and _score.'''
+    hits = []
+    for hit in res['hits']['hits']:
+        doc = hit['_source']
+        doc['_id'] = hit['_id']
+        doc['_score'] = hit['_score']
+        hits.append(doc)
+    return {'total': res['hits']['total'], 'max_score': res['hits']['max_score'],
+            'took': res['took'], 'hits': hits}
+
+
+def legacy_cleaned(body):
+    return json.dumps(clean(json.loads(body.decode('utf-8'))), indent=2).encode('utf-8')
+
+
+def legacy_raw(body):
+    return json.dumps(json.loads(body.decode('utf-8')), indent=2).encode('utf-8')
+
+
+def legacy_msgpack(body):
+    data = clean(json.loads(body.decode('utf-8')))
+    # biothings encodes json before checking for msgpack
+    json.dumps(data, indent=2)
+    return serializer.msgpack.packb(data, use_bin_type=True)
+
+
+def new_cleaned(body):
+    return serializer.json_dumps(clean(serializer.json_loads(body)))
+
+
+def new_raw(body):
+    return serializer.json_dumps(serializer.RawJSON(body))
+
+
+def new_msgpack(body):
+    return serializer.msgpack_dumps(clean(serializer.json_loads(body)))
+
+
+def run(number=100):
+    body = es_response()
+    print("1,000 hits, {:.1f}kB ES response, orjson: {}, msgpack: {}".format(
+        len(body) / 1024., serializer.orjson is not None,
+        serializer.msgpack is not None))
+    cases = [('cleaned', legacy_cleaned, new_cleaned, json.loads),
+             ('raw', legacy_raw, new_raw, json.loads)]
+    if serializer.msgpack is not None:
+        cases.append(('msgpack', legacy_msgpack, new_msgpack,
+                      lambda b: serializer.msgpack.unpackb(b, raw=False)))
+    for name, legacy, new, decode in cases:
+        assert decode(legacy(body)) == decode(new(body))
+        t_legacy = timeit.timeit(lambda: legacy(body), number=number) / number
+        t_new = timeit.timeit(lambda: new(body), number=number) / number
+        print("{:<8} legacy: {:7.2f}ms  new: {:7.2f}ms  ({:.1f}x)".format(
+            name, t_legacy * 1e3, t_new * 1e3, t_legacy / t_new))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,65 @@
+'''
+Microbenchmark for SOURCE_TRANSLATORS translation: compares the former
+"one re.sub per translator" loop to the single-pass SourceTranslator.
+
+Run from "src" folder:
+
+    python -m tools.bench_translate [number]
+'''
+from __future__ import print_function
+import re
+import sys
+import timeit
+
+from config import SOURCE_TRANSLATORS
+from utils.es import translate_datasource
+
+# query strings as sent by users (see tests/tests.py)
+QUERIES = ['cdk2', 'CDK2', 'insulin receptor', 'cyclin-dependent kinase 2',
+           'refseq:NM_001798', 'accession:AA810989', 'reporter:1000_at',
+           'interpro:IPR008351', 'GO:0000307', 'homologene:74409',
+           'reagent:GNF282', 'uniprot:P24941', 'ensemblgene:ENSG00000123374',
+           'ensembltranscript:ENST00000266970', 'hgnc:1771', 'MIM:116953',
+           'mgi:MGI\\:88339', 'rgd:620503', 'flybase:FBgn0004107',
+           'wormbase:WBGene00000407', 'zfin:ZDB-GENE-980526-406',
+           'symbol:cdk2 AND taxid:9606', 'name:"cyclin-dependent kinase"',
+           'chr1:1000-100000', 'cdk?', 'tp53*', 'ENSG00000123374',
+           'NM_001798', 'hsa-mir-503', '1017']
+# scopes, translated as field names
+SCOPES = ['entrezgene', 'ensembl.gene', 'ensemblgene', 'refseq', 'accession',
+          'reporter', 'symbol', 'uniprot', 'go', 'retired', 'HGNC', 'MGI']
+
+
+def legacy_translate_datasource(q, trim_from="", unescape=False):
+    for src in SOURCE_TRANSLATORS.keys():
+        regex = SOURCE_TRANSLATORS[src]
+        if trim_from:
+            regex = re.sub(trim_from + ".*", "", regex)
+            src = re.sub(trim_from + ".*", "", src)
+        if unescape:
+            regex = regex.replace("\\", "")
+            src = src.replace("\\", "")
+        q = re.sub(src, regex, q, flags=re.I)
+    return q
+
+
+def run(number=20000):
+    variants = [("query", QUERIES, {}),
+                ("scopes", SCOPES, {"trim_from": ":", "unescape": True})]
+    # sanity check: both ways must translate the same way
+    for _, corpus, kwargs in variants:
+        for q in corpus:
+            assert legacy_translate_datasource(q, **kwargs) == \
+                translate_datasource(q, **kwargs), q
+    for name, corpus, kwargs in variants:
+        t_before = timeit.timeit(lambda: [legacy_translate_datasource(q, **kwargs)
+                                          for q in corpus], number=number)
+        t_after = timeit.timeit(lambda: [translate_datasource(q, **kwargs)
+                                         for q in corpus], number=number)
+        n = float(number * len(corpus))
+        print("{:<8} before: {:7.2f}us/string  after: {:7.2f}us/string  x{:.1f}".format(
+              name, t_before / n * 1e6, t_after / n * 1e6, t_before / t_after))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,217 @@
+'''
+Caches shared by API handlers and query helpers.
+'''
+import os
+import time
+import json
+import hashlib
+from collections import OrderedDict
+
+from . import serializer
+
+# returned by caches on a miss when None is a legit cached value
+MISSING = object()
+
+
+class LRUCache(object):
+    '''A bounded key/value cache. When full, the least recently used entry
+       is evicted. If "ttl" (in seconds) is set, entries older than that are
+       considered missing. Hits and misses are counted for monitoring.
+    '''
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()    # key -> (timestamp, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, MISSING)
+        if entry is not MISSING:
+            if self.ttl is None or time.time() - entry[0] < self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            # expired
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        self._data[key] = (time.time(), value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        '''remove given key from the cache, or all entries if key is None.'''
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        '''(key, value) pairs, least recently used first, expired included.'''
+        return [(key, entry[1]) for key, entry in self._data.items()]
+
+    def stats(self):
+        return {"size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+class DiskCache(object):
+    '''Same interface as LRUCache, string values are stored as files in
+       "path" folder, so they survive restarts and can be shared by several
+       processes. When the folder grows over "maxsize" bytes, least recently
+       used files are removed.
+    '''
+
+    def __init__(self, path, maxsize=1024**3, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self._size = self._disk_usage()
+        self.hits = 0
+        self.misses = 0
+
+    def _key_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _files(self):
+        for fn in os.listdir(self.path):
+            if not fn.endswith('.tmp'):
+                yield os.path.join(self.path, fn)
+
+    def _disk_usage(self):
+        return sum([os.path.getsize(f) for f in self._files()])
+
+    def get(self, key, default=None):
+        fpath = self._key_path(key)
+        try:
+            with open(fpath, 'rb') as f:
+                value = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+            if self.ttl is None or time.time() - mtime < self.ttl:
+                os.utime(fpath, None)     # mark as recently used
+                self.hits += 1
+                return value.decode('utf-8')
+            os.remove(fpath)
+        except (IOError, OSError):
+            # missing, or removed by another process meanwhile
+            pass
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        fpath = self._key_path(key)
+        value = value.encode('utf-8')
+        # write then rename, so other processes never read partial files
+        tmpfile = "{}.{}.tmp".format(fpath, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(value)
+        os.rename(tmpfile, fpath)
+        self._size += len(value)
+        if self._size > self.maxsize:
+            self._evict()
+
+    def _evict(self):
+        '''remove least recently used files until 90% of maxsize is reached'''
+        files = []
+        for f in self._files():
+            try:
+                st = os.stat(f)
+                files.append((st.st_mtime, st.st_size, f))
+            except OSError:
+                pass
+        files.sort()
+        self._size = sum([x[1] for x in files])
+        for _, size, f in files:
+            if self._size <= self.maxsize * 0.9:
+                break
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+            self._size -= size
+
+    def invalidate(self, key=None):
+        '''remove given key from the cache, or all entries if key is None.'''
+        files = self._files() if key is None else [self._key_path(key)]
+        for f in files:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        self._size = self._disk_usage()
+
+    def __len__(self):
+        return len(list(self._files()))
+
+    def stats(self):
+        return {"size": self._size,
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+class ResponseCache(object):
+    '''Cache API responses for a given data version, on top of a
+       LRUCache or DiskCache backend. Responses are stored json-encoded,
+       so each hit returns a new object, free to be modified by the caller.
+       Responses bigger than "max_item_size" (once encoded) are not cached.
+    '''
+
+    # backend key of the data version of cached entries (cache keys are
+    # prefixed with a version, so they never collide with it)
+    VERSION_KEY = '__version__'
+
+    def __init__(self, backend, max_item_size=None):
+        self.backend = backend
+        self.max_item_size = max_item_size
+        self.version = None
+
+    @staticmethod
+    def make_key(*args, **kwargs):
+        return json.dumps([args, kwargs], sort_keys=True, default=str)
+
+    def _check_version(self, version):
+        if version == self.version:
+            return
+        # the data version is also kept in the backend: a shared one
+        # (DiskCache) may already hold entries of this version, set by
+        # another process or before a restart
+        stored = self.backend.get(self.VERSION_KEY)
+        if stored != version:
+            if stored is not None:
+                # new data, all previous entries are now useless
+                self.backend.invalidate()
+            self.backend.set(self.VERSION_KEY, version)
+        self.version = version
+
+    def get(self, key, version):
+        self._check_version(version)
+        value = self.backend.get(version + key)
+        if value is not None:
+            return serializer.json_loads(value)
+        return MISSING
+
+    def set(self, key, version, response):
+        self._check_version(version)
+        value = serializer.json_dumps(response).decode('utf-8')
+        if self.max_item_size is None or len(value) <= self.max_item_size:
+            self.backend.set(version + key, value)
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats["version"] = self.version
+        return stats
@@ -6,26 +6,36 @@ from __future__ import print_function
 # http://www.elasticsearch.org/guide/reference/query-dsl/custom-score-query.html
 # http://www.elasticsearch.org/guide/reference/query-dsl/custom-boost-factor-query.html
 # http://www.elasticsearch.org/guide/reference/query-dsl/boosting-query.html
+import os
 import sys
 
 import json
 import re
 import time
 import copy
-import requests
+import base64
+import hashlib
+from collections import namedtuple
 
 from config import (ES_INDEX_NAME_TIER1, ES_INDEX_NAME,
                     SOURCE_TRANSLATORS, GENOME_ASSEMBLY,
-                    TAXONOMY, ES_HOST,  ES_INDEX_TYPE)
+                    TAXONOMY, ES_HOST,  ES_INDEX_TYPE,
+                    RESPONSE_CACHE_BACKEND, RESPONSE_CACHE_SIZE,
+                    RESPONSE_CACHE_DISK_PATH, RESPONSE_CACHE_DISK_SIZE,
+                    RESPONSE_CACHE_MAX_ITEM_SIZE, FACET_CACHE_SIZE,
+                    INDEX_VERSION_CHECK_INTERVAL, INTERVAL_INDEX_MAX_IDS,
+                    ES_CLIENT_PROFILES, ES_DEAD_TIMEOUT)
 from biothings.utils.common import (ask, is_int, is_str,
                                     is_seq, timesofar)
 from biothings.www.api.es import ESQuery, QueryError, ESQueryBuilder, \
                                  parse_facets_option
 from elasticsearch import Elasticsearch
-from .userfilters import UserFilters
+from . import userfilters, taxonomy, idindex, intervalindex, metrics, querycost
+from .cache import LRUCache, DiskCache, ResponseCache, MISSING
 
 from elasticsearch import helpers
 from biothings.utils.mongo import doc_feeder
+from elasticsearch.exceptions import TransportError
 
 
 import logging
@@ -57,45 +67,488 @@ def safe_genome_pos(s):
         raise ValueError('invalid type "%s" for "save_genome_pos"' % type(s))
 
 
+def _unique(li):
+    '''return unique items from li, order is kept.'''
+    seen = set()
+    return [x for x in li if not (x in seen or seen.add(x))]
+
+
+_INTERVAL_QUERY = re.compile(r'chr(?P<chr>\w+):(?P<gstart>[0-9,]+)-(?P<gend>[0-9,]+)')
+# result of ESQueryBuilder.classify_query: "q" is the query string the
+# query is built from, "interval" the parsed genomic interval (interval
+# queries) and "entrezgene" the integer value (id queries)
+ParsedQuery = namedtuple('ParsedQuery', ['type', 'q', 'interval', 'entrezgene'])
+
+# "cursor" parameter value starting cursor paging
+CURSOR_START = ('1', 'true', True)
+# sort values ES 2.x returns for hits missing a numeric sort field
+_MISSING_SORT_VALUES = (2 ** 63 - 1, -2 ** 63, float('inf'), float('-inf'))
+
+
+def _parse_sort_option(sort):
+    '''return [(field, "asc" or "desc")] from sort='entrezgene,-symbol'
+       or a list of fields (or {field: order} dicts).
+    '''
+    if is_str(sort):
+        sort = [x.strip() for x in sort.split(',') if x.strip()]
+    _sort = []
+    for field in sort or []:
+        if isinstance(field, dict):
+            for field, order in field.items():
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+                _sort.append((field, order))
+        elif field.startswith('-'):
+            _sort.append((field[1:], 'desc'))
+        else:
+            _sort.append((field, 'asc'))
+    return _sort
+
+
+def _encode_cursor(values):
+    values = [None if v in _MISSING_SORT_VALUES else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor, n):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        values = None
+    if not isinstance(values, list) or len(values) != n:
+        raise QueryError("Invalid cursor.")
+    return values
+
+
+def _get_keyset_filter(sort, values):
+    '''filter matching hits sorted after the hit with given sort values
+       (what search_after does on ES 5+). Hits missing a sort field are
+       sorted last, sort fields are expected to be single-valued.
+    '''
+    after = []
+    same = []       # previous sort fields equal
+    for (field, order), value in zip(sort, values):
+        missing = {"bool": {"must_not": {"exists": {"field": field}}}}
+        if value is None:
+            same.append(missing)
+            continue
+        _after = {"range": {field: {"gt" if order == 'asc' else "lt": value}}}
+        if field != '_uid':
+            _after = {"bool": {"should": [_after, missing]}}
+        after.append({"bool": {"must": same + [_after]}})
+        same = same + [{"term": {field: value}}]
+    return {"bool": {"should": after}}
+
+
+class SourceTranslator(object):
+    '''SOURCE_TRANSLATORS compiled into one alternation regex, so a query
+       is translated in a single pass. Each key is a group of the regex,
+       the matching group gives the (already expanded) replacement.
+       "trim_from" and "unescape" variants are compiled on first use.
+    '''
+    def __init__(self, translators, memo_size=1000):
+        self.translators = translators
+        self._compiled = {}
+        # translated field names (trim_from is set) come from a small set
+        # of scopes, worth memoizing
+        self._memo = LRUCache(memo_size)
+
+    def _compile(self, trim_from, unescape):
+        srcs = []
+        expansions = [None]    # group index -> replacement
+        for src, regex in self.translators.items():
+            if trim_from:
+                regex = re.sub(trim_from + ".*", "", regex)
+                src = re.sub(trim_from + ".*", "", src)
+            if unescape:
+                regex = regex.replace("\\", "")
+                src = src.replace("\\", "")
+            srcs.append(src)
+            # replacement template (backslash escapes) expanded once
+            expansions.append(re.sub("^", regex, ""))
+        # longest keys first, in case a key is a prefix of another one
+        order = sorted(range(len(srcs)), key=lambda i: -len(srcs[i]))
+        pattern = "|".join(["({})".format(srcs[i]) for i in order])
+        if all([src[:1].isalnum() for src in srcs]):
+            # cheap lookahead on first letters, so most positions in q are
+            # skipped without trying every alternative
+            firsts = set("".join([src[0].lower() + src[0].upper() for src in srcs]))
+            pattern = "(?=[{}])(?:{})".format("".join(sorted(firsts)), pattern)
+        pattern = re.compile(pattern, re.I)
+        expansions = [None] + [expansions[i + 1] for i in order]
+        return pattern, expansions
+
+    def translate(self, q, trim_from="", unescape=False):
+        memo_key = None
+        if trim_from:
+            memo_key = (q, trim_from, unescape)
+            res = self._memo.get(memo_key)
+            if res is not None:
+                return res
+        variant = (trim_from, unescape)
+        if variant not in self._compiled:
+            self._compiled[variant] = self._compile(trim_from, unescape)
+        pattern, expansions = self._compiled[variant]
+        res = pattern.sub(lambda m: expansions[m.lastindex], q)
+        if memo_key:
+            self._memo.set(memo_key, res)
+        return res
+
+
+_source_translator = SourceTranslator(SOURCE_TRANSLATORS)
+
+
+def translate_datasource(q, trim_from="", unescape=False):
+    '''translate data source prefixes in q according to SOURCE_TRANSLATORS,
+       e.g. "refseq:NM_001798" becomes "refseq.\\\\*:NM_001798".
+    '''
+    return _source_translator.translate(q, trim_from=trim_from, unescape=unescape)
+
+
+class QueryTemplate(object):
+    '''A query shape compiled once into a plain python function.
+
+       Values to fill in are marked with QueryTemplate.slot(name), either as
+       a dict value or as a list item. Calling the template returns a brand
+       new structure each time, so callers are free to modify it:
+
+           tpl = QueryTemplate({"term": {"symbol": QueryTemplate.slot("q")}})
+           tpl(q="cdk2")     # {"term": {"symbol": "cdk2"}}
+    '''
+    class slot(object):
+        def __init__(self, name):
+            self.name = name
+
+    def __init__(self, template):
+        self.slots = []
+        code = self._to_source(template)
+        code = "lambda {}: {}".format(", ".join(self.slots), code)
+        self._build = eval(compile(code, "<QueryTemplate>", "eval"), {})
+
+    def _to_source(self, node):
+        if isinstance(node, QueryTemplate.slot):
+            if node.name not in self.slots:
+                self.slots.append(node.name)
+            return node.name
+        elif isinstance(node, dict):
+            return "{" + ", ".join(["{!r}: {}".format(k, self._to_source(v))
+                                    for k, v in node.items()]) + "}"
+        elif isinstance(node, (list, tuple)):
+            return "[" + ", ".join([self._to_source(v) for v in node]) + "]"
+        elif node is None or isinstance(node, (bool, int, float, str)):
+            return repr(node)
+        else:
+            raise TypeError('unsupported type "{}" in query template'.format(type(node)))
+
+    def __call__(self, **values):
+        return self._build(**values)
+
+
+_q = QueryTemplate.slot("q")
+
+# those query shapes are used for every text query, they are compiled once
+# here (with datasource field names already translated) instead of being
+# built from a json string on each request.
+_DIS_MAX_QUERY = QueryTemplate({
+    "dis_max": {
+        "tie_breaker": 0,
+        "boost": 1,
+        "queries": [
+            {
+                "function_score": {
+                    "query": {
+                        "match": {
+                            "symbol": {
+                                "query": _q,
+                                "analyzer": "whitespace_lowercase"
+                            }
+                        },
+                    },
+                    "weight": 5
+                }
+            },
+            {
+                "function_score": {
+                    "query": {
+                        # This makes phrase match of "cyclin-dependent
+                        # kinase 2" appears first
+                        "match_phrase": {"name": _q},
+                    },
+                    "weight": 4
+
+                }
+            },
+            {
+                "function_score": {
+                    "query": {
+                        "match": {
+                            "name": {
+                                "query": _q,
+                                "operator": "and",
+                                "analyzer": "whitespace_lowercase"
+                            }
+                        },
+                    },
+                    "weight": 3
+                }
+            },
+            {
+                "function_score": {
+                    "query": {
+                        "match": {
+                            "unigene": {
+                                "query": _q,
+                                "analyzer": "string_lowercase"
+                            }
+                        }
+                    },
+                    "weight": 1.1
+                }
+            },
+            {
+                "function_score": {
+                    "query": {
+                        "multi_match": {
+                            "query": _q,
+                            "fields": [
+                                translate_datasource("refseq", trim_from=":", unescape=True),
+                                translate_datasource("accession", trim_from=":", unescape=True)
+                            ],
+                            "operator": "or"
+                        }
+                    },
+                    "weight": 1.1
+                }
+            },
+            {
+                "function_score": {
+                    "query": {
+                        "match": {
+                            "go": {
+                                "query": _q,
+                                "analyzer": "string_lowercase"
+                            }
+                        }
+                    },
+                    "weight": 1.1
+                }
+            },
+            # {
+            # "custom_boost_factor": {
+            #     "query" : {
+            #         "match" : { "_all" : {
+            #                     "query": "%(q)s",
+            #                     "analyzer": "whitespace_lowercase"
+            #             }
+            #         },
+            #     },
+            #     "boost_factor": 1
+            # }
+            # },
+            {
+                "function_score": {
+                    "query": {
+                        "query_string": {
+                            "query": _q,
+                            "default_operator": "AND",
+                            "auto_generate_phrase_queries": True
+                        },
+                    },
+                    "weight": 1
+                }
+            },
+
+        ]
+    }
+})
+
+# dis_max query used when q is an integer (ie. an entrezgene id)
+_ENTREZGENE_QUERY = QueryTemplate({
+    "dis_max": {
+        "tie_breaker": 0,
+        "boost": 1,
+        "queries": [
+            {
+                "function_score": {
+                    "query": {
+                        "term": {"entrezgene": QueryTemplate.slot("entrezgene")},
+                    },
+                    "weight": 8
+                }
+            }
+        ]
+    }
+})
+
+_WILDCARD_QUERY = QueryTemplate({
+    "dis_max": {
+        "tie_breaker": 0,
+        "boost": 1,
+        "queries": [
+            {
+                "function_score": {
+                    "query": {
+                        "wildcard": {
+                            "symbol": {
+                                "value": _q,
+                                # "weight": 5.0,
+                            }
+                        },
+                    },
+                }
+            },
+            {
+                "function_score": {
+                    "query": {
+                        "wildcard": {
+                            "name": {
+                                "value": _q,
+                                # "weight": 1.1,
+                            }
+                        },
+                    }
+                }
+            },
+            {
+                "function_score": {
+                    "query": {
+                        "wildcard": {
+                            "summary": {
+                                "value": _q,
+                                # "weight": 0.5,
+                            }
+                        },
+                    }
+                }
+            },
+
+        ]
+    }
+})
+
+# chars which made the former json based wildcard query building fail
+_JSON_UNSAFE_CHARS = re.compile(r'["\\\x00-\x1f]')
+
+
+# only what's needed to get index versions from a get_mapping call
+_INDEX_VERSION_FILTER = "*.mappings.*._meta"
+
+
+def get_response_cache():
+    '''return the response cache set in config (RESPONSE_CACHE_BACKEND),
+       or None if disabled.
+    '''
+    if RESPONSE_CACHE_BACKEND == "memory":
+        backend = LRUCache(maxsize=RESPONSE_CACHE_SIZE)
+    elif RESPONSE_CACHE_BACKEND == "disk":
+        backend = DiskCache(RESPONSE_CACHE_DISK_PATH,
+                            maxsize=RESPONSE_CACHE_DISK_SIZE)
+    elif RESPONSE_CACHE_BACKEND:
+        raise ValueError('Unknown RESPONSE_CACHE_BACKEND "{}"'.format(
+                         RESPONSE_CACHE_BACKEND))
+    else:
+        return None
+    return ResponseCache(backend, max_item_size=RESPONSE_CACHE_MAX_ITEM_SIZE)
+
+
+def get_facet_cache():
+    '''return the aggregations cache, or None if disabled.'''
+    if FACET_CACHE_SIZE:
+        return ResponseCache(LRUCache(maxsize=FACET_CACHE_SIZE))
+    return None
+
+
 class ESQuery(ESQuery):
+    # shared by all instances (one per handler class)
+    _response_cache = get_response_cache()
+    _facet_cache = get_facet_cache()
+    _index_versions = {}    # index name -> (last check time, version, _meta hash)
+
     def __init__(self):
         super(ESQuery, self).__init__()
         self._default_fields = ['name', 'symbol', 'taxid', 'entrezgene']
         self._default_species = [9606, 10090, 10116]  # human, mouse, rat
         self._tier_1_species = set(TAXONOMY.values())
 
+    @property
+    def _es(self):
+        '''ES client of the current process (see get_es): instances are
+           created at import time, before API processes are forked.
+        '''
+        return get_es(role='api')
+
+    @_es.setter
+    def _es(self, es):
+        # client set by biothings ESQuery.__init__, not used
+        pass
+
     def _search(self, q, species='all', **kwargs):
         scroll_options = {}
         if kwargs.get("scroll"):
             scroll_options["size"] = kwargs.get("size")
             scroll_options["scroll"] = kwargs.get("scroll")
+        key = None if scroll_options else self._get_facet_cache_key(q, species)
+        version = key and self._get_data_version()
+        q, aggs = self._get_cached_facets(q, key, version)
         self._set_index(species)
-        res = self._es.search(index=self._index, doc_type=self._doc_type,
-                              body=q, **scroll_options)
+        with metrics.timer('es'):
+            res = self._es.search(index=self._index, doc_type=self._doc_type,
+                                  body=q, **scroll_options)
         self._index = ES_INDEX_NAME  # reset self._index
-        return res
+        return self._set_cached_facets(res, key, version, aggs)
 
     def _msearch(self, **kwargs):
         self._set_index(kwargs.get('species', 'all'))
         # logging.debug("_msearch: %s" % kwargs['body'])
-        res = super(ESQuery, self)._msearch(**kwargs)
+        with metrics.timer('es'):
+            res = super(ESQuery, self)._msearch(**kwargs)
         self._index = ES_INDEX_NAME     # reset self._index
         return res
 
+    def _mget(self, ids, species='all', **kwargs):
+        with metrics.timer('es'):
+            return self._es.mget(body={'ids': ids},
+                                 index=self._get_index(species),
+                                 doc_type=self._doc_type, **kwargs)
+
+    def _cleaned_res(self, res, empty, single_hit, options):
+        with metrics.timer('clean'):
+            return super(ESQuery, self)._cleaned_res(res, empty=empty,
+                                                     single_hit=single_hit,
+                                                     options=options)
+
     def _set_index(self, species):
         '''set proper index for given species parameter.'''
+        self._index = self._get_index(species)
+
+    def _get_index(self, species):
+        '''return proper index for given species parameter.'''
         if species == 'all' or len(set(species)-self._tier_1_species) > 0:
-            self._index = ES_INDEX_NAME
+            return ES_INDEX_NAME
         else:
-            self._index = ES_INDEX_NAME_TIER1
+            return ES_INDEX_NAME_TIER1
 
     def _get_query_builder(self, **kwargs):
         return ESQueryBuilder(**kwargs)
 
     def _build_query(self, q, **kwargs):
         # can override this function if more query types are to be added
-        esqb = self._get_query_builder(**kwargs)
-        return esqb.query(q)
+        with metrics.timer('build'):
+            esqb = self._get_query_builder(**kwargs)
+            esqb.interval_index = self._get_interval_index()
+            _q = esqb.query(q)
+            querycost.check(_q)
+            return _q
+
+    def _get_interval_index(self):
+        '''return the genomic interval index (see utils/intervalindex.py)
+           if available and matching ES data, None otherwise.
+        '''
+        interval_index = intervalindex.get_interval_index()
+        if interval_index is not None and \
+                interval_index.version == self._get_data_version():
+            return interval_index
+        return None
 
     def _cleaned_species(self, species, default_to_none=False):
         '''return a cleaned species parameter.
@@ -136,17 +589,8 @@ class ESQuery(ESQuery):
         # change facet counts.
         kwargs['species'] = self._cleaned_species(kwargs.get('species', None))
         include_tax_tree = kwargs.pop('include_tax_tree', False)
-        if include_tax_tree:
-            headers = {'content-type': 'application/x-www-form-urlencoded',
-                       'user-agent': "Python-requests_mygene.info/%s (gzip)"
-                       % requests.__version__}
-            # TODO: URL as config param
-            res = requests.post('http://t.biothings.io/v1/taxon?ids=' +
-                                ','.join(['{}'.format(sid) for sid in
-                                          kwargs['species']]) +
-                                '&expand_species=true', headers=headers)
-            if res.status_code == requests.codes.ok:
-                kwargs['species'] = res.json()
+        if include_tax_tree and kwargs['species'] != 'all':
+            kwargs['species'] = taxonomy.expand_species(kwargs['species'])
 
         # this parameter is to add species filter without
         # changing facet counts.
@@ -155,30 +599,249 @@ class ESQuery(ESQuery):
         options.kwargs = kwargs
         return options
 
+    def _get_fresh_index_version(self, index):
+        '''return (True, version) if index version was checked less than
+           INDEX_VERSION_CHECK_INTERVAL seconds ago, (False, None) otherwise.
+        '''
+        checked = self._index_versions.get(index)
+        if checked and time.time() - checked[0] < INDEX_VERSION_CHECK_INTERVAL:
+            return True, checked[1]
+        return False, None
+
+    def _set_index_version(self, index, mapping, aliases=None):
+        '''set index version from a get_mapping result filtered with
+           _INDEX_VERSION_FILTER, or from a get_alias result if there's no
+           _meta in mapping.
+        '''
+        if mapping:
+            real_index, mapping = list(mapping.items())[0]
+            _meta = mapping['mappings'][self._doc_type]['_meta']
+            version = "{}:{}".format(real_index, _meta.get('build_version') or
+                                     _meta.get('timestamp'))
+            # _meta can be updated in place (stats, src_version) when
+            # changes are synced to the index, data stays the same
+            meta_hash = hashlib.sha1(json.dumps(_meta, sort_keys=True, default=str)
+                                     .encode('utf-8')).hexdigest()[:8]
+        else:
+            # no _meta, only the index name can be checked
+            version = list(aliases.keys())[0]
+            meta_hash = ''
+        self._index_versions[index] = (time.time(), version, meta_hash)
+        return version
+
+    def get_index_version(self, index=None):
+        '''return a string identifying data currently behind the given index
+           (or alias): the actual index name and _meta build_version or
+           timestamp. ES is asked at most every INDEX_VERSION_CHECK_INTERVAL
+           seconds. Returns None if ES can't tell.
+        '''
+        index = index or self._index
+        fresh, version = self._get_fresh_index_version(index)
+        if fresh:
+            return version
+        try:
+            mapping = self._es.indices.get_mapping(
+                index, self._doc_type, filter_path=_INDEX_VERSION_FILTER)
+            aliases = None if mapping else self._es.indices.get_alias(index)
+        except Exception as e:
+            logging.warning("Can't get version of index '%s': %s", index, e)
+            return None
+        return self._set_index_version(index, mapping, aliases)
+
+    def _get_data_version(self):
+        '''version of data served by this ESQuery, whatever the index
+           selected from species parameter.
+        '''
+        versions = [self.get_index_version(index) for index in
+                    (ES_INDEX_NAME, ES_INDEX_NAME_TIER1)]
+        if None in versions:
+            return None
+        return "|".join(versions)
+
+    def _get_metadata_version(self):
+        '''data version, plus a hash of indices _meta: for responses
+           built from _meta (/metadata), which can change without data.
+        '''
+        version = self._get_data_version()
+        if version is None:
+            return None
+        return "|".join([version] + [self._index_versions[index][2] for index in
+                                     (ES_INDEX_NAME, ES_INDEX_NAME_TIER1)])
+
+    def _get_facet_cache_key(self, q, species):
+        '''return the aggregations cache key of ES query "q", None if it
+           has no aggregations. Aggregations only depend on index, query
+           and aggregations requested: post filter (species_facet_filter),
+           paging, sort and fields are not part of the key.
+        '''
+        if self._facet_cache is None or not isinstance(q, dict) or \
+                not q.get('aggs'):
+            return None
+        return ResponseCache.make_key(self._get_index(species), q.get('query'),
+                                      q['aggs'])
+
+    def _get_cached_facets(self, q, key, version):
+        '''return (query to send to ES, cached aggregations or MISSING):
+           aggregations are removed from the query if cached.
+        '''
+        if not version:
+            return q, MISSING
+        aggs = self._facet_cache.get(key, version)
+        if aggs is not MISSING:
+            q = dict(q)
+            del q['aggs']
+        return q, aggs
+
+    def _set_cached_facets(self, res, key, version, aggs):
+        '''add cached aggregations to ES result, or cache its aggregations.'''
+        if not version:
+            return res
+        if aggs is not MISSING:
+            res['aggregations'] = aggs
+        elif 'aggregations' in res:
+            self._facet_cache.set(key, version, res['aggregations'])
+        return res
+
+    def _get_response_cache_key(self, endpoint, q, kwargs):
+        '''return the response cache key for this request, or None if it
+           can't be cached (paged scroll results, raw ES responses).
+        '''
+        if self._response_cache is None or \
+                'fetch_all' in kwargs or 'scroll_id' in kwargs or \
+                kwargs.get('raw') in (True, 1, '1', 'true'):
+            return None
+        key_kwargs = dict(kwargs)
+        # order doesn't matter in comma-separated lists
+        for k in ('fields', 'filter', 'species', 'scopes'):
+            if is_str(key_kwargs.get(k)):
+                key_kwargs[k] = ','.join(sorted(set(
+                    [x.strip() for x in key_kwargs[k].split(',')])))
+        return ResponseCache.make_key(endpoint, q, **key_kwargs)
+
+    def _set_cached_response(self, key, version, res):
+        '''store res in response cache, unless it's an error or partial
+           (search timed out, see utils/querycost.py).'''
+        if not (isinstance(res, dict) and
+                ('error' in res or res.get('success') is False or
+                 res.get('timed_out'))):
+            self._response_cache.set(key, version, res)
+
+    def _cached_response(self, endpoint, q, kwargs, func):
+        '''return func(q, **kwargs) from response cache if possible, or
+           call it and cache the result.
+        '''
+        key = self._get_response_cache_key(endpoint, q, kwargs)
+        version = key and self._get_data_version()
+        if not version:
+            return func(q, **kwargs)
+        res = self._response_cache.get(key, version)
+        if res is MISSING:
+            res = func(q, **kwargs)
+            self._set_cached_response(key, version, res)
+        return res
+
+    def query(self, q, **kwargs):
+        '''for /query?q=<query>'''
+        if kwargs.get('cursor'):
+            return self._cached_response("query", q, kwargs, self._cursor_query)
+        return self._cached_response("query", q, kwargs,
+                                     super(ESQuery, self).query)
+
+    def _cleaned_query_res(self, res, options):
+        '''same output as query(), from a _search result.'''
+        _res = res['hits']
+        _res['took'] = res['took']
+        if res.get('timed_out'):
+            _res['timed_out'] = True
+        if '_scroll_id' in res:
+            _res['_scroll_id'] = res['_scroll_id']
+        _res['hits'] = self._cleaned_res({'hits': {'total': _res['total'],
+                                                   'hits': _res['hits']}},
+                                         empty=[], single_hit=False,
+                                         options=options)
+        if 'aggregations' in res:
+            _res['facets'] = {}
+            for facet, agg in res['aggregations'].items():
+                _res['facets'][facet] = {
+                    '_type': 'terms',
+                    'terms': [{'term': b['key'], 'count': b['doc_count']}
+                              for b in agg.get('buckets', [])],
+                    'other': agg.get('sum_other_doc_count', 0),
+                    'missing': 0,
+                    'total': sum([b['doc_count'] for b in agg.get('buckets', [])])
+                }
+        return _res
+
+    def _build_cursor_query(self, q, cursor, options):
+        '''build query for a page of cursor paging: hits are sorted on
+           "sort" option then _uid, and only hits after the last hit of
+           previous page (whose sort values are encoded in "cursor") are
+           matched. So any page costs the same as the first one, unlike
+           from/size paging.
+        '''
+        sort = _parse_sort_option(options.kwargs.pop('sort', None))
+        options.kwargs.pop('from', None)
+        if '_score' in [field for field, _ in sort]:
+            raise QueryError("Cursor paging can't sort on _score.")
+        sort.append(('_uid', 'asc'))
+        _q = self._build_query(q, options=options, **options.kwargs)
+        _q['sort'] = [{field: {"order": order, "missing": "_last"}}
+                      if field != '_uid' else {field: {"order": order}}
+                      for field, order in sort]
+        if cursor not in CURSOR_START:
+            _q['query'] = {"bool": {"must": _q.get('query', {"match_all": {}}),
+                                    "filter": _get_keyset_filter(
+                                        sort, _decode_cursor(cursor, len(sort)))}}
+        return _q
+
+    @staticmethod
+    def _get_next_cursor(_q, res):
+        '''cursor for the page following result "res" of query "_q",
+           None if it was the last page.
+        '''
+        hits = res['hits']['hits']
+        if hits and len(hits) >= int(_q.get('size', 10)):
+            return _encode_cursor(hits[-1]['sort'])
+        return None
+
+    def _cursor_query(self, q, **kwargs):
+        '''query() with cursor paging: "cursor" is true for first page,
+           then the "cursor" returned with previous page.
+        '''
+        cursor = kwargs.pop('cursor')
+        options = self._get_cleaned_query_options(kwargs)
+        try:
+            _q = self._build_cursor_query(q, cursor, options)
+        except QueryError as err:
+            return {'success': False, 'error': str(err)}
+        if options.rawquery:
+            return _q
+        try:
+            res = self._search(_q, species=options.kwargs['species'])
+        except TransportError as err:
+            return {'success': False,
+                    'error': err.info if options.raw else "invalid query term."}
+        if options.raw:
+            return res
+        cursor = self._get_next_cursor(_q, res)
+        res = self._cleaned_query_res(res, options)
+        res['cursor'] = cursor
+        return res
+
     def metadata(self, raw=False):
         '''return metadata about the index.'''
-        mapping = self._es.indices.get_mapping(self._index, self._doc_type)
         if raw:
-            return mapping
-
-        def get_fields(properties):
-            for k, v in list(properties.items()):
-                if 'properties' in v:
-                    for f in get_fields(v['properties']):
-                        yield f
-                else:
-                    if v.get('index', None) == 'no':
-                        continue
-                    f = v.get('index_name', k)
-                    yield f
-        mapping = list(mapping.values())[0]['mappings']
-        # field_set = set(get_fields(mapping[self._doc_type]['properties']))
+            return self._es.indices.get_mapping(self._index, self._doc_type)
+        # only _meta is needed, not the whole mapping
+        mapping = self._es.indices.get_mapping(
+            self._index, self._doc_type, filter_path=_INDEX_VERSION_FILTER)
+        mapping = list(mapping.values())[0]['mappings'] if mapping else {}
         metadata = {
             # 'available_fields': sorted(field_set)
             # TODO: http://mygene.info as config
             'available_fields': 'http://mygene.info/metadata/fields'
         }
-        if '_meta' in mapping[self._doc_type]:
+        if '_meta' in mapping.get(self._doc_type, {}):
             metadata.update(mapping[self._doc_type]['_meta'])
         metadata['genome_assembly'] = GENOME_ASSEMBLY
         metadata['taxonomy'] = TAXONOMY
@@ -189,9 +852,24 @@ class ESQuery(ESQuery):
 
     def get_gene(self, geneid, **kwargs):
         '''for /gene/<geneid>'''
+        return self._cached_response("gene", geneid, kwargs, self._get_gene)
+
+    def _get_gene(self, geneid, **kwargs):
+        metrics.set_query_type('id')
+        _id = self._get_indexed_id(geneid, kwargs)
         options = self._get_cleaned_annotation_options(kwargs)
-        qbdr = ESQueryBuilder(options=options, **options.kwargs)
-        _q = qbdr.build_id_query(geneid, options.scopes)
+        if _id:
+            res = self._mget([_id], species=options.kwargs['species'],
+                             **self._get_mget_params(options))
+            doc = self._get_mget_resolved([geneid], res, options,
+                                          single_hit=True).get(geneid)
+            if doc is not None:
+                return doc
+            # not a genedoc _id, but may still match an (analyzed) id
+            # field, e.g. a lowercase Ensembl id: search it
+        with metrics.timer('build'):
+            qbdr = ESQueryBuilder(options=options, **options.kwargs)
+            _q = qbdr.build_id_query(geneid, options.scopes)
         if options.rawquery:
             return _q
         res = self._search(_q, species=options.kwargs['species'])
@@ -200,6 +878,176 @@ class ESQuery(ESQuery):
         return res
 
 
+    # scopes for which a gene id may be the genedoc _id itself
+    # (entrezgene, or Ensembl gene for Ensembl-only genes)
+    _ID_SCOPES = set(['entrezgene', 'retired', 'ensemblgene', 'ensembl.gene'])
+    # filters which can't be applied to _mget results
+    _NON_ID_FILTERS = ['userfilter', 'exists', 'missing',
+                       'entrezonly', 'ensemblonly']
+
+    def _get_indexed_id(self, geneid, kwargs, data_version=None):
+        '''return genedoc _id for geneid from the id index (see
+           utils/idindex.py), or None if it can't be used: no index, index
+           not matching ES data, scopes not covering all id fields, or
+           geneid mapped to several genedocs. data_version is
+           self._get_data_version(), if already known.
+        '''
+        if idindex.get_id_index() is None or not isinstance(geneid, (int, str)):
+            return None
+        scopes = self._get_id_scopes(kwargs)
+        if not scopes or not ('entrezgene' in scopes and 'retired' in scopes and
+                              ('ensemblgene' in scopes or 'ensembl.gene' in scopes)):
+            return None
+        id_index = self._get_current_id_index(data_version)
+        if id_index is None:
+            return None
+        _ids = id_index.get(str(int(geneid)) if is_int(geneid) else geneid)
+        return _ids[0] if len(_ids) == 1 else None
+
+    def _get_current_id_index(self, data_version=None):
+        '''return the id index (see utils/idindex.py) if it matches ES data
+           (data_version, current one by default), else None.
+        '''
+        id_index = idindex.get_id_index()
+        if id_index is None or id_index.version != (data_version or self._get_data_version()):
+            return None
+        return id_index
+
+    def _get_id_scopes(self, kwargs):
+        '''return the set of query scopes if they are all id fields and
+           other query parameters allow a lookup by _id, else None.
+        '''
+        for k in ['raw', 'rawquery'] + self._NON_ID_FILTERS:
+            if kwargs.get(k) not in (None, False, 0, '0', 'false', ''):
+                return None
+        scopes = kwargs.get('scopes', None)
+        if scopes is None:
+            # same as ESQueryBuilder.build_id_query default
+            scopes = ['entrezgene', 'retired', 'ensemblgene']
+        elif is_str(scopes):
+            scopes = [x.strip() for x in scopes.split(',')]
+        scopes = set(scopes)
+        if not scopes or not scopes <= self._ID_SCOPES:
+            return None
+        return scopes
+
+    def _get_mget_candidates(self, bid_list, kwargs, id_index=None):
+        '''return ids from bid_list which can be looked up as genedoc _id,
+           according to scopes and other query parameters. With "retired"
+           scope, an entrezgene id may also be a retired id of other genes:
+           it's a candidate only if id_index (a current id index, see
+           _get_current_id_index) maps it to its own genedoc only.
+        '''
+        scopes = self._get_id_scopes(kwargs)
+        if not scopes:
+            return []
+        by_entrez = 'entrezgene' in scopes
+        by_ensembl = 'ensemblgene' in scopes or 'ensembl.gene' in scopes
+        check_retired = 'retired' in scopes
+        candidates = []
+        for bid in bid_list:
+            if not isinstance(bid, (int, str)):
+                return []
+            if is_int(bid):
+                key = str(int(bid))
+                if by_entrez and (not check_retired or
+                                  (id_index is not None and id_index.get(key) == [key])):
+                    candidates.append(bid)
+            elif by_ensembl:
+                candidates.append(bid)
+        return candidates
+
+    def _get_mget_params(self, options):
+        '''return _mget parameters (_source) for given query options.'''
+        species = options.kwargs.get('species', 'all')
+        params = {}
+        fields = options.kwargs.get('_source', None)
+        if fields:
+            fields = fields.split(',') if is_str(fields) else list(fields)
+            if species != 'all' and 'taxid' not in fields:
+                # needed to check species, removed afterwards
+                fields = fields + ['taxid']
+            params['_source'] = fields
+        return params
+
+    def _get_mget_resolved(self, bid_list, res, options, single_hit=False):
+        '''return a dict of bid -> cleaned docs (or cleaned doc if
+           single_hit) from an _mget result, for found docs matching species.
+        '''
+        species = options.kwargs.get('species', 'all')
+        fields = options.kwargs.get('_source', None)
+        resolved = {}
+        for bid, doc in zip(bid_list, res['docs']):
+            if not doc.get('found'):
+                continue
+            _source = doc['_source']
+            if species != 'all':
+                if _source.get('taxid') not in species:
+                    continue
+                if fields and 'taxid' not in fields:
+                    _source.pop('taxid', None)
+            # formatted the same way as msearch hits. Score is meaningless
+            # here, there's only one hit per id.
+            hit = {'_id': doc['_id'], '_score': 1.0, '_source': _source}
+            resolved[bid] = self._cleaned_res({'hits': {'total': 1, 'hits': [hit]}},
+                                              empty=[], single_hit=single_hit,
+                                              options=options)
+        return resolved
+
+    def _mget_genes(self, bid_list, options):
+        '''fetch genedocs by _id, return a dict of bid -> cleaned docs
+           for found ids matching species.
+        '''
+        res = self._mget([str(bid) for bid in bid_list],
+                         species=options.kwargs.get('species', 'all'),
+                         **self._get_mget_params(options))
+        return self._get_mget_resolved(bid_list, res, options)
+
+    @staticmethod
+    def _stitch_mget_res(bid_list, resolved, searched):
+        '''return results for bid_list, in that order, from "resolved"
+           (bid -> cleaned docs) and "searched" (msearch results, as
+           returned by mget_biothings).
+        '''
+        grouped = {}
+        for hit in searched:
+            grouped.setdefault(hit['query'], []).append(hit)
+        _res = []
+        for bid in bid_list:
+            if bid in resolved:
+                for hit in resolved[bid]:
+                    hit[u'query'] = bid
+                    _res.append(hit)
+            else:
+                _res.extend(grouped[bid])
+        return _res
+
+    def mget_biothings(self, bid_list, **kwargs):
+        '''for POST batch queries. Ids which are genedoc _ids are fetched
+           with one _mget, others (retired ids, Ensembl ids of genes with an
+           entrezgene, entrezgene ids without a current id index to tell
+           they aren't retired ids too, or any id when scopes are not id
+           fields) go through the msearch queries. Results keep the order of bid_list.
+        '''
+        metrics.set_query_type('id')
+        id_index = None
+        if idindex.get_id_index() is not None:
+            id_index = self._get_current_id_index()
+        candidates = self._get_mget_candidates(bid_list, kwargs, id_index)
+        if not candidates:
+            return super(ESQuery, self).mget_biothings(bid_list, **kwargs)
+        options = self._get_cleaned_query_options(dict(kwargs))
+        resolved = self._mget_genes(_unique(candidates), options)
+        residual = _unique([bid for bid in bid_list if bid not in resolved])
+        searched = []
+        if residual:
+            searched = super(ESQuery, self).mget_biothings(residual, **kwargs)
+            if isinstance(searched, dict):
+                # error
+                return searched
+        return self._stitch_mget_res(bid_list, resolved, searched)
+
+
 class ESQueryBuilder(ESQueryBuilder):
     def __init__(self, **query_options):
         """You can pass these options:
@@ -258,6 +1106,9 @@ class ESQueryBuilder(ESQueryBuilder):
             self._query_options['_source'] = self._query_options['fields']
             del self._query_options['fields']
 
+        # set by ESQuery, used to resolve genomic interval queries locally
+        self.interval_index = None
+
         # this is a fake query to make sure to return empty hits
         self._nohits_query = {
             "match": {
@@ -266,16 +1117,7 @@ class ESQueryBuilder(ESQueryBuilder):
         }
 
     def _translate_datasource(self, q, trim_from="", unescape=False):
-        for src in SOURCE_TRANSLATORS.keys():
-            regex = SOURCE_TRANSLATORS[src]
-            if trim_from:
-                regex = re.sub(trim_from + ".*","",regex)
-                src = re.sub(trim_from + ".*","",src)
-            if unescape:
-                regex = regex.replace("\\","")
-                src = src.replace("\\","")
-            q = re.sub(src, regex, q, flags=re.I)
-        return q
+        return translate_datasource(q, trim_from=trim_from, unescape=unescape)
 
     def _parse_interval_query(self, query):
         '''Check if the input query string matches interval search regex,
@@ -285,9 +1127,9 @@ class ESQueryBuilder(ESQueryBuilder):
               gend
             , otherwise, return None.
         '''
-        pattern = r'chr(?P<chr>\w+):(?P<gstart>[0-9,]+)-(?P<gend>[0-9,]+)'
-        if query:
-            mat = re.search(pattern, query)
+        # most queries have no ":", no need to run the pattern
+        if query and ':' in query:
+            mat = _INTERVAL_QUERY.search(query)
             if mat:
                 d = mat.groupdict()
                 if query.startswith('hg19.'):
@@ -300,224 +1142,86 @@ class ESQueryBuilder(ESQueryBuilder):
                 return d
 
     def dis_max_query(self, q):
-        # remove '"' and '\' from q, they will break json decoder.
-        q = q.replace('"', '').replace('\\', '')
-        _query = {
-            "dis_max": {
-                "tie_breaker": 0,
-                "boost": 1,
-                "queries": [
-                    {
-                        "function_score": {
-                            "query": {
-                                "match": {
-                                    "symbol": {
-                                        "query": "%(q)s",
-                                        "analyzer": "whitespace_lowercase"
-                                    }
-                                },
-                            },
-                            "weight": 5
-                        }
-                    },
-                    {
-                        "function_score": {
-                            "query": {
-                                # This makes phrase match of "cyclin-dependent
-                                # kinase 2" appears first
-                                "match_phrase": {"name": "%(q)s"},
-                            },
-                            "weight": 4
-
-                        }
-                    },
-                    {
-                        "function_score": {
-                            "query": {
-                                "match": {
-                                    "name": {
-                                        "query": "%(q)s",
-                                        "operator": "and",
-                                        "analyzer": "whitespace_lowercase"
-                                    }
-                                },
-                            },
-                            "weight": 3
-                        }
-                    },
-                    {
-                        "function_score": {
-                            "query": {
-                                "match": {
-                                    "unigene": {
-                                        "query": "%(q)s",
-                                        "analyzer": "string_lowercase"
-                                    }
-                                }
-                            },
-                            "weight": 1.1
-                        }
-                    },
-                    {
-                        "function_score": {
-                            "query": {
-                                "multi_match": {
-                                    "query": "%(q)s",
-                                    "fields": [
-                                        self._translate_datasource("refseq",trim_from=":",unescape=True),
-                                        self._translate_datasource("accession",trim_from=":",unescape=True)
-                                    ],
-                                    "operator": "or"
-                                }
-                            },
-                            "weight": 1.1
-                        }
-                    },
-                    {
-                        "function_score": {
-                            "query": {
-                                "match": {
-                                    "go": {
-                                        "query": "%(q)s",
-                                        "analyzer": "string_lowercase"
-                                    }
-                                }
-                            },
-                            "weight": 1.1
-                        }
-                    },
-                    # {
-                    # "custom_boost_factor": {
-                    #     "query" : {
-                    #         "match" : { "_all" : {
-                    #                     "query": "%(q)s",
-                    #                     "analyzer": "whitespace_lowercase"
-                    #             }
-                    #         },
-                    #     },
-                    #     "boost_factor": 1
-                    # }
-                    # },
-                    {
-                        "function_score": {
-                            "query": {
-                                "query_string": {
-                                    "query": "%(q)s",
-                                    "default_operator": "AND",
-                                    "auto_generate_phrase_queries": True
-                                },
-                            },
-                            "weight": 1
-                        }
-                    },
+        return self._dis_max_query(self._classify_string_query(q))
 
-                ]
-            }
-        }
-        _query = json.dumps(_query)
-        _query = json.loads(_query % {'q': q})
-
-        if is_int(q):
-            _query['dis_max']['queries'] = []
-            _query['dis_max']['queries'].insert(
-                0,
-                {
-                    "function_score": {
-                        "query": {
-                            "term": {"entrezgene": int(q)},
-                        },
-                        "weight": 8
-                    }
-                }
-            )
-
-        return _query
+    def _dis_max_query(self, parsed):
+        '''dis_max query (entrezgene query for integers) from ParsedQuery.'''
+        if parsed.entrezgene is not None:
+            return _ENTREZGENE_QUERY(entrezgene=parsed.entrezgene)
+        return _DIS_MAX_QUERY(q=parsed.q)
 
     def _is_wildcard_query(self, query):
         ''' Return True if input query is a wildcard query. '''
-        return query.find('*') != -1 or query.find('?') != -1
-
-    def wildcard_query(self, q):
-        '''q should contains either * or ?, but not the first character.'''
-        _query = {
-            "dis_max": {
-                "tie_breaker": 0,
-                "boost": 1,
-                "queries": [
-                    {
-                        "function_score": {
-                            "query": {
-                                "wildcard": {
-                                    "symbol": {
-                                        "value": "%(q)s",
-                                        # "weight": 5.0,
-                                    }
-                                },
-                            },
-                        }
-                    },
-                    {
-                        "function_score": {
-                            "query": {
-                                "wildcard": {
-                                    "name": {
-                                        "value": "%(q)s",
-                                        # "weight": 1.1,
-                                    }
-                                },
-                            }
-                        }
-                    },
-                    {
-                        "function_score": {
-                            "query": {
-                                "wildcard": {
-                                    "summary": {
-                                        "value": "%(q)s",
-                                        # "weight": 0.5,
-                                    }
-                                },
-                            }
-                        }
-                    },
-
-                ]
-            }
-        }
-        _query = json.dumps(_query)
+        return '*' in query or '?' in query
+
+    def classify_query(self, q):
+        '''return a ParsedQuery for (translated) query string q, checking
+           each query type once, in order of precedence:
+              interval    e.g. "chr1:1000-2000", "hg19.chr1:1000-2000"
+              match_all   "__all__"
+              raw_string  fielded or boolean query (may contain wildcards)
+              wildcard    contains "*" or "?"
+              id          an integer, searched as entrezgene
+              dis_max     free text
+        '''
+        interval = self._parse_interval_query(q)
+        if interval:
+            return ParsedQuery('interval', q, interval, None)
+        return self._classify_string_query(q)
+
+    def _classify_string_query(self, q):
+        '''classify_query for non-interval queries.'''
+        if q == '__all__':
+            return ParsedQuery('match_all', q, None, None)
+        if self._is_raw_string_query(q):
+            return ParsedQuery('raw_string', q, None, None)
+        if '*' in q or '?' in q:
+            return ParsedQuery('wildcard', q, None, None)
+        # dis_max input: '"' and '\\' are removed, as the former json based
+        # builder did, so query_string still gets the same input.
+        q = q.replace('"', '').replace('\\', '')
         try:
-            _query = json.loads(_query % {'q': q.lower()})
+            return ParsedQuery('id', q, None, int(q))
         except ValueError:
-            raise QueryError("invalid query term.")
+            return ParsedQuery('dis_max', q, None, None)
 
-        return _query
+    def wildcard_query(self, q):
+        '''q should contains either * or ?, but not the first character.'''
+        q = q.lower()
+        if _JSON_UNSAFE_CHARS.search(q):
+            # keep the json string decoding rules of the former
+            # "json.loads(template % q)" implementation for such terms
+            try:
+                q = json.loads('"%s"' % q)
+            except ValueError:
+                raise QueryError("invalid query term.")
+        return _WILDCARD_QUERY(q=q)
 
-    def generate_query(self, q):
+    def generate_query(self, q, parsed=None):
         '''
-        Return query dict according to passed arg "q". Can be:
+        Return query dict according to passed arg "q" (classified by
+        classify_query, unless "parsed" is given). Can be:
             - match query
             - wildcard query
             - raw_string query
             - "match all" query
         Also add query filters
         '''
-        # Check if fielded/boolean query, excluding special goid query
-        # raw_string_query should be checked ahead of wildcard query, as
-        # raw_string may contain wildcard as well # e.g., a query
-        # "symbol:CDK?", should be treated as raw_string_query.
+        if parsed is None:
+            parsed = self._classify_string_query(q)
         if self._is_user_query() and self.user_query(q):
+            metrics.set_query_type('user_query')
             _query = self.user_query(q)
-        elif q == '__all__':
-            _query = {"match_all": {}}
-        elif self._is_raw_string_query(q):
-            #logging.debug("this is raw string query")
-            _query = self.raw_string_query(q)
-        elif self._is_wildcard_query(q):
-            #logging.debug("this is wildcard query")
-            _query = self.wildcard_query(q)
         else:
-            #logging.debug("this is dis max query")
-            _query = self.dis_max_query(q)
+            metrics.set_query_type(parsed.type)
+            if parsed.type == 'match_all':
+                _query = {"match_all": {}}
+            elif parsed.type == 'raw_string':
+                _query = self.raw_string_query(q)
+            elif parsed.type == 'wildcard':
+                _query = self.wildcard_query(q)
+            else:
+                _query = self._dis_max_query(parsed)
 
         _query = self.add_query_filters(_query)
         return _query
@@ -546,9 +1250,8 @@ class ESQueryBuilder(ESQueryBuilder):
             })
 
         if self.userfilter:
-            _uf = UserFilters()
             for _fname in self.userfilter:
-                _filter = _uf.get(_fname)
+                _filter = userfilters.get_filter(_fname)
                 if _filter:
                     filters.append(_filter['filter'])
 
@@ -640,13 +1343,13 @@ class ESQueryBuilder(ESQueryBuilder):
         # some query fields running on ES2
         q = self._translate_datasource(q)
 
-        # Check if special interval query pattern exists
-        interval_query = self._parse_interval_query(q)
-        if interval_query:
+        parsed = self.classify_query(q)
+        if parsed.type == 'interval':
+            metrics.set_query_type('interval')
             # should also passing a "taxid" along with interval.
             if self.species != 'all':
                 self.species = [self.species[0]]  # TODO: where is it used ?
-                _q = self.build_genomic_pos_query(**interval_query)
+                _q = self.build_genomic_pos_query(**parsed.interval)
                 return _q
             else:
                 raise QueryError('genomic interval query cannot be combined ' +
@@ -654,7 +1357,7 @@ class ESQueryBuilder(ESQueryBuilder):
                                  'Specify a single species.')
 
         else:
-            _query = self.generate_query(q)
+            _query = self.generate_query(q, parsed)
             # TODO: this is actually not used, how useful ?
             # _query = self.string_query(q)
 
@@ -778,23 +1481,34 @@ class ESQueryBuilder(ESQueryBuilder):
             if assembly == 'mm9':
                 genomic_pos_field = "genomic_pos_mm9"
 
-        _query = {
-            "nested": {
-                "path": genomic_pos_field,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"term": {
-                                genomic_pos_field + ".chr": chr.lower()}},
-                            {"range": {
-                                genomic_pos_field + ".start": {"lte": gend}}},
-                            {"range": {
-                                genomic_pos_field + ".end": {"gte": gstart}}}
-                        ]
+        _ids = None
+        if self.interval_index is not None and self.species != 'all':
+            _ids = self.interval_index.overlap(self.species[0], genomic_pos_field,
+                                               chr, gstart, gend)
+            if len(_ids) > INTERVAL_INDEX_MAX_IDS:
+                _ids = None
+        if _ids is not None:
+            # overlapping genes found locally, same hits as the nested
+            # query below
+            _query = {"ids": {"values": _ids}}
+        else:
+            _query = {
+                "nested": {
+                    "path": genomic_pos_field,
+                    "query": {
+                        "bool": {
+                            "must": [
+                                {"term": {
+                                    genomic_pos_field + ".chr": chr.lower()}},
+                                {"range": {
+                                    genomic_pos_field + ".start": {"lte": gend}}},
+                                {"range": {
+                                    genomic_pos_field + ".end": {"gte": gstart}}}
+                            ]
+                        }
                     }
                 }
             }
-        }
         # _query = {
         #     'filtered': {
         #         'query': _query,
@@ -813,9 +1527,29 @@ class ESQueryBuilder(ESQueryBuilder):
 # FROM MYGENE.HUB   #
 # ################# #
 
-def get_es(es_host=None):
-    es_host = es_host or ES_HOST
-    es = Elasticsearch(es_host, timeout=600, max_retries=100,retry_on_timeout=True)
+# (pid, role, hosts) -> Elasticsearch, connections aren't shared with
+# forked processes
+_es_clients = {}
+
+
+def get_es_hosts(es_host=None):
+    '''return ES nodes from a comma-separated list (ES_HOST by default).'''
+    return [h.strip() for h in (es_host or ES_HOST).split(',') if h.strip()]
+
+
+def get_es(es_host=None, role='batch'):
+    '''return the ES client of this process for given nodes and role
+       ("api" or "batch"), with timeout, retries and connections per node
+       from ES_CLIENT_PROFILES. Requests are spread over nodes, a failing
+       node is retried after ES_DEAD_TIMEOUT seconds (longer if it keeps
+       failing).
+    '''
+    hosts = tuple(get_es_hosts(es_host))
+    key = (os.getpid(), role, hosts)
+    es = _es_clients.get(key)
+    if es is None:
+        es = _es_clients[key] = Elasticsearch(list(hosts), dead_timeout=ES_DEAD_TIMEOUT,
+                                              **ES_CLIENT_PROFILES[role])
     return es
 
 
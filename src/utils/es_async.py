@@ -1,222 +1,487 @@
-import re
+'''
+Non-blocking counterpart of utils.es.ESQuery, used by API handlers so
+slow ES requests don't block the IOLoop (asyncio-based with tornado >= 5).
+
+ES is queried through its REST API with one AsyncHTTPClient shared by the
+whole process: at most ES_ASYNC_MAX_CLIENTS requests are in flight at the
+same time, others are queued by the client. Requests are spread over ES
+nodes listed in ES_HOST, skipping nodes marked as dead (see _fetch).
+
+Identical read requests sent to ES while one is already in flight (same
+method, url and body) wait for that one instead of being sent again (see
+SingleFlight): a burst of clients asking for the same gene or query
+costs a single ES call.
+'''
 import json
+import asyncio
+import hashlib
+import logging
+from urllib.parse import quote, urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.iostream import StreamClosedError
+from elasticsearch.connection_pool import ConnectionPool
+from elasticsearch.exceptions import (HTTP_EXCEPTIONS, TransportError,
+                                      ConnectionError, ConnectionTimeout,
+                                      NotFoundError)
+
+from biothings.www.api.es import QueryError
+from .es import (ESQuery, ESQueryBuilder, _unique, _INDEX_VERSION_FILTER,
+                 get_es_hosts)
+from .cache import MISSING, LRUCache
+from . import idindex, intervalindex, metrics, serializer, taxonomy, userfilters
+from config import (ES_HOST, ES_INDEX_NAME, ES_INDEX_NAME_TIER1,
+                    ES_SCROLL_SIZE, ES_SCROLL_TIME, ES_ASYNC_MAX_CLIENTS,
+                    ES_CLIENT_PROFILES, ES_DEAD_TIMEOUT,
+                    ES_COALESCE_REQUESTS, ES_COALESCE_STATS_SIZE)
+
+try:
+    import pycurl
+    AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient",
+                              max_clients=ES_ASYNC_MAX_CLIENTS)
+    # curl errors (HTTP 599) telling the ES node doesn't respond, others
+    # (e.g. malformed request) are not the node's fault
+    _NODE_CURL_ERRORS = set([pycurl.E_COULDNT_RESOLVE_HOST,
+                             pycurl.E_COULDNT_CONNECT,
+                             pycurl.E_OPERATION_TIMEDOUT,
+                             pycurl.E_GOT_NOTHING, pycurl.E_SEND_ERROR,
+                             pycurl.E_RECV_ERROR])
+except ImportError:
+    AsyncHTTPClient.configure(None, max_clients=ES_ASYNC_MAX_CLIENTS)
+    _NODE_CURL_ERRORS = set()
+
+
+def get_es_url(es_host=None):
+    es_host = es_host or ES_HOST
+    if "://" not in es_host:
+        es_host = "http://" + es_host
+    return es_host.rstrip("/")
+
+
+class ESNode(object):
+    '''an ES node, as a "connection" of an elasticsearch-py ConnectionPool.'''
+    def __init__(self, url):
+        self.url = url
 
-import tornado.web
-import tornado.httpclient
-tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-import tornadoes
+    def __repr__(self):
+        return "<ESNode: {}>".format(self.url)
+
+
+def get_es_nodes(es_host=None):
+    '''return a ConnectionPool of ES nodes listed in es_host (ES_HOST by
+       default): same node selection and dead nodes handling as ES
+       clients from utils.es.get_es.
+    '''
+    return ConnectionPool([(ESNode(get_es_url(host)), {})
+                           for host in get_es_hosts(es_host)],
+                          dead_timeout=ES_DEAD_TIMEOUT)
+
+
+class SingleFlight(object):
+    '''Run at most one call per key at a time: callers asking for a key
+       already in flight get the result (or exception) of that call.
+       Calls and shared calls are counted per key, for the last
+       "stats_size" keys seen.
+    '''
+    def __init__(self, stats_size=1000):
+        self._inflight = {}
+        self._stats = LRUCache(stats_size)    # key -> [calls, shared]
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, coro_func):
+        self.calls += 1
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = [0, 0]
+            self._stats.set(key, stats)
+        stats[0] += 1
+        future = self._inflight.get(key)
+        if future is not None:
+            self.shared += 1
+            stats[1] += 1
+            # shield: a cancelled waiter must not cancel the shared call
+            return await asyncio.shield(future)
+        future = self._inflight[key] = asyncio.get_event_loop().create_future()
+        try:
+            res = await coro_func()
+        except BaseException as e:
+            future.set_exception(e)
+            # no waiter is fine, don't log "exception never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(res)
+            return res
+        finally:
+            del self._inflight[key]
 
-from utils.es import (ESQuery, ESQueryBuilder,
-                      MGQueryError, ElasticSearchException,
-                      ES_INDEX_NAME_ALL)
-from utils.dotfield import parse_dot_fields
-from config import ES_HOST
+    def stats(self, top=20):
+        keys = sorted(self._stats.items(), key=lambda kv: kv[1][1],
+                      reverse=True)[:top]
+        return {"inflight": len(self._inflight),
+                "calls": self.calls,
+                "shared": self.shared,
+                "top_keys": [{"key": key, "calls": calls, "shared": shared}
+                             for key, (calls, shared) in keys if shared]}
 
 
 class ESQueryAsync(ESQuery):
-    es_connection = tornadoes.ESConnection(ES_HOST.split(':')[0])
-    es_connection.httprequest_kwargs = {'request_timeout': 120.}  # increase default timeout from 20 to 120s
-
-    def _search_async(self, q, species='all', callback=None):
-        self._set_index(species)
-        self.es_connection.search(callback=callback,
-                                  index=self._index,
-                                  type=self._doc_type,
-                                  source=q)
-
-    def _msearch_async(self, q, species='all', callback=None):
-        self._set_index(species)
-        path = '/'.join((self.es_connection.url, self._index, self._doc_type, '_msearch'))
-        request_http = tornadoes.HTTPRequest(path, method="POST", body=q,
-                                             **self.es_connection.httprequest_kwargs)
-        self.es_connection.client.fetch(request=request_http, callback=callback)
-        self._index = ES_INDEX_NAME_ALL     # reset self._index
-
-    def get_gene2(self, geneid, fields='all', **kwargs):
+    '''Coroutines are suffixed with "_async", query building and results
+       cleaning are shared with ESQuery.
+    '''
+    es_nodes = get_es_nodes()
+    single_flight = SingleFlight(ES_COALESCE_STATS_SIZE)
+
+    @classmethod
+    async def _request(cls, path, method="GET", body=None, coalesce=True,
+                       decode=True, **params):
+        '''send a request to ES, return decoded json response (or the
+           response body as a RawJSON if "decode" is False). ES errors
+           are raised as elasticsearch-py exceptions. Unless "coalesce" is
+           False, an identical request already in flight is shared.
+        '''
+        # user values (query string, fields, scroll ids...) are escaped
+        path = "/" + "/".join([quote(str(p), safe=",*") for p in path if p])
+        params = [(k, v) for k, v in sorted(params.items()) if v is not None]
+        if params:
+            path += "?" + urlencode(params)
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body, sort_keys=True)
+        if not (coalesce and ES_COALESCE_REQUESTS):
+            body = await cls._fetch(path, method, body)
+        else:
+            # readable in /metrics, body is hashed
+            key = "{} {} {}".format(method, path,
+                                    hashlib.sha1((body or "").encode("utf-8"))
+                                    .hexdigest())
+            body = await cls.single_flight.do(
+                key, lambda: cls._fetch(path, method, body))
+        if not decode:
+            return serializer.RawJSON(body)
+        # each caller decodes its own copy, results are modified in place
+        # when cleaned
+        return serializer.json_loads(body)
+
+    @classmethod
+    async def _fetch(cls, path, method, body):
+        '''return raw body of ES response, from one of ES nodes. A node
+           not responding (connection error or timeout) is marked as dead,
+           and the request is retried on another one (see "api" profile in
+           ES_CLIENT_PROFILES).
+        '''
+        profile = ES_CLIENT_PROFILES['api']
+        for attempt in range(profile['max_retries'] + 1):
+            node = cls.es_nodes.get_connection()
+            request = HTTPRequest(node.url + path, method=method, body=body,
+                                  headers={"Content-Type": "application/json"},
+                                  request_timeout=profile['timeout'])
+            try:
+                with metrics.timer('es'):
+                    response = await AsyncHTTPClient().fetch(request)
+            except HTTPError as e:
+                if e.code != 599:
+                    info = e.response.body.decode("utf-8") if e.response and e.response.body \
+                        else str(e)
+                    raise HTTP_EXCEPTIONS.get(e.code, TransportError)(e.code, str(e), info)
+                if getattr(e, "errno", None) is not None and \
+                        e.errno not in _NODE_CURL_ERRORS:
+                    # curl error on our side, node is fine
+                    raise TransportError("N/A", str(e), str(e))
+                # timeout, or connection error with curl client
+                error = e
+            except (OSError, StreamClosedError) as e:
+                # connection error with simple client
+                error = e
+            else:
+                cls.es_nodes.mark_live(node)
+                return response.body
+            # no response from this node
+            cls.es_nodes.mark_dead(node)
+            timeout = "time" in str(error).lower()
+            if attempt == profile['max_retries'] or \
+                    (timeout and not profile['retry_on_timeout']):
+                raise (ConnectionTimeout if timeout else ConnectionError)(
+                    "N/A", str(error), str(error))
+
+    async def _search_async(self, q, species='all', decode=True, **params):
+        # raw ES responses are left untouched
+        key = None if 'scroll' in params or not decode \
+            else self._get_facet_cache_key(q, species)
+        version = key and await self._get_data_version_async()
+        q, aggs = self._get_cached_facets(q, key, version)
+        # each scroll search opens its own scroll context
+        res = await self._request([self._get_index(species), self._doc_type, "_search"],
+                                  method="POST", body=q, decode=decode,
+                                  coalesce='scroll' not in params, **params)
+        return self._set_cached_facets(res, key, version, aggs)
+
+    async def _msearch_async(self, q, species='all'):
+        return await self._request([self._get_index(species), self._doc_type, "_msearch"],
+                                   method="POST", body=q)
+
+    async def _mget_async(self, ids, species='all', **params):
+        if "_source" in params:
+            params["_source"] = ",".join(params["_source"])
+        return await self._request([self._get_index(species), self._doc_type, "_mget"],
+                                   method="POST", body={"ids": ids}, **params)
+
+    async def _scroll_async(self, scroll_id, scroll=ES_SCROLL_TIME):
+        # every call moves the scroll forward, never share them
+        return await self._request(["_search", "scroll"], method="POST",
+                                   body=scroll_id, coalesce=False, scroll=scroll)
+
+    async def _clear_scroll_async(self, scroll_id):
+        try:
+            await self._request(["_search", "scroll", scroll_id],
+                                method="DELETE", coalesce=False)
+        except TransportError as e:
+            logging.debug("Can't clear scroll: %s", e)
+
+    async def get_index_version_async(self, index):
+        '''same as ESQuery.get_index_version, without blocking.'''
+        fresh, version = self._get_fresh_index_version(index)
+        if fresh:
+            return version
+        try:
+            mapping = await self._request([index, "_mapping", self._doc_type],
+                                          filter_path=_INDEX_VERSION_FILTER)
+            aliases = None if mapping else \
+                await self._request([index, "_alias"])
+        except Exception as e:
+            logging.warning("Can't get version of index '%s': %s", index, e)
+            return None
+        return self._set_index_version(index, mapping, aliases)
+
+    async def _get_data_version_async(self):
+        '''same as ESQuery._get_data_version, without blocking.'''
+        versions = [await self.get_index_version_async(index) for index in
+                    (ES_INDEX_NAME, ES_INDEX_NAME_TIER1)]
+        if None in versions:
+            return None
+        return "|".join(versions)
+
+    async def _cached_response_async(self, endpoint, q, kwargs, coro):
+        '''same as ESQuery._cached_response, coro being a coroutine
+           function.
+        '''
+        key = self._get_response_cache_key(endpoint, q, kwargs)
+        version = key and await self._get_data_version_async()
+        if not version:
+            return await coro(q, **kwargs)
+        res = self._response_cache.get(key, version)
+        if res is MISSING:
+            res = await coro(q, **kwargs)
+            self._set_cached_response(key, version, res)
+        return res
+
+    async def _prepare_kwargs_async(self, kwargs):
+        '''fetch without blocking what query options need from other
+           services, before options are cleaned and the query is built:
+           species expanded with include_tax_tree (see ESQuery._get_options)
+           and user filters (see ESQueryBuilder.extra_query_filters), which
+           are then cached. Return kwargs.
+        '''
+        if kwargs.pop('include_tax_tree', False):
+            species = self._cleaned_species(kwargs.get('species', None))
+            if species != 'all':
+                kwargs['species'] = await taxonomy.expand_species_async(species)
+        if kwargs.get('userfilter'):
+            for name in kwargs['userfilter'].split(','):
+                if userfilters.get_cached_filter(name) is MISSING:
+                    try:
+                        doc = await self._request([userfilters.ES_INDEX_NAME,
+                                                   userfilters.ES_DOC_TYPE, name])
+                        _filter = doc['_source']
+                    except NotFoundError:
+                        _filter = None
+                    userfilters.set_cached_filter(name, _filter)
+        return kwargs
+
+    async def get_gene_async(self, geneid, **kwargs):
         '''for /gene/<geneid>'''
-        callback = kwargs.pop('callback', None)
-        is_async = callback is not None
+        return await self._cached_response_async("gene", geneid, kwargs,
+                                                 self._get_gene_async)
 
-        options = self._get_cleaned_query_options(fields, kwargs)
-        qbdr = ESQueryBuilder(**options.kwargs)
-        _q = qbdr.build_id_query(geneid, options.scopes)
+    async def _get_gene_async(self, geneid, **kwargs):
+        metrics.set_query_type('id')
+        _id = None
+        if idindex.get_id_index() is not None:
+            version = await self._get_data_version_async()
+            if version:
+                _id = self._get_indexed_id(geneid, kwargs, version)
+        options = self._get_cleaned_annotation_options(await self._prepare_kwargs_async(kwargs))
+        if _id:
+            res = await self._mget_async([_id], species=options.kwargs['species'],
+                                         **self._get_mget_params(options))
+            doc = self._get_mget_resolved([geneid], res, options,
+                                          single_hit=True).get(geneid)
+            if doc is not None:
+                return doc
+            # not a genedoc _id, but may still match an (analyzed) id
+            # field, e.g. a lowercase Ensembl id: search it
+        with metrics.timer('build'):
+            qbdr = ESQueryBuilder(options=options, **options.kwargs)
+            _q = qbdr.build_id_query(geneid, options.scopes)
         if options.rawquery:
-            if is_async:
-                callback(_q)
-                return
-            else:
-                return _q
-        if is_async:
-            def inner_callback(response):
-                res = json.loads(response.body)
-                if not options.raw:
-                    res = self._cleaned_res(res, empty=None, single_hit=True, dotfield=options.dotfield)
-                callback(res)
-            self._search_async(_q, species=options.kwargs['species'], callback=inner_callback)
-            return
-        else:
-            res = self._search(_q)
-            if not options.raw:
-                res = self._cleaned_res(res, empty=None, single_hit=True, dotfield=options.dotfield)
-            return res
+            return _q
+        # raw ES response is returned as is, without decoding
+        res = await self._search_async(_q, species=options.kwargs['species'],
+                                       decode=not options.raw)
+        if not options.raw:
+            res = self._cleaned_res(res, empty=None, single_hit=True, options=options)
+        return res
 
-    def _normalize_msearch_res(self, res, geneid_list, options):
-        assert len(res) == len(geneid_list)
+    def _normalize_msearch_res(self, res, bid_list, options):
+        assert len(res) == len(bid_list)
         _res = []
-        for i in range(len(res)):
-            hits = res[i]
-            qterm = geneid_list[i]
-            hits = self._cleaned_res(hits, empty=[], single_hit=False, dotfield=options.dotfield)
+        for hits, qterm in zip(res, bid_list):
+            if 'error' in hits:
+                _res.append({u'query': qterm, u'error': True})
+                continue
+            hits = self._cleaned_res(hits, empty=[], single_hit=False, options=options)
             if len(hits) == 0:
-                _res.append({u'query': qterm,
-                             u'notfound': True})
-            elif 'error' in hits:
-                _res.append({u'query': qterm,
-                             u'error': True})
+                _res.append({u'query': qterm, u'notfound': True})
             else:
                 for hit in hits:
                     hit[u'query'] = qterm
                     _res.append(hit)
         return _res
 
-    def mget_gene2(self, geneid_list, fields=None, **kwargs):
-        '''for /query post request'''
-        callback = kwargs.pop('callback', None)
-        is_async = callback is not None
+    async def _msearch_genes_async(self, bid_list, options):
+        with metrics.timer('build'):
+            qbdr = ESQueryBuilder(options=options, **options.kwargs)
+            _q = qbdr.build_multiple_id_query(bid_list, options.scopes)
+        if options.rawquery:
+            return _q
+        res = await self._msearch_async(_q, species=options.kwargs['species'])
+        res = res['responses']
+        if options.raw:
+            return res
+        return self._normalize_msearch_res(res, bid_list, options)
 
-        options = self._get_cleaned_query_options(fields, kwargs)
-        qbdr = ESQueryBuilder(**options.kwargs)
+    async def _mget_biothings_async(self, bid_list, options, kwargs):
+        '''see ESQuery.mget_biothings.'''
+        metrics.set_query_type('id')
         try:
-            _q = qbdr.build_multiple_id_query(geneid_list, options.scopes)
-        except MGQueryError as err:
-            res = {'success': False,
-                   'error': err.message}
-            if is_async:
-                callback(res)
-                return
-            else:
-                return res
-        if options.rawquery:
-            if is_async:
-                callback(_q)
-                return
-            else:
-                return _q
-        if is_async:
-            def inner_callback(response):
-                if response.code == 599 and response.body is None:
-                    res = {'success': False,
-                           'error': 'timeout'}
-                else:
-                    res = json.loads(response.body)['responses']
-                    if not options.raw:
-                        res = self._normalize_msearch_res(res, geneid_list, options)
-                callback(res)
-            self._msearch_async(_q, species=kwargs['species'], callback=inner_callback)
-            return
-        else:
-            res = self._msearch(_q, kwargs['species'])['responses']
-            return res if options.raw else self._normalize_msearch_res(res, geneid_list, options)
+            id_index = None
+            if idindex.get_id_index() is not None:
+                version = await self._get_data_version_async()
+                id_index = self._get_current_id_index(version) if version else None
+            candidates = self._get_mget_candidates(bid_list, kwargs, id_index)
+            if not candidates:
+                return await self._msearch_genes_async(bid_list, options)
+            candidates = _unique(candidates)
+            species = options.kwargs.get('species', 'all')
+            res = await self._mget_async([str(bid) for bid in candidates],
+                                         species=species,
+                                         **self._get_mget_params(options))
+            resolved = self._get_mget_resolved(candidates, res, options)
+            residual = _unique([bid for bid in bid_list if bid not in resolved])
+            searched = []
+            if residual:
+                searched = await self._msearch_genes_async(residual, options)
+            return self._stitch_mget_res(bid_list, resolved, searched)
+        except QueryError as err:
+            return {'success': False, 'error': str(err)}
+        except TransportError as err:
+            return {'success': False, 'error': err.error}
 
-    @staticmethod
-    def _normalize_query_res(res, options):
-        if "error" in res:
-            return {'success': False,
-                    'error': "invalid query term."}
-
-        _res = res['hits']
-        _res['took'] = res['took']
-        if "facets" in res:
-            _res['facets'] = res['facets']
-        for v in _res['hits']:
-            del v['_type']
-            del v['_index']
-            for attr in ['fields', '_source']:
-                if attr in v:
-                    v.update(v[attr])
-                    del v[attr]
-                    break
-            if not options.dotfield:
-                parse_dot_fields(v)
-        res = _res
-        return res
+    async def mget_gene_async(self, bid_list, **kwargs):
+        '''for /gene POST, returns all fields by default'''
+        await self._prepare_kwargs_async(kwargs)
+        options = self._get_cleaned_annotation_options(dict(kwargs))
+        return await self._mget_biothings_async(bid_list, options, kwargs)
 
-    def query(self, q, fields=None, **kwargs):
+    async def mget_biothings_async(self, bid_list, **kwargs):
+        '''for /query POST'''
+        await self._prepare_kwargs_async(kwargs)
+        options = self._get_cleaned_query_options(dict(kwargs))
+        return await self._mget_biothings_async(bid_list, options, kwargs)
+
+    async def query_async(self, q, **kwargs):
         '''for /query?q=<query>'''
-        callback = kwargs.pop('callback', None)
-        is_async = callback is not None
-
-        options = self._get_cleaned_query_options(fields, kwargs)
-        qbdr = ESQueryBuilder(**options.kwargs)
-        q = re.sub(u'[\t\n\x0b\x0c\r\x00]+', ' ', q)
-        q = q.strip()
-        _q = None
-        # Check if special interval query pattern exists
-        interval_query = self._parse_interval_query(q)
+        return await self._cached_response_async("query", q, kwargs,
+                                                 self._query_async)
+
+    async def _query_async(self, q, **kwargs):
+        cursor = kwargs.pop('cursor', None)
+        options = self._get_cleaned_query_options(await self._prepare_kwargs_async(kwargs))
+        params = {}
+        if options.kwargs.pop('fetch_all', False) in (True, 1, '1', 'true'):
+            params['scroll'] = ES_SCROLL_TIME
+            options.kwargs['size'] = ES_SCROLL_SIZE
+            cursor = None
+        if intervalindex.get_interval_index() is not None:
+            # so _build_query checks interval index version without blocking
+            await self._get_data_version_async()
         try:
-            if interval_query:
-                #should also passing a "taxid" along with interval.
-                if qbdr.species != 'all':
-                    qbdr.species = [qbdr.species[0]]
-                    _q = qbdr.build_genomic_pos_query(**interval_query)
-                else:
-                    res = {'success': False,
-                           'error': 'genomic interval query cannot be combined with "species=all" parameter. Specify a single species.'}
-                    if is_async:
-                        callback(res)
-                        return
-                    else:
-                        return res
-
-            # Check if fielded/boolean query, excluding special goid query
-            # raw_string_query should be checked ahead of wildcard query, as raw_string may contain wildcard as well
-            # e.g., a query "symbol:CDK?", should be treated as raw_string_query.
-            elif self._is_raw_string_query(q) and not q.lower().startswith('go:'):
-                _q = qbdr.build(q, mode=3)   # raw string query
-            elif self._is_wildcard_query(q):
-                _q = qbdr.build(q, mode=2)   # wildcard query
-            else:
-            # normal text query
-                _q = qbdr.build(q, mode=1)
-        except MGQueryError as err:
-            res = {'success': False,
-                   'error': err.message}
-            if is_async:
-                callback(res)
-                return
+            if cursor:
+                _q = self._build_cursor_query(q, cursor, options)
             else:
-                return res
+                _q = self._build_query(q, options=options, **options.kwargs)
+        except QueryError as err:
+            return {'success': False, 'error': str(err)}
+        if options.rawquery:
+            return _q
+        try:
+            res = await self._search_async(_q, species=options.kwargs['species'],
+                                           decode=not options.raw, **params)
+        except TransportError as err:
+            return {'success': False,
+                    'error': err.info if options.raw else "invalid query term."}
+        if options.raw:
+            return res
+        if cursor:
+            cursor = self._get_next_cursor(_q, res)
+            res = self._cleaned_query_res(res, options)
+            res['cursor'] = cursor
+            return res
+        return self._cleaned_query_res(res, options)
 
-        if _q:
-            if options.rawquery:
-                if is_async:
-                    callback(_q)
-                    return
+    async def stream_async(self, q, **kwargs):
+        '''for /query?q=<query>&stream=true: async generator of all hits
+           of a query, in batches of ES_SCROLL_SIZE hits (cleaned unless
+           raw). Next batch is only fetched from ES once the caller asks
+           for it, and the scroll is cleared when the generator is closed.
+        '''
+        options = self._get_cleaned_query_options(await self._prepare_kwargs_async(kwargs))
+        options.kwargs.pop('fetch_all', None)
+        options.kwargs['size'] = ES_SCROLL_SIZE
+        if intervalindex.get_interval_index() is not None:
+            await self._get_data_version_async()
+        _q = self._build_query(q, options=options, **options.kwargs)
+        if options.rawquery:
+            yield [_q]
+            return
+        # facets are not exported, hits in index order unless sorted
+        # by the user is the cheapest to scroll
+        _q.pop('aggs', None)
+        _q.setdefault('sort', ['_doc'])
+        res = await self._search_async(_q, species=options.kwargs['species'],
+                                       scroll=ES_SCROLL_TIME)
+        try:
+            while res['hits']['hits']:
+                if options.raw:
+                    yield res['hits']['hits']
                 else:
-                    return _q
-
-            if is_async:
-                def inner_callback(response):
-                    res = json.loads(response.body)
-                    if not options.raw:
-                        res = self._normalize_query_res(res, options)
-                    callback(res)
-                self._search_async(_q, species=kwargs['species'], callback=inner_callback)
-                return
-            else:
-                try:
-                    res = self._search(_q, species=kwargs['species'])
-                    if not options.raw:
-                        res = self._normalize_query_res(res, options)
-                except ElasticSearchException as err:
-                    err_msg = err.message if options.raw else "invalid query term."
-                    res = {'success': False,
-                           'error': err_msg}
-        else:
-            res = {'success': False, 'error': "Invalid query. Please check parameters."}
+                    yield self._cleaned_res({'hits': res['hits']}, empty=[],
+                                            single_hit=False, options=options)
+                res = await self._scroll_async(res['_scroll_id'])
+        finally:
+            if res.get('_scroll_id'):
+                await self._clear_scroll_async(res['_scroll_id'])
 
-        if is_async:
-            callback(res)
-            return
-        else:
+    async def scroll_async(self, scroll_id, **kwargs):
+        '''next batch of a fetch_all query, until no more hits.'''
+        options = self._get_cleaned_query_options(await self._prepare_kwargs_async(kwargs))
+        try:
+            res = await self._scroll_async(scroll_id)
+        except TransportError:
+            return {'success': False,
+                    'error': 'Invalid or stale scroll_id.'}
+        if options.raw:
             return res
+        if not res['hits']['hits']:
+            return {'success': False, 'error': 'No results to return.'}
+        return self._cleaned_query_res(res, options)
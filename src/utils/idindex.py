@@ -0,0 +1,178 @@
+'''
+Gene identifier index: maps entrezgene, retired and Ensembl gene ids to
+genedoc _ids, so /gene/<id> can fetch the genedoc by _id instead of
+searching id fields.
+
+Only ids which are not the _id of their own genedoc are stored (most
+entrezgene ids are), so a missing id is looked up as an _id, then searched
+if there's no such genedoc (ids matched by analyzed fields only). An id
+mapped to several genedocs is stored too, callers then fall back to a
+search to keep ES ordering.
+
+The index is built at deploy time from the merged genedoc collection,
+once the new ES index is live:
+
+    python -m utils.idindex <genedoc collection> [<output file>]
+
+It's stamped with the ES data version (see ESQuery._get_data_version) and
+stored as a sorted, memory-mapped file, looked up by binary search. A
+new file is renamed over the previous one, and picked up (swapped) by API
+processes on next check.
+'''
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+
+from config import ID_INDEX_PATH, INDEX_VERSION_CHECK_INTERVAL
+
+_MAGIC = b'MGIDXv1\n'
+_OFFSET = struct.Struct('<Q')
+
+
+def get_gene_ids(doc):
+    '''return ids (as strings) a genedoc can be looked up by.'''
+    ids = []
+    if 'entrezgene' in doc:
+        ids.append(doc['entrezgene'])
+    retired = doc.get('retired', [])
+    ids.extend(retired if isinstance(retired, list) else [retired])
+    ensembl = doc.get('ensembl', [])
+    for e in (ensembl if isinstance(ensembl, list) else [ensembl]):
+        if 'gene' in e:
+            ids.append(e['gene'])
+    return [str(x) for x in ids]
+
+
+class IdIndex(object):
+    '''Read-only sorted id -> _ids mapping, memory-mapped from "path".
+       File layout: magic, version (length-prefixed), number of entries,
+       offsets of entries, then entries as b"<id>\\t<_id>[,<_id>...]".
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("'{}' is not an id index file".format(path))
+        pos = len(_MAGIC)
+        vlen = _OFFSET.unpack_from(self._mm, pos)[0]
+        pos += _OFFSET.size
+        self.version = self._mm[pos:pos + vlen].decode('utf-8')
+        pos += vlen
+        self._n = _OFFSET.unpack_from(self._mm, pos)[0]
+        self._offsets = pos + _OFFSET.size
+        self._data = self._offsets + (self._n + 1) * _OFFSET.size
+
+    @staticmethod
+    def build(path, docs, version):
+        '''build index file from genedocs (with _id, entrezgene, retired
+           and ensembl.gene fields).
+        '''
+        mapping = {}
+        for doc in docs:
+            _id = str(doc['_id'])
+            for gid in get_gene_ids(doc):
+                mapping.setdefault(gid, set()).add(_id)
+        entries = []
+        for gid in sorted(mapping):
+            _ids = mapping[gid]
+            if _ids != set([gid]):
+                entries.append("{}\t{}".format(gid, ",".join(sorted(_ids))).encode('utf-8'))
+        version = version.encode('utf-8')
+        tmpfile = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(_OFFSET.pack(len(version)))
+            f.write(version)
+            f.write(_OFFSET.pack(len(entries)))
+            offset = 0
+            for entry in entries:
+                f.write(_OFFSET.pack(offset))
+                offset += len(entry)
+            f.write(_OFFSET.pack(offset))
+            for entry in entries:
+                f.write(entry)
+        # readers keep their mmap of the previous file
+        os.rename(tmpfile, path)
+        return len(entries)
+
+    def __len__(self):
+        return self._n
+
+    def _entry(self, i):
+        start, end = struct.unpack_from('<QQ', self._mm, self._offsets + i * _OFFSET.size)
+        return self._mm[self._data + start:self._data + end]
+
+    def get(self, gid):
+        '''return the list of _ids for gene id "gid" (as a string).'''
+        key = gid.encode('utf-8') + b'\t'
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if entry[:len(key)] == key:
+                return entry[len(key):].decode('utf-8').split(',')
+            if entry < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return [gid]
+
+    def is_current(self):
+        '''True if file at self.path is still the one mapped.'''
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime) == (self._stat.st_ino, self._stat.st_mtime)
+
+    def close(self):
+        self._mm.close()
+
+
+_id_index = None
+_last_check = 0
+
+
+def get_id_index():
+    '''return IdIndex loaded from ID_INDEX_PATH, None if not available.
+       The file is checked for a new version every
+       INDEX_VERSION_CHECK_INTERVAL seconds.
+    '''
+    global _id_index, _last_check
+    if not ID_INDEX_PATH or time.time() - _last_check < INDEX_VERSION_CHECK_INTERVAL:
+        return _id_index
+    _last_check = time.time()
+    if _id_index is None or not _id_index.is_current():
+        try:
+            idx = IdIndex(ID_INDEX_PATH)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning("Can't load id index '%s': %s", ID_INDEX_PATH, e)
+            idx = None
+        # old mmap is left to garbage collection, requests being served
+        # may still use it
+        _id_index = idx
+    return _id_index
+
+
+def main():
+    from utils.mongo import get_target_db, doc_feeder
+    from utils.es import ESQuery
+    collection = get_target_db()[sys.argv[1]]
+    path = sys.argv[2] if len(sys.argv) > 2 else ID_INDEX_PATH
+    version = ESQuery()._get_data_version()
+    if not version:
+        sys.exit("Can't get ES data version")
+    docs = doc_feeder(collection, step=10000,
+                      fields=['entrezgene', 'retired', 'ensembl.gene'])
+    n = IdIndex.build(path, docs, version)
+    print("{} ids saved in '{}' (version {})".format(n, path, version))
+
+
+if __name__ == '__main__':
+    main()
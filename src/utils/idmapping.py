@@ -0,0 +1,159 @@
+'''
+Compact, memory-mapped id mappings for the data builder (ensembl gene to
+entrez gene ids, root gene ids...), replacing dicts and sets of millions
+of ids: a file is opened read-only without deserializing, and shared
+through the page cache by all processes using it (merge workers).
+
+File layout: magic, key width, number of keys, value width, number of
+values, then keys (sorted, fixed width, null-padded), offsets of each
+key values (uint32), and values (fixed width, null-padded). A key is
+looked up by binary search on the first key of each block of _BLOCK keys
+(kept in memory), then within its block. A file without values is a set
+of ids.
+
+Mappings built from source data (see IdMapping.open_stored) are stored
+once per version of that data, and opened as is by following builds.
+'''
+import os
+import mmap
+import tempfile
+import bisect
+import struct
+
+_MAGIC = b'MGIDMv1\n'
+_HEADER = struct.Struct('<QQQQ')
+_OFFSET = struct.Struct('<I')
+_BLOCK = 128
+
+
+def _pad(s, width):
+    return s.encode('utf-8').ljust(width, b'\0')
+
+
+class IdMapping(object):
+    '''Read-only sorted mapping of ids (as strings) to one or more ids,
+       memory-mapped from "path". get() returns a string for one value,
+       a list for several ones, as utils.dataload.list2dict does.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("'{}' is not an id mapping file".format(path))
+        pos = len(_MAGIC)
+        self._kwidth, self._n, self._vwidth, nvalues = _HEADER.unpack_from(self._mm, pos)
+        self._keys = pos + _HEADER.size
+        self._offsets = self._keys + self._n * self._kwidth
+        self._values = self._offsets + (self._n + 1) * _OFFSET.size
+        self._fences = [self._key(i) for i in range(0, self._n, _BLOCK)]
+
+    @staticmethod
+    def build(path, items):
+        '''build mapping file from (id, value or list of values) items,
+           or from ids for a set. Return the number of ids.
+        '''
+        items = sorted((str(k), [] if v is None else
+                        [str(x) for x in (v if isinstance(v, (list, tuple)) else [v])])
+                       for k, v in (x if isinstance(x, tuple) else (x, None) for x in items))
+        # duplicated ids (a set built from a list) are kept once
+        items = [item for i, item in enumerate(items) if i == 0 or item[0] != items[i - 1][0]]
+        kwidth = max([len(k.encode('utf-8')) for k, _ in items] or [0])
+        vwidth = max([len(x.encode('utf-8')) for _, v in items for x in v] or [0])
+        nvalues = sum(len(v) for _, v in items)
+        tmpfile = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(_HEADER.pack(kwidth, len(items), vwidth, nvalues))
+            f.writelines(_pad(k, kwidth) for k, _ in items)
+            offset = 0
+            for _, v in items:
+                f.write(_OFFSET.pack(offset))
+                offset += len(v)
+            f.write(_OFFSET.pack(offset))
+            f.writelines(_pad(x, vwidth) for _, v in items for x in v)
+        os.rename(tmpfile, path)
+        return len(items)
+
+    @classmethod
+    def open_stored(cls, folder, name, versions, items):
+        '''return mapping "name" stored in folder (system temp folder if
+           None) for given versions (strings) of the data it's built from,
+           building it from items() (see build) only if it's not stored
+           yet. Files of other versions are removed, processes using them
+           keep their mapping.
+        '''
+        folder = folder or tempfile.gettempdir()
+        filename = "{}.{}.idm".format(name, ".".join(versions))
+        path = os.path.join(folder, filename)
+        if not os.path.exists(path):
+            cls.build(path, items())
+            for fn in os.listdir(folder):
+                if fn.startswith(name + ".") and fn.endswith(".idm") and fn != filename:
+                    try:
+                        os.remove(os.path.join(folder, fn))
+                    except OSError:
+                        pass
+        return cls(path)
+
+    def __len__(self):
+        return self._n
+
+    def _key(self, i):
+        start = self._keys + i * self._kwidth
+        return self._mm[start:start + self._kwidth]
+
+    def _index(self, key):
+        '''position of key, -1 if missing.'''
+        key = str(key).encode('utf-8')
+        if len(key) > self._kwidth:
+            return -1
+        key = key.ljust(self._kwidth, b'\0')
+        block = bisect.bisect_right(self._fences, key) - 1
+        if block < 0:
+            return -1
+        first = block * _BLOCK
+        w = self._kwidth
+        start = self._keys + first * w
+        end = start + min(_BLOCK, self._n - first) * w
+        pos = self._mm.find(key, start, end)
+        # a match across two keys isn't one
+        while pos != -1 and (pos - start) % w:
+            pos = self._mm.find(key, pos + 1, end)
+        return -1 if pos == -1 else first + (pos - start) // w
+
+    def _get_values(self, i):
+        start, end = struct.unpack_from('<II', self._mm, self._offsets + i * _OFFSET.size)
+        w = self._vwidth
+        pos = self._values + start * w
+        return [self._mm[pos + j * w:pos + (j + 1) * w].rstrip(b'\0').decode('utf-8')
+                for j in range(end - start)]
+
+    def __contains__(self, key):
+        return self._index(key) != -1
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        if i == -1:
+            return default
+        values = self._get_values(i)
+        return values[0] if len(values) == 1 else values
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self._key(i).rstrip(b'\0').decode('utf-8')
+
+    def items(self):
+        for i, key in enumerate(self):
+            values = self._get_values(i)
+            yield key, values[0] if len(values) == 1 else values
+
+    def close(self):
+        self._mm.close()
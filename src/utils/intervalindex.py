@@ -0,0 +1,197 @@
+'''
+Genomic interval index: for each species, assembly field (genomic_pos,
+genomic_pos_hg19, genomic_pos_mm9) and chromosome, gene positions sorted
+by start, with the length of the longest gene. Genes overlapping an
+interval are then found by binary search, instead of the nested range
+queries ES runs for "chrX:start-end" queries.
+
+Built at deploy time from the merged genedoc collection, once the new
+ES index is live:
+
+    python -m utils.intervalindex <genedoc collection> [<output file>]
+
+Like the id index (see utils/idindex.py), it's stamped with the ES data
+version, memory-mapped, and swapped when a new file is renamed over it.
+'''
+import os
+import sys
+import mmap
+import json
+import time
+import struct
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+
+from config import INTERVAL_INDEX_PATH, INDEX_VERSION_CHECK_INTERVAL
+
+_MAGIC = b'MGIVXv1\n'
+_LEN = struct.Struct('<Q')
+POS_FIELDS = ['genomic_pos', 'genomic_pos_hg19', 'genomic_pos_mm9']
+
+
+def get_gene_positions(doc, field):
+    '''yield (chr, start, end) of a genedoc for given genomic_pos field.'''
+    pos = doc.get(field, [])
+    for p in (pos if isinstance(pos, list) else [pos]):
+        try:
+            yield str(p['chr']).lower(), int(p['start']), int(p['end'])
+        except (KeyError, TypeError, ValueError):
+            continue
+
+
+class IntervalIndex(object):
+    '''Read-only interval index memory-mapped from "path". File layout:
+       magic, version and json header (length-prefixed), then int64
+       arrays: _id offsets, and per group (taxid/field/chr) starts, ends
+       and _id numbers; finally _id strings.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("'{}' is not an interval index file".format(path))
+        pos = len(_MAGIC)
+        chunks = []
+        for _ in range(2):
+            n = _LEN.unpack_from(self._mm, pos)[0]
+            chunks.append(self._mm[pos + _LEN.size:pos + _LEN.size + n].decode('utf-8'))
+            pos += _LEN.size + n
+        self.version = chunks[0]
+        header = json.loads(chunks[1])
+        # int64 arrays start 8-bytes aligned
+        self._arrays = memoryview(self._mm)[header['arrays']:header['ids']].cast('q')
+        self._ids = header['ids']
+        self._n_ids = header['n_ids']
+        self._groups = header['groups']
+
+    @staticmethod
+    def build(path, docs, version):
+        '''build index file from genedocs (with _id, taxid and genomic_pos
+           fields).
+        '''
+        groups = {}
+        ids = []
+        for doc in docs:
+            n = None
+            for field in POS_FIELDS:
+                for chr, start, end in get_gene_positions(doc, field):
+                    if n is None:
+                        n = len(ids)
+                        ids.append(str(doc['_id']).encode('utf-8'))
+                    key = "{}:{}:{}".format(doc.get('taxid'), field, chr)
+                    groups.setdefault(key, []).append((start, end, n))
+        id_offsets = array('q', [0])
+        for _id in ids:
+            id_offsets.append(id_offsets[-1] + len(_id))
+        arrays = [id_offsets]
+        header = {'groups': {}, 'n_ids': len(ids)}
+        offset = len(id_offsets)
+        for key, genes in groups.items():
+            genes.sort()
+            max_len = max([end - start for start, end, _ in genes])
+            header['groups'][key] = [offset, len(genes), max_len]
+            for i in range(3):
+                arrays.append(array('q', [g[i] for g in genes]))
+            offset += 3 * len(genes)
+        version = version.encode('utf-8')
+        # header size depends on arrays position, which depends on header
+        # size: leave room for it
+        header['arrays'] = header['ids'] = 0
+        base = len(_MAGIC) + 2 * _LEN.size + len(version) + \
+            len(json.dumps(header).encode('utf-8')) + 64
+        header['arrays'] = base + (-base % 8)
+        header['ids'] = header['arrays'] + offset * 8
+        _header = json.dumps(header).encode('utf-8')
+        tmpfile = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(_MAGIC)
+            for chunk in (version, _header):
+                f.write(_LEN.pack(len(chunk)))
+                f.write(chunk)
+            f.write(b'\0' * (header['arrays'] - f.tell()))
+            for arr in arrays:
+                arr.tofile(f)
+            for _id in ids:
+                f.write(_id)
+        os.rename(tmpfile, path)
+        return len(ids)
+
+    def _get_id(self, n):
+        start, end = self._arrays[n], self._arrays[n + 1]
+        return self._mm[self._ids + start:self._ids + end].decode('utf-8')
+
+    def overlap(self, taxid, field, chr, gstart, gend):
+        '''return _ids of genes of given species overlapping [gstart, gend]
+           on chr, for given genomic_pos field, sorted by start position.
+        '''
+        group = self._groups.get("{}:{}:{}".format(taxid, field, chr.lower()))
+        if not group:
+            return []
+        offset, n, max_len = group
+        starts = self._arrays[offset:offset + n]
+        ends = self._arrays[offset + n:offset + 2 * n]
+        nums = self._arrays[offset + 2 * n:offset + 3 * n]
+        # genes can't start before gstart - max_len and overlap
+        lo = bisect_left(starts, gstart - max_len)
+        hi = bisect_right(starts, gend)
+        _ids = []
+        seen = set()
+        for i in range(lo, hi):
+            if ends[i] >= gstart and nums[i] not in seen:
+                seen.add(nums[i])
+                _ids.append(self._get_id(nums[i]))
+        return _ids
+
+    def is_current(self):
+        '''True if file at self.path is still the one mapped.'''
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime) == (self._stat.st_ino, self._stat.st_mtime)
+
+
+_interval_index = None
+_last_check = 0
+
+
+def get_interval_index():
+    '''return IntervalIndex loaded from INTERVAL_INDEX_PATH, None if not
+       available. The file is checked for a new version every
+       INDEX_VERSION_CHECK_INTERVAL seconds.
+    '''
+    global _interval_index, _last_check
+    if not INTERVAL_INDEX_PATH or \
+            time.time() - _last_check < INDEX_VERSION_CHECK_INTERVAL:
+        return _interval_index
+    _last_check = time.time()
+    if _interval_index is None or not _interval_index.is_current():
+        try:
+            idx = IntervalIndex(INTERVAL_INDEX_PATH)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning("Can't load interval index '%s': %s",
+                            INTERVAL_INDEX_PATH, e)
+            idx = None
+        _interval_index = idx
+    return _interval_index
+
+
+def main():
+    from utils.mongo import get_target_db, doc_feeder
+    from utils.es import ESQuery
+    collection = get_target_db()[sys.argv[1]]
+    path = sys.argv[2] if len(sys.argv) > 2 else INTERVAL_INDEX_PATH
+    version = ESQuery()._get_data_version()
+    if not version:
+        sys.exit("Can't get ES data version")
+    docs = doc_feeder(collection, step=10000, fields=['taxid'] + POS_FIELDS)
+    n = IntervalIndex.build(path, docs, version)
+    print("{} genes saved in '{}' (version {})".format(n, path, version))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+'''
+Per-phase latency metrics for API requests.
+
+A request is timed from handler prepare() to on_finish(), and split into
+phases (params, build, es, clean, serialize) with:
+
+    with metrics.timer('build'):
+        ...
+
+Timings are aggregated into histograms per endpoint, query type
+(dis_max, wildcard, raw_string, interval, id...) and phase, exposed by
+/metrics. The current request is tracked with a context variable, so
+concurrent coroutines each record their own timings.
+'''
+import time
+import bisect
+from contextvars import ContextVar
+
+from config import METRICS_ENABLED
+
+# histogram upper bounds, in ms (last bucket is everything above)
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+           1000, 2500, 5000, 10000, 30000]
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+
+    def percentile(self, p):
+        '''upper bound of the bucket containing the p-th percentile.'''
+        rank = self.count * p / 100.
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return 0
+
+    def stats(self):
+        return {"count": self.count,
+                "sum_ms": round(self.sum, 3),
+                "mean_ms": round(self.sum / self.count, 3) if self.count else 0,
+                "p50_ms": self.percentile(50),
+                "p90_ms": self.percentile(90),
+                "p99_ms": self.percentile(99),
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+inf"],
+                                    self.counts))}
+
+
+class RequestTimings(object):
+    '''phases durations (in seconds) of the current request.'''
+    __slots__ = ('endpoint', 'query_type', 'phases', 'start')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.query_type = None
+        self.phases = {}
+        self.start = time.perf_counter()
+
+
+class _Timer(object):
+    __slots__ = ('phase', 'timings', 't0')
+
+    def __init__(self, phase, timings):
+        self.phase = phase
+        self.timings = timings
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        phases = self.timings.phases
+        phases[self.phase] = phases.get(self.phase, 0.) + time.perf_counter() - self.t0
+
+
+class _NoTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_no_timer = _NoTimer()
+_current = ContextVar('request_timings', default=None)
+# (endpoint, query type, phase) -> Histogram
+_histograms = {}
+
+
+def start_request(endpoint):
+    if METRICS_ENABLED:
+        _current.set(RequestTimings(endpoint))
+
+
+def set_query_type(query_type):
+    '''set query type of current request, first one set wins (an id
+       query may run a dis_max query for instance).
+    '''
+    timings = _current.get()
+    if timings is not None and timings.query_type is None:
+        timings.query_type = query_type
+
+
+def get_query_type():
+    '''query type of current request, None if not set (or outside a request).'''
+    timings = _current.get()
+    return timings.query_type if timings is not None else None
+
+
+def timer(phase):
+    '''context manager adding elapsed time to given phase of current
+       request (no-op when metrics are disabled or outside a request).
+    '''
+    timings = _current.get()
+    if timings is None:
+        return _no_timer
+    return _Timer(phase, timings)
+
+
+def finish_request():
+    '''record current request timings into histograms.'''
+    timings = _current.get()
+    if timings is None:
+        return
+    _current.set(None)
+    timings.phases['total'] = time.perf_counter() - timings.start
+    key = (timings.endpoint, timings.query_type or 'other')
+    for phase, seconds in timings.phases.items():
+        hist = _histograms.get(key + (phase,))
+        if hist is None:
+            hist = _histograms[key + (phase,)] = Histogram()
+        hist.observe(seconds * 1000)
+
+
+def get_metrics():
+    '''return {endpoint: {query type: {phase: stats}}}'''
+    res = {}
+    for (endpoint, query_type, phase), hist in sorted(_histograms.items()):
+        res.setdefault(endpoint, {}).setdefault(query_type, {})[phase] = hist.stats()
+    return res
+
+
+def reset():
+    _histograms.clear()
@@ -0,0 +1,190 @@
+'''
+Cost estimate of /query ES bodies, checked before they are sent to ES
+(see ESQuery._build_query).
+
+The cost is a sum of weighted components, roughly proportional to the
+work ES does for the query:
+
+    clauses     each query/filter clause
+    wildcards   wildcard, prefix or regexp clauses, and wildcard terms of
+                query_string queries (much more for a leading wildcard,
+                which scans the whole terms dictionary)
+    terms       values of terms/ids clauses (e.g. species of an expanded
+                taxonomy tree)
+    nested      nested clauses (genomic interval queries)
+    size        hits to fetch and sort (from + size)
+    aggs        aggregations and their number of buckets
+
+A body costing more than QUERY_COST_LIMIT is rejected with a QueryError,
+one costing more than QUERY_COST_SOFT_LIMIT is downgraded: ES stops
+searching after QUERY_COST_SOFT_TIMEOUT and returns the hits found so far
+("timed_out" set in raw responses). Costs are reported on /metrics.
+'''
+import re
+import bisect
+
+from biothings.www.api.es import QueryError
+
+from config import QUERY_COST_LIMIT, QUERY_COST_SOFT_LIMIT, QUERY_COST_SOFT_TIMEOUT
+from . import metrics
+
+WEIGHTS = {
+    'clause': 1,
+    'query_string_clause': 2,
+    'wildcard': 5,
+    'leading_wildcard': 50,
+    'regexp': 20,
+    'nested': 10,
+    'terms_per_100': 1,
+    'size_per_100': 1,
+    'agg': 5,
+    'agg_size_per_100': 1,
+}
+
+# query_string terms: fielded or not, quoted or not
+_QUERY_STRING_TERM = re.compile(r'(?:[^\s:()"]+:)?(?:"[^"]*"|[^\s()"]+)')
+_QUERY_STRING_OPERATORS = set(['AND', 'OR', 'NOT', '&&', '||', '!'])
+# clauses whose value isn't made of sub-clauses
+_LEAF_CLAUSES = set(['match', 'match_phrase', 'match_phrase_prefix', 'multi_match',
+                     'term', 'range', 'exists', 'missing', 'match_all', 'type'])
+
+# cost histogram upper bounds (last bucket is everything above)
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def _is_leading_wildcard(term):
+    return term[:1] in ('*', '?')
+
+
+def _query_string_cost(query, costs):
+    for term in _QUERY_STRING_TERM.findall(query):
+        if term in _QUERY_STRING_OPERATORS:
+            continue
+        costs['clauses'] += WEIGHTS['query_string_clause']
+        value = term.split(':', 1)[-1] if not term.startswith('"') else term
+        if value.startswith('"'):
+            continue
+        if _is_leading_wildcard(value):
+            costs['wildcards'] += WEIGHTS['leading_wildcard']
+        elif '*' in value or '?' in value:
+            costs['wildcards'] += WEIGHTS['wildcard']
+
+
+def _clause_cost(clause, costs):
+    '''add costs of a query/filter clause (dict, or list of clauses).'''
+    if isinstance(clause, list):
+        for c in clause:
+            _clause_cost(c, costs)
+        return
+    if not isinstance(clause, dict):
+        return
+    for name, value in clause.items():
+        if name in ('query', 'filter', 'must', 'should', 'must_not', 'queries',
+                    'and', 'or', 'not', 'filters', 'functions'):
+            # bool/filtered/dis_max/function_score parts
+            _clause_cost(value, costs)
+            continue
+        if not isinstance(value, (dict, list)):
+            continue
+        costs['clauses'] += WEIGHTS['clause']
+        if name == 'query_string':
+            _query_string_cost(str(value.get('query', '')), costs)
+        elif name in ('wildcard', 'prefix', 'regexp'):
+            for v in value.values():
+                v = v.get('value', '') if isinstance(v, dict) else v
+                if name == 'regexp':
+                    costs['wildcards'] += WEIGHTS['regexp']
+                elif name == 'wildcard' and _is_leading_wildcard(str(v)):
+                    costs['wildcards'] += WEIGHTS['leading_wildcard']
+                else:
+                    costs['wildcards'] += WEIGHTS['wildcard']
+        elif name in ('terms', 'ids'):
+            n = sum(len(v) for v in value.values() if isinstance(v, list))
+            costs['terms'] += WEIGHTS['terms_per_100'] * n / 100.
+        elif name == 'nested':
+            costs['nested'] += WEIGHTS['nested']
+            _clause_cost(value.get('query', value.get('filter')), costs)
+        elif name not in _LEAF_CLAUSES:
+            # bool, filtered, dis_max, function_score, constant_score...
+            _clause_cost(value, costs)
+
+
+def _to_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def estimate(_q):
+    '''return {component: cost} of ES body _q, with the "total" cost.'''
+    costs = dict.fromkeys(['clauses', 'wildcards', 'terms', 'nested', 'size', 'aggs'], 0)
+    _clause_cost(_q.get('query'), costs)
+    _clause_cost(_q.get('filter'), costs)
+    size = _to_int(_q.get('from'), 0) + _to_int(_q.get('size'), 10)
+    costs['size'] = WEIGHTS['size_per_100'] * size / 100.
+    for agg in (_q.get('aggs') or {}).values():
+        costs['aggs'] += WEIGHTS['agg']
+        for body in agg.values():
+            if isinstance(body, dict):
+                costs['aggs'] += WEIGHTS['agg_size_per_100'] * _to_int(body.get('size'), 10) / 100.
+    costs = dict((k, round(v, 2)) for k, v in costs.items())
+    costs['total'] = round(sum(costs.values()), 2)
+    return costs
+
+
+class CostStats(object):
+    '''costs of checked bodies, per query type.'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.by_type = {}
+        self.components = {}
+        self.downgraded = 0
+        self.rejected = 0
+
+    def observe(self, query_type, costs):
+        total = costs['total']
+        self.counts[bisect.bisect_left(BUCKETS, total)] += 1
+        stats = self.by_type.setdefault(query_type, {"count": 0, "sum": 0., "max": 0.})
+        stats['count'] += 1
+        stats['sum'] += total
+        stats['max'] = max(stats['max'], total)
+        for k, v in costs.items():
+            if k != 'total':
+                self.components[k] = self.components.get(k, 0.) + v
+
+    def stats(self):
+        return {"limit": QUERY_COST_LIMIT, "soft_limit": QUERY_COST_SOFT_LIMIT,
+                "downgraded": self.downgraded, "rejected": self.rejected,
+                "by_query_type": dict((t, {"count": s['count'], "max": s['max'],
+                                           "mean": round(s['sum'] / s['count'], 2)})
+                                      for t, s in self.by_type.items()),
+                "components": dict((k, round(v, 2)) for k, v in self.components.items()),
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+inf"], self.counts))}
+
+
+_stats = CostStats()
+
+
+def check(_q):
+    '''raise QueryError if ES body _q costs more than QUERY_COST_LIMIT, set
+       a search timeout if it costs more than QUERY_COST_SOFT_LIMIT.
+       Return the estimated costs.
+    '''
+    costs = estimate(_q)
+    _stats.observe(metrics.get_query_type() or 'other', costs)
+    total = costs['total']
+    if QUERY_COST_LIMIT and total > QUERY_COST_LIMIT:
+        _stats.rejected += 1
+        raise QueryError("Query too expensive (cost {} over {}): use fewer "
+                         "wildcards, clauses or species, or a smaller size.".format(
+                             total, QUERY_COST_LIMIT))
+    if QUERY_COST_SOFT_LIMIT and total > QUERY_COST_SOFT_LIMIT:
+        _stats.downgraded += 1
+        _q.setdefault('timeout', QUERY_COST_SOFT_TIMEOUT)
+    return costs
+
+
+def get_stats():
+    return _stats.stats()
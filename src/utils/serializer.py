@@ -0,0 +1,62 @@
+'''
+JSON and msgpack encoding of API responses, and decoding of ES responses.
+
+orjson is used when installed (several times faster than json module on
+big responses, and decodes bytes without an intermediate str), msgpack
+for "msgpack=true" requests. Both are optional:
+
+    pip install orjson msgpack-python
+
+A response can also be given as RawJSON, bytes already json-encoded (an
+ES response returned as is for "raw=1" requests), written without being
+decoded and encoded again.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class RawJSON(bytes):
+    '''json-encoded response, written as is.'''
+
+
+def json_loads(s):
+    '''decode json from bytes or str.'''
+    if orjson is not None:
+        return orjson.loads(s)
+    if isinstance(s, bytes):
+        s = s.decode('utf-8')
+    return json.loads(s)
+
+
+def json_dumps(data, indent=None):
+    '''return data json-encoded, as utf-8 bytes.'''
+    if isinstance(data, RawJSON):
+        return bytes(data)
+    # orjson only indents with 2 spaces, and rejects integers over 64 bits
+    if orjson is not None and indent in (None, 2):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(data, option=option)
+        except TypeError:
+            pass
+    return json.dumps(data, indent=indent).encode('utf-8')
+
+
+def msgpack_dumps(data):
+    '''return data msgpack-encoded, None if msgpack isn't installed.'''
+    if msgpack is None:
+        return None
+    if isinstance(data, RawJSON):
+        data = json_loads(data)
+    return msgpack.packb(data, use_bin_type=True)
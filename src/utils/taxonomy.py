@@ -0,0 +1,232 @@
+'''
+Local taxonomy tree, used to expand species to all their descendants
+(include_tax_tree query parameter) without querying the remote taxonomy
+service.
+
+The tree is built from NCBI taxdump "nodes.dmp" file
+(ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz, the archive itself
+can be given). Nodes are stored in depth-first order, so descendants of
+a taxid are a contiguous slice of that order. Once built, the tree is
+saved next to the dump file (".idx") in a compact binary format, loaded
+in a fraction of a second on next startups.
+
+Without a tree, species are expanded by the remote taxonomy service: API
+handlers use expand_species_async, not to block the IOLoop meanwhile.
+'''
+import os
+import json
+import time
+import tarfile
+import logging
+from array import array
+
+import requests
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from config import (TAXDUMP_PATH, TAXONOMY_CACHE_SIZE,
+                    TAXONOMY_SERVICE_URL, TAXONOMY_REMOTE_FALLBACK)
+from .cache import LRUCache
+
+_IDX_MAGIC = b'MGTAXv1\n'
+
+
+class TaxonomyTree(object):
+    '''taxids in depth-first order ("order"), with the size of the
+       subtree rooted at each position ("size") and the position of each
+       taxid in "order" ("pos", indexed by taxid, -1 if unknown).
+    '''
+
+    def __init__(self, order, size, pos):
+        self.order = order
+        self.size = size
+        self.pos = pos
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        '''build tree from (taxid, parent_taxid) pairs.'''
+        parents = dict(nodes)
+        children = {}
+        for taxid, parent in parents.items():
+            if taxid != parent:
+                children.setdefault(parent, []).append(taxid)
+        # NCBI root (1) is its own parent
+        roots = [t for t, p in parents.items() if t == p or p not in parents]
+        max_taxid = max(parents) if parents else 0
+        order = array('l')
+        size = array('l')
+        pos = array('l', [-1]) * (max_taxid + 1)
+        for root in sorted(roots):
+            # iterative depth-first walk, sizes are set when leaving a node
+            stack = [(root, False)]
+            while stack:
+                taxid, leaving = stack.pop()
+                if leaving:
+                    p = pos[taxid]
+                    size[p] = len(order) - p
+                    continue
+                pos[taxid] = len(order)
+                order.append(taxid)
+                size.append(1)
+                stack.append((taxid, True))
+                for child in reversed(sorted(children.get(taxid, []))):
+                    stack.append((child, False))
+        return cls(order, size, pos)
+
+    @classmethod
+    def from_taxdump(cls, path):
+        '''build tree from a nodes.dmp file, or a taxdump.tar.gz archive.'''
+        def parse(lines):
+            for line in lines:
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                taxid, parent = line.split('\t|\t', 2)[:2]
+                yield int(taxid), int(parent)
+        if tarfile.is_tarfile(path):
+            with tarfile.open(path) as tar:
+                return cls.from_nodes(parse(tar.extractfile('nodes.dmp')))
+        with open(path) as f:
+            return cls.from_nodes(parse(f))
+
+    def save(self, path):
+        tmpfile = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(_IDX_MAGIC)
+            for arr in (self.order, self.pos):
+                f.write(array('l', [len(arr)]).tobytes())
+                arr.tofile(f)
+            self.size.tofile(f)
+        os.rename(tmpfile, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(_IDX_MAGIC)) != _IDX_MAGIC:
+                raise ValueError("'{}' is not a taxonomy index file".format(path))
+            arrays = []
+            for _ in range(2):
+                n = array('l')
+                n.fromfile(f, 1)
+                arr = array('l')
+                arr.fromfile(f, n[0])
+                arrays.append(arr)
+            order, pos = arrays
+            size = array('l')
+            size.fromfile(f, len(order))
+        return cls(order, size, pos)
+
+    def __contains__(self, taxid):
+        return 0 <= taxid < len(self.pos) and self.pos[taxid] != -1
+
+    def __len__(self):
+        return len(self.order)
+
+    def descendants(self, taxid):
+        '''return taxid and all its descendants (empty if unknown).'''
+        if taxid not in self:
+            return []
+        p = self.pos[taxid]
+        return self.order[p:p + self.size[p]].tolist()
+
+
+_tree = None
+_expand_cache = LRUCache(TAXONOMY_CACHE_SIZE)
+
+
+def get_tree():
+    '''return the TaxonomyTree built from TAXDUMP_PATH, or None if not
+       configured. Index file is (re)built if missing or older than
+       TAXDUMP_PATH.
+    '''
+    global _tree
+    if _tree is None and TAXDUMP_PATH:
+        idxfile = TAXDUMP_PATH + '.idx'
+        t0 = time.time()
+        if os.path.exists(idxfile) and \
+                os.path.getmtime(idxfile) >= os.path.getmtime(TAXDUMP_PATH):
+            _tree = TaxonomyTree.load(idxfile)
+        else:
+            _tree = TaxonomyTree.from_taxdump(TAXDUMP_PATH)
+            try:
+                _tree.save(idxfile)
+            except (IOError, OSError) as e:
+                logging.warning("Can't save taxonomy index '%s': %s", idxfile, e)
+        logging.info("Taxonomy tree loaded (%d nodes) in %.2fs",
+                     len(_tree), time.time() - t0)
+    return _tree
+
+
+_REMOTE_HEADERS = {'content-type': 'application/x-www-form-urlencoded',
+                   'user-agent': "Python-requests_mygene.info/%s (gzip)"
+                   % requests.__version__}
+
+
+def _remote_url(taxids):
+    return TAXONOMY_SERVICE_URL + '?ids=' + \
+        ','.join(['{}'.format(t) for t in taxids]) + '&expand_species=true'
+
+
+def _expand_species_remote(taxids):
+    try:
+        res = requests.post(_remote_url(taxids), headers=_REMOTE_HEADERS)
+    except requests.RequestException as e:
+        logging.warning("Can't expand species %s: %s", taxids, e)
+        return None
+    if res.status_code == requests.codes.ok:
+        return res.json()
+    return None
+
+
+async def _expand_species_remote_async(taxids):
+    request = HTTPRequest(_remote_url(taxids), method="POST", body="",
+                          headers=_REMOTE_HEADERS)
+    try:
+        res = await AsyncHTTPClient().fetch(request, raise_error=False)
+    except Exception as e:
+        # connection errors, timeouts
+        logging.warning("Can't expand species %s: %s", taxids, e)
+        return None
+    if res.code == 200:
+        return json.loads(res.body.decode('utf-8'))
+    return None
+
+
+def _expand_species_local(taxids):
+    '''return taxids expanded with the local tree, None if there's none.'''
+    tree = get_tree()
+    if tree is None:
+        return None
+    expanded = set()
+    for taxid in taxids:
+        expanded.update(tree.descendants(taxid) or [taxid])
+    return sorted(expanded)
+
+
+def expand_species(taxids):
+    '''return given taxids and all their descendants, from the local
+       taxonomy tree, or from the remote service if there's no tree and
+       TAXONOMY_REMOTE_FALLBACK is set. Unknown taxids are kept as is.
+    '''
+    key = tuple(sorted(set(taxids)))
+    expanded = _expand_cache.get(key)
+    if expanded is None:
+        expanded = _expand_species_local(key)
+        if expanded is None and TAXONOMY_REMOTE_FALLBACK:
+            expanded = _expand_species_remote(key)
+        if expanded is None:
+            return list(taxids)
+        _expand_cache.set(key, expanded)
+    return list(expanded)
+
+
+async def expand_species_async(taxids):
+    '''same as expand_species, without blocking on the remote service.'''
+    key = tuple(sorted(set(taxids)))
+    expanded = _expand_cache.get(key)
+    if expanded is None:
+        expanded = _expand_species_local(key)
+        if expanded is None and TAXONOMY_REMOTE_FALLBACK:
+            expanded = await _expand_species_remote_async(key)
+        if expanded is None:
+            return list(taxids)
+        _expand_cache.set(key, expanded)
+    return list(expanded)
@@ -1,14 +1,52 @@
 from elasticsearch.exceptions import NotFoundError
 
 from biothings.settings import BiothingSettings
-from biothings.utils.es import get_es
+from biothings.utils.common import ask
+from config import USERFILTER_CACHE_SIZE, USERFILTER_CACHE_TTL
+from .cache import LRUCache, MISSING
 biothing_settings = BiothingSettings()
 
+ES_INDEX_NAME = 'userfilters'
+ES_DOC_TYPE = 'filter'
+
+# one cache of resolved filters per process, shared by all UserFilters
+# instances
+_filter_cache = LRUCache(maxsize=USERFILTER_CACHE_SIZE, ttl=USERFILTER_CACHE_TTL)
+
+
+def get_conn():
+    '''ES client of the current process (see utils.es.get_es).'''
+    # utils.es imports this module
+    from .es import get_es
+    return get_es(biothing_settings.es_host, role='api')
+
+
+def get_filter(name):
+    '''return a named filter (or None if it does not exist), from the
+       cache if available.
+    '''
+    return UserFilters().get(name)
+
+
+def get_cached_filter(name):
+    '''return a named filter from the cache, MISSING if not cached.'''
+    return _filter_cache.get(name, MISSING)
+
+
+def set_cached_filter(name, _filter):
+    '''cache a named filter fetched elsewhere (None if it does not exist).'''
+    _filter_cache.set(name, _filter)
+
+
+def cache_stats():
+    return _filter_cache.stats()
+
+
 class UserFilters(object):
     def __init__(self):
-        self.conn = get_es(biothing_settings.es_host) 
-        self.ES_INDEX_NAME = 'userfilters'
-        self.ES_DOC_TYPE = 'filter'
+        self.conn = get_conn()
+        self.ES_INDEX_NAME = ES_INDEX_NAME
+        self.ES_DOC_TYPE = ES_DOC_TYPE
         self._MAPPING = {
             "dynamic": False,
             "properties": {}
@@ -38,15 +76,24 @@ class UserFilters(object):
             print(self.conn.index(_doc, self.ES_INDEX_NAME,
                                   self.ES_DOC_TYPE,
                                   id=_doc['_id']))
+            _filter_cache.invalidate(name)
         else:
             print("No filter to add.")
 
-    def get(self, name):
-        '''get a named filter.'''
+    def get(self, name, use_cache=True):
+        '''get a named filter.
+           Non-existing filters are cached as well (as None).
+        '''
+        if use_cache:
+            _filter = _filter_cache.get(name, MISSING)
+            if _filter is not MISSING:
+                return _filter
         try:
-            return self.conn.get(self.ES_INDEX_NAME, name, self.ES_DOC_TYPE)['_source']
+            _filter = self.conn.get(self.ES_INDEX_NAME, name, self.ES_DOC_TYPE)['_source']
         except NotFoundError:
-            return None
+            _filter = None
+        _filter_cache.set(name, _filter)
+        return _filter
 
     def count(self):
         n = self.conn.count(None, self.ES_INDEX_NAME, self.ES_DOC_TYPE)['count']
@@ -62,20 +109,22 @@ class UserFilters(object):
 
     def delete(self, name, noconfirm=False):
         '''delete a named filter.'''
-        _filter = self.get(name)
+        _filter = self.get(name, use_cache=False)
         if _filter:
             msg = 'Found filter "{}". Continue to delete it?'.format(name)
             if noconfirm or ask(msg) == 'Y':
                 print('Deleting filter "{}"...'.format(name),)
                 print(self.conn.delete(self.ES_INDEX_NAME, self.ES_DOC_TYPE, name))
+                _filter_cache.invalidate(name)
         else:
             print('Filter "{}" does not exist. Abort now.'.format(name))
 
     def rename(self, name, newname):
         '''"rename" a named filter.
            Basically, this needs to create a new doc and delete the old one.
+           (cached entries for both names are invalidated by add and delete)
         '''
-        _filter = self.get(name)
+        _filter = self.get(name, use_cache=False)
         if _filter:
             msg = 'Found filter "{}". Rename it to "{}"?'.format(name, newname)
             if ask(msg) == 'Y':
@@ -0,0 +1,157 @@
+'''
+Warm-up of an API process before it reports healthy on /status: lazily
+loaded state (taxonomy tree, id and interval indices, data version) is
+loaded, then a corpus of frequent /gene and /query requests is replayed
+against ES, with at most WARMUP_CONCURRENCY requests at a time. This
+fills ES filesystem and query caches for the new index, and our response
+cache.
+
+The corpus is a file of request paths, one per line, sampled from access
+logs (tornado or nginx format) with:
+
+    python -m utils.warmup <access log> [<output file>] [<number of requests>]
+'''
+import re
+import sys
+import time
+import asyncio
+import logging
+from collections import Counter
+from urllib.parse import urlsplit, parse_qsl
+
+from config import WARMUP_CORPUS_PATH, WARMUP_CONCURRENCY, WARMUP_TIMEOUT
+from . import taxonomy, idindex, intervalindex
+
+_REQUEST_PATH = re.compile(r'\bGET (/\S*(?:/gene/|/query)\S*)')
+# not affecting results, or not replayable
+_IGNORED_PARAMS = ('callback', 'msgpack', 'email')
+
+
+def parse_request(path):
+    '''return ("gene", geneid, kwargs) or ("query", q, kwargs) for a /gene
+       or /query GET request path, None if it can't be replayed.
+    '''
+    url = urlsplit(path)
+    kwargs = dict(parse_qsl(url.query))
+    for param in _IGNORED_PARAMS:
+        kwargs.pop(param, None)
+    segments = [s for s in url.path.split('/') if s]
+    if len(segments) >= 2 and segments[-2] == 'gene':
+        # same defaults as GeneHandler
+        kwargs.setdefault('scopes', 'entrezgene,ensemblgene,retired')
+        kwargs.setdefault('species', 'all')
+        return 'gene', segments[-1], kwargs
+    if segments and segments[-1] == 'query' and kwargs.get('q') and \
+            not set(kwargs) & set(['scroll_id', 'fetch_all', 'stream', 'cursor']):
+        try:
+            for param in ('from', 'size'):
+                if param in kwargs:
+                    kwargs[param] = int(kwargs[param])
+        except ValueError:
+            return None
+        return 'query', kwargs.pop('q'), kwargs
+    return None
+
+
+def load_corpus(path):
+    '''return replayable requests from a corpus file.'''
+    with open(path) as f:
+        requests = [parse_request(line.strip()) for line in f if line.strip()]
+    return [r for r in requests if r is not None]
+
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100.))], 3)
+
+
+class Warmer(object):
+    '''warm-up of ESQueryAsync "esq", see module docstring. "done" is False
+       while warm-up is running.
+    '''
+
+    def __init__(self, esq, corpus_path=WARMUP_CORPUS_PATH,
+                 concurrency=WARMUP_CONCURRENCY, timeout=WARMUP_TIMEOUT):
+        self.esq = esq
+        self.corpus_path = corpus_path
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.done = True
+        self.report = {}
+        self._latencies = []
+        self._errors = 0
+
+    def start(self):
+        '''schedule warm-up on the IOLoop, process is not warm from now.'''
+        from tornado.ioloop import IOLoop
+        self.done = False
+        IOLoop.current().add_callback(self.run)
+
+    async def run(self):
+        self.done = False
+        t0 = time.time()
+        try:
+            await asyncio.wait_for(self._run(), self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Warm-up stopped after %ss", self.timeout)
+        except Exception as e:
+            logging.exception("Warm-up failed: %s", e)
+        self.report = {"seconds": round(time.time() - t0, 3),
+                       "requests": len(self._latencies),
+                       "errors": self._errors,
+                       "p50_ms": _percentile(self._latencies, 50),
+                       "p99_ms": _percentile(self._latencies, 99)}
+        logging.info("Warm-up done: %s", self.report)
+        self.done = True
+
+    def status(self):
+        return {"done": self.done, "requests": len(self._latencies),
+                "errors": self._errors}
+
+    async def _run(self):
+        taxonomy.get_tree()
+        idindex.get_id_index()
+        intervalindex.get_interval_index()
+        await self.esq._get_data_version_async()
+        if not self.corpus_path:
+            return
+        requests = iter(load_corpus(self.corpus_path))
+        await asyncio.gather(*[self._worker(requests)
+                               for _ in range(self.concurrency)])
+
+    async def _worker(self, requests):
+        # workers share the iterator, each takes the next request
+        for endpoint, arg, kwargs in requests:
+            t0 = time.perf_counter()
+            try:
+                if endpoint == 'gene':
+                    await self.esq.get_gene_async(arg, **kwargs)
+                else:
+                    await self.esq.query_async(arg, **kwargs)
+            except Exception as e:
+                self._errors += 1
+                logging.debug("Warm-up request %s '%s' failed: %s", endpoint, arg, e)
+            self._latencies.append((time.perf_counter() - t0) * 1000)
+
+
+def main():
+    logfile = sys.argv[1]
+    output = sys.argv[2] if len(sys.argv) > 2 else WARMUP_CORPUS_PATH
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    counts = Counter()
+    with open(logfile) as f:
+        for line in f:
+            m = _REQUEST_PATH.search(line)
+            if m and parse_request(m.group(1)) is not None:
+                counts[m.group(1)] += 1
+    with open(output, 'w') as f:
+        for path, _ in counts.most_common(n):
+            f.write(path + '\n')
+    print("{} requests saved in '{}' (out of {} distinct)".format(
+        min(n, len(counts)), output, len(counts)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,20 @@
 import re
 import json
+import hashlib
 
 from tornado.web import HTTPError
+from tornado.iostream import StreamClosedError
+from elasticsearch.exceptions import TransportError
 from biothings.www.api.handlers import MetaDataHandler, BiothingHandler, QueryHandler, \
                                        FieldsHandler, BaseHandler
+from biothings.www.api.es import QueryError
 
 from biothings.utils.version import get_software_info
 from biothings.settings import BiothingSettings
 from utils.es import ESQuery
+from utils.es_async import ESQueryAsync
+from utils import metrics, serializer
+from utils.cache import LRUCache
 from biothings.utils.common import split_ids
 from config import GA_EVENT_CATEGORY
 import os, logging
@@ -15,25 +22,133 @@ import os, logging
 mygene_settings = BiothingSettings()
 
 
-class MyGeneMetaDataHandler(MetaDataHandler):
+def set_response_headers(handler):
+    '''CORS and cache headers, as biothings BaseHandler.return_json sets
+       them, for responses written directly.
+    '''
+    handler.support_cors()
+    if not getattr(handler, 'disable_caching', False):
+        handler.set_cacheable()
+
+
+class CachedJSONMixin(object):
+    '''GET json responses built once per ES metadata version (data version
+       and _meta, see ESQuery._get_metadata_version): the serialized
+       body and its ETag are kept per request URI, so following requests
+       only check data version, and conditional requests get a 304.
+       JSONP and msgpack responses aren't cached.
+    '''
+    # uri -> (data version, body, etag), set per handler class
+    _cached_bodies = None
+
+    def get(self, *args, **kwargs):
+        self.cached_get(super(CachedJSONMixin, self).get, *args, **kwargs)
+
+    def cached_get(self, get, *args, **kwargs):
+        '''serve cached response, or call get() to build it.'''
+        self._building = None
+        if self.get_argument('callback', None) or \
+           self.get_argument('msgpack', None) in ('1', 'true'):
+            return get(*args, **kwargs)
+        version = self.esq._get_metadata_version()
+        entry = self._cached_bodies.get(self.request.uri)
+        if version is None or entry is None or entry[0] != version:
+            # built and cached by return_json
+            self._building = version
+            return get(*args, **kwargs)
+        self._write_cached(entry)
+
+    def return_json(self, data, **kwargs):
+        if not self._building:
+            return super(CachedJSONMixin, self).return_json(data, **kwargs)
+        body = json.dumps(data, indent=kwargs.get('indent'))
+        entry = (self._building, body,
+                 '"{}"'.format(hashlib.sha1(body.encode('utf-8')).hexdigest()))
+        self._cached_bodies.set(self.request.uri, entry)
+        self._write_cached(entry)
+
+    def _write_cached(self, entry):
+        set_response_headers(self)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("ETag", entry[2])
+        if self.check_etag_header():
+            self.set_status(304)
+        else:
+            self.write(entry[1])
+
+
+class MyGeneMetaDataHandler(CachedJSONMixin, MetaDataHandler):
     '''Return db metadata in json string.'''
     disable_caching = True
     esq = ESQuery()
+    _cached_bodies = LRUCache(10)
 
     def get(self):
+        self.cached_get(self._get_metadata)
+
+    def _get_metadata(self):
         _meta = self.esq.metadata()
         self._fill_software_info(_meta)
         _meta["app_revision"] = os.environ["MYGENE_REVISION"]
         self.return_json(_meta, indent=2)
 
-class MyGeneFieldsHandler(FieldsHandler):
+class MyGeneFieldsHandler(CachedJSONMixin, FieldsHandler):
     ''' This class is for the /metadata/fields endpoint. '''
     esq = ESQuery()
+    # one entry per search/prefix parameters
+    _cached_bodies = LRUCache(100)
 
-class GeneHandler(BiothingHandler):
-    esq = ESQuery()
+class MetricsMixin(object):
+    '''time request phases (see utils/metrics.py), reported per
+       "<metrics_name>_<method>" endpoint on /metrics.
+    '''
+    metrics_name = None
 
-    def get(self, geneid=None):
+    def prepare(self):
+        metrics.start_request("{}_{}".format(self.metrics_name,
+                                             self.request.method.lower()))
+        super(MetricsMixin, self).prepare()
+
+    def get_query_params(self):
+        with metrics.timer('params'):
+            return super(MetricsMixin, self).get_query_params()
+
+    def return_json(self, *args, **kwargs):
+        with metrics.timer('serialize'):
+            return super(MetricsMixin, self).return_json(*args, **kwargs)
+
+    def on_finish(self):
+        metrics.finish_request()
+        super(MetricsMixin, self).on_finish()
+
+
+class SerializerMixin(object):
+    '''encode responses with utils.serializer: compact json (unless an
+       indent is given) and msgpack are encoded directly from data, and
+       RawJSON data (raw ES responses) is written as is, with the headers
+       biothings would set. JSONP responses are left to biothings.
+    '''
+    def return_json(self, data, indent=None, **kwargs):
+        if self.get_argument('callback', None):
+            if isinstance(data, serializer.RawJSON):
+                data = serializer.json_loads(data)
+            return super(SerializerMixin, self).return_json(data, indent=indent, **kwargs)
+        set_response_headers(self)
+        if self.get_argument('msgpack', None) in ('1', 'true'):
+            body = serializer.msgpack_dumps(data)
+            if body is not None:
+                self.set_header("Content-Type", "application/x-msgpack")
+                self.write(body)
+                return
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(serializer.json_dumps(data, indent=indent))
+
+
+class GeneHandler(MetricsMixin, SerializerMixin, BiothingHandler):
+    metrics_name = 'gene'
+    esq = ESQueryAsync()
+
+    async def get(self, geneid=None):
         '''/gene/<geneid>
            geneid can be entrezgene, ensemblgene, retired entrezgene ids.
            /gene/1017
@@ -44,7 +159,7 @@ class GeneHandler(BiothingHandler):
             kwargs = self.get_query_params()
             kwargs.setdefault('scopes', 'entrezgene,ensemblgene,retired')
             kwargs.setdefault('species', 'all')
-            gene = self.esq.get_gene(geneid, **kwargs)
+            gene = await self.esq.get_gene_async(geneid, **kwargs)
             if gene:
                 self.return_json(gene)
                 self.ga_track(event={'category': GA_EVENT_CATEGORY,
@@ -54,9 +169,148 @@ class GeneHandler(BiothingHandler):
         else:
             raise HTTPError(404)
 
+    async def post(self, geneid=None):
+        '''/gene POST, same as /query POST with gene ids scopes and all
+           fields returned by default.
+           parameters:
+            ids
+            fields
+            species
+        '''
+        kwargs = self.get_query_params()
+        ids = kwargs.pop('ids', None)
+        if ids:
+            ids = split_ids(ids)
+            kwargs.setdefault('scopes', 'entrezgene,ensemblgene,retired')
+            res = await self.esq.mget_gene_async(ids, **kwargs)
+        else:
+            res = {'success': False, 'error': "Missing required parameters."}
+        self.return_json(res)
+        self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                             'action': 'gene_post',
+                             'label': 'qsize',
+                             'value': len(ids) if ids else 0})
+
 
-class QueryHandler(QueryHandler):
-    esq = ESQuery()
+class QueryHandler(MetricsMixin, SerializerMixin, QueryHandler):
+    metrics_name = 'query'
+    esq = ESQueryAsync()
+
+    async def get(self):
+        '''
+        parameters:
+            q
+            fields
+            from
+            size
+            sort
+            species
+            fetch_all
+            scroll_id
+            stream      if true, all hits are returned as newline-delimited
+                        json (one hit per line), instead of scroll batches
+            cursor      if true, hits are paged with a cursor instead of
+                        "from": response has a "cursor" to pass to get the
+                        next page (null on last page), sorted on "sort"
+                        then _id
+
+            explain
+        '''
+        kwargs = self.get_query_params()
+        q = kwargs.pop('q', None)
+        scroll_id = kwargs.pop('scroll_id', None)
+        stream = kwargs.pop('stream', None) in (True, 1, '1', 'true')
+        res = None
+        if stream and q:
+            await self._write_stream(q, kwargs)
+            self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                                 'action': 'query_stream',
+                                 'label': 'qsize',
+                                 'value': len(q)})
+            return
+        if scroll_id:
+            res = await self.esq.scroll_async(scroll_id, **kwargs)
+        elif q:
+            for arg in ['from', 'size']:
+                value = kwargs.get(arg, None)
+                if value:
+                    try:
+                        kwargs[arg] = int(value)
+                    except ValueError:
+                        res = {'success': False,
+                               'error': 'Parameter "{}" must be an integer.'.format(arg)}
+            if res is None:
+                res = await self.esq.query_async(q, **kwargs)
+        else:
+            res = {'success': False, 'error': "Missing required parameters."}
+
+        self.return_json(res)
+        self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                             'action': 'query_get',
+                             'label': 'qsize',
+                             'value': len(q) if q else 0})
+
+    async def post(self):
+        '''
+        parameters:
+            q
+            scopes
+            fields
+            species
+
+            jsoninput   if true, input "q" is a json string, must be decoded as a list.
+        '''
+        kwargs = self.get_query_params()
+        q = kwargs.pop('q', None)
+        jsoninput = kwargs.pop('jsoninput', None) in ('1', 'true')
+        if q:
+            try:
+                ids = json.loads(q) if jsoninput else split_ids(q)
+                if not isinstance(ids, list) or not ids:
+                    raise ValueError
+            except ValueError:
+                res = {'success': False, 'error': 'Invalid input for "q" parameter.'}
+            else:
+                res = await self.esq.mget_biothings_async(ids, **kwargs)
+        else:
+            res = {'success': False, 'error': "Missing required parameters."}
+
+        self.return_json(res)
+        self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                             'action': 'query_post',
+                             'label': 'qsize',
+                             'value': len(q) if q else 0})
+
+    async def _write_stream(self, q, kwargs):
+        '''write all hits of query "q" as newline-delimited json. Each
+           batch is flushed before the next one is fetched, so memory use
+           doesn't depend on the number of hits, and a slow client slows
+           down the scroll.
+        '''
+        self.support_cors()
+        self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+        stream = self.esq.stream_async(q, **kwargs)
+        sent = False
+        try:
+            async for hits in stream:
+                with metrics.timer('serialize'):
+                    self.write(b"".join([serializer.json_dumps(hit) + b"\n"
+                                         for hit in hits]))
+                sent = True
+                await self.flush()
+        except (QueryError, TransportError) as err:
+            error = {'success': False,
+                     'error': str(err) if isinstance(err, QueryError)
+                     else "invalid query term."}
+            if sent:
+                # status and headers are gone, error is the last line
+                self.write(json.dumps(error) + "\n")
+            else:
+                self.return_json(error)
+        except StreamClosedError:
+            logging.debug("Client closed stream of query '%s'", q)
+        finally:
+            await stream.aclose()
 
     # over ride from biothings BaseHandler to stop renaming "from" to "from_"
     def _check_paging_param(self, kwargs):
@@ -22,10 +22,39 @@ from config import API_VERSION
 #*******#
 from biothings.www.api.handlers import StatusHandler, BiothingHandler
 from utils.es import ESQuery
+from utils import metrics, querycost
+from utils.es_async import ESQueryAsync
+from utils.warmup import Warmer
+warmer = Warmer(ESQueryAsync())
+
 class MyGeneStatusHandler(StatusHandler):
-    ''' This class is for the /status endpoint. '''
+    ''' This class is for the /status endpoint: 503 until startup
+        warm-up is done. '''
     esq = ESQuery()
 
+    def get(self):
+        if not warmer.done:
+            self.set_status(503)
+            return self.return_json(warmer.status())
+        super(MyGeneStatusHandler, self).get()
+
+    def head(self):
+        if not warmer.done:
+            return self.set_status(503)
+        super(MyGeneStatusHandler, self).head()
+
+class MyGeneMetricsHandler(BiothingHandler):
+    ''' This class is for the /metrics endpoint: latency histograms
+        per endpoint, query type and phase, since process start, counts
+        of ES requests shared by concurrent identical calls, /query cost
+        estimates, and startup warm-up report. '''
+    def get(self):
+        res = metrics.get_metrics()
+        res['es_coalescing'] = ESQueryAsync.single_flight.stats()
+        res['query_cost'] = querycost.get_stats()
+        res['warmup'] = warmer.report
+        self.return_json(res)
+
 class MainHandler(BiothingHandler):
     def get(self):
         if INCLUDE_DOCS:
@@ -74,6 +103,7 @@ if INCLUDE_DOCS and not os.path.exists(DOCS_STATIC_PATH):
 APP_LIST = [
     (r"/", MainHandler),
     (r"/status", MyGeneStatusHandler),
+    (r"/metrics", MyGeneMetricsHandler),
     (r"/metadata", MyGeneMetaDataHandler),
     #TODO: what is v2a ?
     (r"/v2a/metadata", MyGeneMetaDataHandler),
@@ -83,7 +113,6 @@ APP_LIST = [
 APP_LIST += add_apps('', api_app_list)
 APP_LIST += add_apps(API_VERSION, api_app_list)
 #APP_LIST += add_apps('demo', demo_app_list)
-#APP_LIST += add_apps('v2a', api_v2_async_app_list)
 #APP_LIST += add_apps('auth', auth_app_list)
 
 if options.debug:
@@ -102,6 +131,7 @@ if __USE_WSGI__:
 
 
 if __name__ == '__main__':
+    warmer.start()
     main(APP_LIST)
 
 